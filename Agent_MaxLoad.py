@@ -1,7 +1,7 @@
 import asyncio
 import logging
-import statistics
-from agent_common import AgentConfig, AgentSocket, AppState, FileHelper
+from agent_common import AppState
+from agent_scenarios import SEARCH_STRATEGIES, ScenarioRunner, add_agent_args, run_with_agents, save_capacity_csv
 
 # -----------------------------
 # Configuration and defaults
@@ -14,10 +14,18 @@ def parse_args():
     p.add_argument('--target-eps', type=float, default=5000) # expected total events/sec (used to set warm-up)
     p.add_argument('--warmup-min', type=float, default=5) # 5–10 minutes recommended
     p.add_argument('--step-min', type=float, default=3) # 3–5 minutes recommended
-    p.add_argument('--step-inc', type=float, default=0.10) # +10% per step
+    p.add_argument('--search', type=str, default='bisect', choices=SEARCH_STRATEGIES) # bisect: x2 probes to bracket the breach, then bisection; step: +step-inc per step
+    p.add_argument('--step-inc', type=float, default=0.10) # +10% per step (--search step)
+    p.add_argument('--resolution', type=float, default=0.02) # bisection stops when the bracket is within 2% (--search bisect)
+    p.add_argument('--min-eps', type=float, default=0) # bisect gives up when the SLOs fail even below this (0 = target-eps / 1024)
+    p.add_argument('--steady-tol', type=float, default=0.05) # step ends when EPS/latency drift and EPS CI are within 5% (0 = fixed steps)
+    p.add_argument('--step-max-min', type=float, default=0) # unsteady steps run on up to this (0 = 2x step-min)
+    p.add_argument('--gen-lag-p99-sec', type=float, default=0.05) # own event loop later than this (p99) = generator-bound step
+    p.add_argument('--gen-send-ratio', type=float, default=0.9) # sends below this part of the plan with a late loop = generator-bound
     p.add_argument('--slo-p95-sec', type=float, default=0.5) # p95 confirm latency threshold
     p.add_argument('--slo-err-rate', type=float, default=0.01) # <1% errors
     p.add_argument('--save-to', type=str, default=None)  # file to save results
+    add_agent_args(p)
     p.add_argument('--host', type=str, default='127.0.0.1')
     p.add_argument('--port', type=int, default=8444)
     p.add_argument('--token', type=str, default='MG2LIICYMYF4ANGRNUSQXWYAZTSK67DHSBFDRCZWEBQZEB6RUJKQ')
@@ -29,68 +37,28 @@ args = parse_args()
 # -----------------------------
 # Scenario controller
 # -----------------------------
+def search_options() -> dict:
+    return {"strategy": args.search, "step_min": args.step_min, "step_inc": args.step_inc,
+            "resolution": args.resolution, "min_eps": args.min_eps, "steady_tol": args.steady_tol, "step_max_min": args.step_max_min,
+            "gen_lag_p99_sec": args.gen_lag_p99_sec, "gen_send_ratio": args.gen_send_ratio}
+
 async def scenario_controller(app_state: AppState):
+    phases = []
     # Phase 1: Warm-up at 50% of target capacity
     if args.warmup_min > 0:
-        warmup_eps = args.target_eps * 0.5
-        await app_state.set_rate_limit_total(warmup_eps)
-        logging.info("Warm-up: setting total EPS to %.0f for %.1f min", warmup_eps, args.warmup_min)
-        await asyncio.sleep(args.warmup_min * 60)
-
+        phases.append({"name": "warm-up", "type": "constant", "x": 0.5, "min": args.warmup_min, "slo": False})
     # Phase 2: Step/capacity until SLO breach
-    best_sustainable = 0
-    best_confirmed = 0
-    step_sent = 0
-    step_confirmed = 0
-    step_p95 = 0
-    step_eps = args.target_eps
-
-    i_limit = 1000
-    for i in range(1, i_limit + 1):
-        step_eps = step_eps * (1.0 + args.step_inc)
-        await app_state.set_rate_limit_total(step_eps)
-        logging.info("Step: increased total EPS to %.0f, running for %.1f min", step_eps, args.step_min)
-
-        # run this step window
-        step_time = args.step_min * 60
-        await asyncio.sleep(step_time)
-
-        # evaluate window SLOs
-        lats, batches_sent, confirms, errors = app_state.snapshot_and_reset_window()
-        p95 = statistics.quantiles(lats, n=100)[94] if len(lats) >= 100 else (max(lats) if lats else 0.0)
-        mean_lat = statistics.mean(lats)
-        confirmed_eps = confirms * args.event_batch / step_time
-        err_rate = (errors / max(1, (confirms + errors)))
-        logging.info(
-            "Step result: p95=%.3fs, mean_lat=%.1fs sent=%d, confirms=%d, confirmed_eps=%d, errors=%d (err_rate=%.3f)",
-            p95, mean_lat, batches_sent, confirms, confirmed_eps, errors, err_rate
-        )
-
-        step_sent = batches_sent
-        step_confirmed = confirms
-        step_p95 = p95
-        if best_confirmed < confirmed_eps:
-            best_confirmed = confirmed_eps
-
-        if (confirmed_eps < step_eps * 0.85) or (p95 and p95 > args.slo_p95_sec) or (err_rate > args.slo_err_rate):
-            logging.warning(
-                "SLO breached at EPS=%.0f (eps=%.1f%% of target, p95=%.3fs, err_rate=%.3f). Using previous step as capacity.", 
-                confirmed_eps, 100 * confirmed_eps / step_eps, p95, err_rate)
-            break
+    phases.append({"name": "capacity", "type": "search", "eps": args.target_eps})
 
-        if (confirmed_eps > best_sustainable):
-            best_sustainable = confirmed_eps
+    runner = ScenarioRunner(app_state, args.target_eps, {"p95_sec": args.slo_p95_sec, "err_rate": args.slo_err_rate},
+                            search_options())
+    await runner.run(phases)
 
-        if i == i_limit:
-            logging.info("Reached maximum steps (%d).", i_limit)
+    result = runner.last_search
+    if args.save_to and result is not None:
+        save_capacity_csv(args.save_to, args.agents, args.event_batch, result)
 
-    if args.save_to:
-        FileHelper.save_results_csv(args.save_to,
-            ['Agents Count', 'Batch Size', 'Sent', 'Confirmed', 'P95', 'Best Eps', 'Best Confirmed'],
-            [args.agents, args.event_batch, step_sent, step_confirmed,"%.2f" % step_p95, "%d" % best_sustainable, "%d" % best_confirmed]
-        )
-
-    logging.info("Best sustainable capacity: %.0f EPS", best_sustainable)
+    logging.info("Best sustainable capacity: %.0f EPS", result.best_sustainable if result else 0)
     logging.info("Scenario complete. Stopping soon...")
 
 # -----------------------------
@@ -110,27 +78,7 @@ async def main():
     #args.slo_p95_sec = 0.5
     #args.slo_err_rate = 0.01
 
-    config = AgentConfig(args.host, args.port, args.token, args.event_batch)
-    app_state = AppState(args.agents, args.event_batch)
-
-    agents = [AgentSocket(config, app_state) for _ in range(args.agents)]
-
-    # Start agent tasks
-    agent_tasks = [asyncio.create_task(agent.start()) for agent in agents]
-
-    # Start scenario controller
-    scenario_task = asyncio.create_task(scenario_controller(app_state))
-
-    # Wait for scenario to finish
-    await scenario_task
-
-    # Signal to stop and disconnect agents
-    app_state.signalToStop()
-    await asyncio.sleep(3) # Allow some time for agents to finish
-    await asyncio.gather(*[agent.disconnect() for agent in agents]);
-
-    # Wait for all agents to finish
-    await asyncio.gather(*agent_tasks)
+    await run_with_agents(args, scenario_controller)
 
 if __name__ == "__main__":
     try:
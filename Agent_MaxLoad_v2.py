@@ -2,7 +2,7 @@ import asyncio
 from collections import deque
 import secrets
 import time
-from agent_common import AgentMessageHelper, AgentConfig
+from agent_common import AgentMessageHelper, AgentConfig, LoopMonitor
 
 import argparse
 def parse_args():
@@ -99,12 +99,13 @@ class TcpClientHelper:
 
 # --- Monitor rps and event loop lag ---
 async def monitor(config: AgentConfig, agent_tasks: list, stop_event):
+    loop_monitor = LoopMonitor()
+    loop_monitor.start()
     while not stop_event.is_set():
-        start = time.time()
-        await asyncio.sleep(0)
+        lags, ready_max, _, _ = loop_monitor.take_window()
+        lag = lags.percentile(99) * 1000  # мс, p99 of timer wakeups since the last print
 
         now = time.time()
-        lag = (now - start) * 1000  # мс
         rps = 0.0
         if len(g_events_window) > 1:
             duration = now - g_events_window[0]
@@ -113,7 +114,7 @@ async def monitor(config: AgentConfig, agent_tasks: list, stop_event):
         tasks_count = len(agent_tasks)
         print(f"Users: {tasks_count}, Epb: {config.batch_size}, " +
               f"Req/s: {rps:.2f}, Events/sec: {rps * config.batch_size:.2f}, "+
-              f"Event loop lag: {lag:.2f}ms", end='\r')
+              f"Event loop lag p99: {lag:.2f}ms, ready callbacks max: {ready_max}", end='\r')
 
         g_events_window.clear()
         await asyncio.sleep(4)
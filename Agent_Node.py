@@ -0,0 +1,48 @@
+import logging
+import multiprocessing
+from agent_cluster import DEFAULT_CLUSTER_KEY, DEFAULT_CLUSTER_PORT, run_node
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args():
+    p = argparse.ArgumentParser(description="Generator node: runs the agents a coordinator (any scenario script with --nodes) hands out")
+    p.add_argument('--coordinator', type=str, required=True) # host[:port] of the coordinator
+    p.add_argument('--cluster-key', type=str, default=DEFAULT_CLUSTER_KEY) # same as the coordinator's; the default only on loopback
+    p.add_argument('--processes', type=int, default=1) # nodes on this host, one per core; each one takes its own share
+    p.add_argument('--weight', type=float, default=1.0) # share of the agents relative to the other nodes
+    p.add_argument('--once', action='store_true') # exit after one run (default: wait for the next one)
+    return p.parse_args()
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+    host, _, port = args.coordinator.partition(':')
+    address = (host, int(port or DEFAULT_CLUSTER_PORT))
+    logging.info("Node for coordinator %s:%d, %d process(es)", *address, args.processes)
+    if args.processes == 1:
+        run_node(address, args.cluster_key, args.weight, once=args.once)
+        return
+
+    # spawn: the agents' event loops start in the children only
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=run_node, args=(address, args.cluster_key, args.weight, None, args.once),
+                             name=f"Node-{i}", daemon=True) for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
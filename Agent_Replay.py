@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from agent_common import AppState
+from agent_scenarios import ScenarioRunner, add_agent_args, run_with_agents
+from agent_trace import TraceReader
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args():
+    p = argparse.ArgumentParser(description="Replays a recorded trace (--record-trace) of batches at their times")
+    p.add_argument('--trace', type=str, required=True) # trace file, see agent_trace.py
+    p.add_argument('--speed', type=float, default=1.0) # 2 = twice as fast (the same batches in half the time)
+    p.add_argument('--agents', type=int, default=0) # replay agents (0 = as many as in the trace); trace agents share or split
+    p.add_argument('--from-sec', type=float, default=0) # part of the trace to replay, sec since its start
+    p.add_argument('--to-sec', type=float, default=0) # 0 = to the end
+    p.add_argument('--save-to', type=str, default=None)  # a row for the replay
+    add_agent_args(p)
+    p.set_defaults(window=8) # the trace sets the pace: more batches in flight before a send is skipped
+    p.add_argument('--host', type=str, default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8444)
+    p.add_argument('--token', type=str, default='MG2LIICYMYF4ANGRNUSQXWYAZTSK67DHSBFDRCZWEBQZEB6RUJKQ')
+    return p.parse_args()
+
+args = parse_args()
+
+# -----------------------------
+# Replay controller
+# -----------------------------
+async def replay_controller(app_state: AppState):
+    phase = {"name": "replay", "type": "replay", "trace": args.trace, "speed": args.speed,
+             "from_sec": args.from_sec, "to_sec": args.to_sec, "slo": False}
+    await ScenarioRunner(app_state, 0, save_to=args.save_to).run([phase])
+    logging.info("Replay complete. Stopping soon...")
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+async def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    with TraceReader(args.trace) as reader:
+        logging.info("Trace: %d batches of %d agents over %.1f sec", reader.records, reader.agents, reader.duration)
+        args.agents = args.agents or reader.agents
+        # for rates from confirm counts; batches keep their own sizes
+        args.event_batch = max(1, round(reader.mean_batch()))
+    await run_with_agents(args, replay_controller, self_paced=False)
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
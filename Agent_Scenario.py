@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from agent_common import AppState
+from agent_scenarios import ScenarioRunner, add_agent_args, load_scenario, run_with_agents
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args():
+    p = argparse.ArgumentParser(description="Runs the phases of a JSON/YAML scenario on one connected agent pool")
+    p.add_argument('--scenario', type=str, required=True) # scenario file, see Scenarios/
+    p.add_argument('--agents', type=int, default=200)  # number of concurrent agents
+    p.add_argument('--event-batch', type=int, default=100) # events per batch
+    p.add_argument('--target-eps', type=float, default=5000) # capacity for "x" rates until a search phase finds one
+    p.add_argument('--save-to', type=str, default=None)  # a row per phase
+    add_agent_args(p)
+    p.add_argument('--host', type=str, default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8444)
+    p.add_argument('--token', type=str, default='MG2LIICYMYF4ANGRNUSQXWYAZTSK67DHSBFDRCZWEBQZEB6RUJKQ')
+    return p.parse_args()
+
+args = parse_args()
+
+# -----------------------------
+# Scenario controller
+# -----------------------------
+async def scenario_controller(app_state: AppState):
+    scenario = load_scenario(args.scenario)
+    runner = ScenarioRunner(app_state, scenario.get("target_eps", args.target_eps), scenario.get("slo"),
+                            scenario.get("search"), args.save_to)
+    results = await runner.run(scenario["phases"])
+
+    breached = [result.name for result in results if result.slo_passed is False]
+    if breached:
+        logging.warning("SLO breached in phases: %s", ", ".join(breached))
+    logging.info("Capacity: %.0f EPS", runner.capacity)
+    logging.info("Scenario complete. Stopping soon...")
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+async def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    scenario = load_scenario(args.scenario)  # fail on a bad file before connecting agents
+    if not args.reconnect and any(phase["type"] == "churn" for phase in scenario["phases"]):
+        logging.info("Scenario has churn phases, dropped agents will reconnect (--reconnect)")
+        args.reconnect = True
+    # replayed batches come from the trace only: agents that pace themselves would add to them
+    replays = sum(1 for phase in scenario["phases"] if phase["type"] == "replay")
+    if replays and replays < len(scenario["phases"]):
+        raise ValueError("Replay phases can't be mixed with other phase types")
+    await run_with_agents(args, scenario_controller, self_paced=not replays)
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
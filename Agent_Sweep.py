@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+from agent_common import TLS_READ_BUFFER, TRANSPORTS, AgentConfig, AgentSocket, AppState, ConnectionRamp, FileHelper
+from agent_payloads import load_corpus
+from agent_scenarios import SEARCH_STRATEGIES, CapacitySearch, save_capacity_csv, start_metrics
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args():
+    p = argparse.ArgumentParser(description="Capacity sweep over agents x batch sizes in one process (replaces TestRun_Max.ps1)")
+    p.add_argument('--agents', type=str, default='1,10,100,500,1000') # agent counts, ascending is cheapest
+    p.add_argument('--batches', type=str, default='10,100,500,1000,3000,5000') # events per batch
+    p.add_argument('--target-eps', type=float, default=5000) # first step starts above this rate in every cell
+    p.add_argument('--warmup-min', type=float, default=0.5) # per cell, at 50% of target; pool stays connected between cells
+    p.add_argument('--step-min', type=float, default=0.5)
+    p.add_argument('--search', type=str, default='bisect', choices=SEARCH_STRATEGIES) # bisect: x2 probes to bracket the breach, then bisection; step: +step-inc per step
+    p.add_argument('--step-inc', type=float, default=0.10) # +10% per step (--search step)
+    p.add_argument('--resolution', type=float, default=0.02) # bisection stops when the bracket is within 2% (--search bisect)
+    p.add_argument('--min-eps', type=float, default=0) # bisect gives up when the SLOs fail even below this (0 = target-eps / 1024)
+    p.add_argument('--steady-tol', type=float, default=0.05) # step ends when EPS/latency drift and EPS CI are within 5% (0 = fixed steps)
+    p.add_argument('--step-max-min', type=float, default=0) # unsteady steps run on up to this (0 = 2x step-min)
+    p.add_argument('--gen-lag-p99-sec', type=float, default=0.05) # own event loop later than this (p99) = generator-bound step
+    p.add_argument('--gen-send-ratio', type=float, default=0.9) # sends below this part of the plan with a late loop = generator-bound
+    p.add_argument('--slo-p95-sec', type=float, default=0.5) # p95 confirm latency threshold
+    p.add_argument('--slo-err-rate', type=float, default=0.01) # <1% errors
+    p.add_argument('--save-to', type=str, default='results_sweep.csv') # a row per cell; done cells are skipped on restart
+    p.add_argument('--connect-timeout', type=float, default=120) # sec to wait for a resized pool to be approved
+    p.add_argument('--window', type=int, default=1) # batches in flight per agent (1 = wait confirm before next send)
+    p.add_argument('--open-loop', action='store_true') # plan sends from target rate; latency from planned send time
+    p.add_argument('--spawn-rate', type=float, default=0) # new connections per sec (0 = all at once)
+    p.add_argument('--handshake-limit', type=int, default=0) # connects in progress at most (0 = no limit)
+    p.add_argument('--metrics-to', type=str, default=None) # per-second metrics stream file
+    p.add_argument('--metrics-format', type=str, default='jsonl', choices=['jsonl', 'bin']) # bin: columnar float64 blocks
+    p.add_argument('--metrics-port', type=int, default=0) # serve OpenMetrics on http://127.0.0.1:PORT/metrics (0 = off)
+    p.add_argument('--no-tls', action='store_true') # plaintext connection (e.g. TestServer.py --no-tls)
+    p.add_argument('--tls-read-buffer', type=int, default=TLS_READ_BUFFER) # plaintext read buffer of every TLS connection in the process (0 = asyncio's 256 KB)
+    p.add_argument('--transport', type=str, default='stream', choices=TRANSPORTS) # protocol: frames parsed in place, coalesced writes
+    p.add_argument('--payloads', type=str, default=None) # event corpus file, or "default" (see agent_payloads.py)
+    p.add_argument('--host', type=str, default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8444)
+    p.add_argument('--token', type=str, default='MG2LIICYMYF4ANGRNUSQXWYAZTSK67DHSBFDRCZWEBQZEB6RUJKQ')
+    return p.parse_args()
+
+args = parse_args()
+
+# -----------------------------
+# Warm agent pool
+# -----------------------------
+class AgentPool:
+    # Agents stay connected between cells; resize() connects or closes only the difference
+    def __init__(self, config: AgentConfig, app_state: AppState) -> None:
+        self._config = config
+        self._app_state = app_state
+        self._agents: list[AgentSocket] = []
+        self._ramps: list[ConnectionRamp] = []
+
+    async def resize(self, count: int, timeout: float) -> bool:
+        app_state = self._app_state
+        # agents that lost the connection are replaced
+        alive = [agent for agent in self._agents if agent.ready]
+        closing = [agent for agent in self._agents if not agent.ready]
+        if len(alive) > count:
+            closing += alive[count:]
+            alive = alive[:count]
+        await asyncio.gather(*[agent.close() for agent in closing])
+
+        added = [AgentSocket(self._config, app_state) for _ in range(count - len(alive))]
+        self._agents = alive + added
+        app_state.agents_count = count
+        app_state.attach_agents(self._agents)  # drop_agents and the per-agent samples of the fairness stats
+        if added:
+            logging.info("Pool: %d agents kept, connecting %d", len(alive), len(added))
+            ramp = ConnectionRamp(self._config, app_state)
+            ramp.start(added)
+            self._ramps.append(ramp)
+
+        deadline = time.monotonic() + timeout
+        while app_state.agents_active < count and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        return app_state.agents_active >= count
+
+    async def close(self) -> None:
+        await asyncio.gather(*[agent.disconnect() for agent in self._agents])
+        for ramp in self._ramps:
+            await ramp.join()
+
+# -----------------------------
+# Sweep controller
+# -----------------------------
+def load_done_cells(filename: str) -> set[tuple[int, int]]:
+    return {(int(row['Agents Count']), int(row['Batch Size'])) for row in FileHelper.load_results_csv(filename)}
+
+async def sweep(pool: AgentPool, config: AgentConfig, app_state: AppState) -> None:
+    agent_counts = [int(x) for x in args.agents.split(',')]
+    batch_sizes = [int(x) for x in args.batches.split(',')]
+    done = load_done_cells(args.save_to)
+    cells = [(a, b) for a in agent_counts for b in batch_sizes if (a, b) not in done]
+    logging.info("Sweep: %d cells to run, %d already in %s", len(cells), len(done), args.save_to)
+
+    search = CapacitySearch(app_state, args.step_min, args.slo_p95_sec, args.slo_err_rate,
+                            steady_tol=args.steady_tol, step_max_min=args.step_max_min or args.step_min * 2,
+                            gen_lag_p99_sec=args.gen_lag_p99_sec, min_send_ratio=args.gen_send_ratio)
+    for n, (agents_count, batch_size) in enumerate(cells, 1):
+        if app_state.stopped:
+            break
+        logging.info("Cell %d/%d: agents=%d, batch=%d", n, len(cells), agents_count, batch_size)
+        started = time.monotonic()
+        if not await pool.resize(agents_count, args.connect_timeout):
+            logging.warning("Only %d/%d agents connected, cell skipped", app_state.agents_active, agents_count)
+            continue
+        config.batch_size = batch_size
+        app_state.batch_size = batch_size
+
+        if args.warmup_min > 0:
+            warmup_eps = args.target_eps * 0.5
+            await app_state.set_rate_limit_total(warmup_eps)
+            logging.info("Warm-up: setting total EPS to %.0f for %.1f min", warmup_eps, args.warmup_min)
+            await asyncio.sleep(args.warmup_min * 60)
+
+        result = await search.find(args.search, args.target_eps, args.step_inc, args.resolution, args.min_eps)
+        if app_state.stopped:
+            break
+        save_capacity_csv(args.save_to, agents_count, batch_size, result)
+        logging.info("Cell done in %.1f min: agents=%d, batch=%d, best sustainable %.0f EPS",
+                     (time.monotonic() - started) / 60, agents_count, batch_size, result.best_sustainable)
+
+    logging.info("Sweep complete. Stopping soon...")
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+async def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    config = AgentConfig(args.host, args.port, args.token, window=args.window, open_loop=args.open_loop,
+                         use_tls=not args.no_tls, spawn_rate=args.spawn_rate, handshake_limit=args.handshake_limit,
+                         tls_read_buffer=args.tls_read_buffer, transport=args.transport, payloads=load_corpus(args.payloads) if args.payloads else None)
+    app_state = AppState(0)
+    pool = AgentPool(config, app_state)
+    recorder = await start_metrics(args, app_state)
+
+    try:
+        await sweep(pool, config, app_state)
+    finally:
+        app_state.signalToStop()
+        await pool.close()
+        if recorder:
+            await recorder.stop()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
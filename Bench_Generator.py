@@ -0,0 +1,360 @@
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import time
+from agent_common import (TLS_READ_BUFFER, AgentConfig, AgentMessageHelper, AgentProtocol, AgentSocket, AppState,
+                          ConnectionRamp, sleep_until)
+from agent_payloads import DEFAULT_CORPUS, PayloadCorpus
+import TestServer
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmarks of the generator's own hot paths against a loopback TestServer")
+    p.add_argument('--suite', type=str, default='batch,send,read,tls,loop,memory') # benchmarks to run
+    p.add_argument('--batch-sizes', type=str, default='10,100,1000,3000,5000') # events per batch to sweep
+    p.add_argument('--agents', type=str, default='1,10,100') # agent counts to sweep in the loop benchmark
+    p.add_argument('--seconds', type=float, default=1.0) # time budget per micro measurement
+    p.add_argument('--loop-seconds', type=float, default=5.0) # time budget per AgentSocket loop cell
+    p.add_argument('--window', type=int, default=1) # batches in flight per agent in the loop benchmark
+    p.add_argument('--transports', type=str, default='stream,protocol') # agent transports in the loop benchmark
+    p.add_argument('--memory-agents', type=str, default='1000,5000') # idle fleet sizes in the memory benchmark
+    p.add_argument('--no-tls', action='store_true') # plaintext connections for send/loop benchmarks
+    p.add_argument('--save-baseline', type=str, default=None) # write results to this JSON file
+    p.add_argument('--baseline', type=str, default=None) # compare with this JSON file
+    p.add_argument('--threshold', type=float, default=0.10) # fail when a result is this much below the baseline
+    return p.parse_args()
+
+# -----------------------------
+# Helpers
+# -----------------------------
+def bench(fn, seconds: float) -> float:
+    # returns calls per second
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(10):
+            fn()
+        calls += 10
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - start)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class LoopbackServer:
+    # TestServer in its own process, so the server's CPU is not charged to the generator
+    def __init__(self, use_tls: bool) -> None:
+        self._use_tls = use_tls
+        self._cert_dir = tempfile.TemporaryDirectory()
+        self._process = None
+        self.port = free_port()
+
+    def __enter__(self) -> "LoopbackServer":
+        argv = ['--host', '127.0.0.1', '--port', str(self.port), '--stats-sec', '0']
+        if self._use_tls:
+            certfile, keyfile = TestServer.make_self_signed_cert(self._cert_dir.name)
+            argv += ['--certfile', certfile, '--keyfile', keyfile]
+        else:
+            argv += ['--no-tls']
+        ctx = multiprocessing.get_context("spawn")
+        self._process = ctx.Process(target=TestServer.run_server, args=(TestServer.parse_args(argv),), daemon=True)
+        self._process.start()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        raise Exception("Loopback server did not start")
+
+    def __exit__(self, *exc) -> None:
+        self._process.terminate()
+        self._process.join()
+        self._cert_dir.cleanup()
+
+# -----------------------------
+# Benchmarks, each returns {name: value}; higher is better, except LOWER_IS_BETTER
+# -----------------------------
+LOWER_IS_BETTER = ("agent_rss_bytes", "agent_loop_cpu_us")
+
+def bench_batch(batch_sizes: list[int], seconds: float) -> dict:
+    # string path (make_events_batch + encode + prefix, as send_message does) vs cached bytes frame,
+    # and the frame with events from the default payload corpus
+    results = {}
+    confirmation_id = 1
+    corpus = PayloadCorpus(DEFAULT_CORPUS, seed=1)
+
+    def str_path(size: int):
+        msg_bytes = AgentMessageHelper.make_events_batch(size, confirmation_id).encode()
+        return len(msg_bytes).to_bytes(4, byteorder="big") + msg_bytes
+
+    def frame_path(size: int):
+        return AgentMessageHelper.make_events_batch_frame(size, confirmation_id)
+
+    for size in batch_sizes:
+        # both paths must produce the same message on the wire (retry if ts ticked in between)
+        assert any(str_path(size) == b"".join(frame_path(size)) for _ in range(2)), f"frame mismatch for batch={size}"
+        results[f"make_events_batch[b={size}]"] = bench(lambda: str_path(size), seconds)
+        results[f"make_events_batch_frame[b={size}]"] = bench(lambda: frame_path(size), seconds)
+        results[f"payload_corpus_frame[b={size}]"] = bench(
+            lambda: corpus.make_events_batch_frame(size, confirmation_id), seconds)
+    return results
+
+def bench_read(seconds: float) -> dict:
+    # read_message over an in-memory StreamReader full of confirm frames
+    confirm = b'{"m":"confirm","id":"12345","data":{"priority":0}}'
+    frame = len(confirm).to_bytes(4, byteorder="big") + confirm
+    chunk = frame * 1000
+
+    async def run() -> float:
+        reader = asyncio.StreamReader(limit=2 ** 24)
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            reader.feed_data(chunk)
+            for _ in range(1000):
+                await AgentMessageHelper.read_message(reader)
+            count += 1000
+        return count / (time.perf_counter() - start)
+
+    async def run_protocol() -> float:
+        # the same frames through AgentProtocol's receive buffer, as a transport would feed them
+        class Sink:
+            def _on_confirm(self, confirmation_id):
+                pass
+
+        protocol = AgentProtocol(Sink())
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            pos = 0
+            while pos < len(chunk):
+                buf = protocol.get_buffer(-1)
+                n = min(len(buf), len(chunk) - pos)
+                buf[:n] = chunk[pos:pos + n]
+                protocol.buffer_updated(n)
+                pos += n
+            count += 1000
+        return count / (time.perf_counter() - start)
+
+    return {"read_message": asyncio.run(run()), "read_protocol": asyncio.run(run_protocol())}
+
+def bench_tls(batch_sizes: list[int], seconds: float, certfile: str, keyfile: str) -> dict:
+    # TLS record framing cost of one batch, in memory (no sockets): client SSLObject write + BIO read
+    results = {}
+    client_ctx = AgentConfig('127.0.0.1', 0, '').ssl_context
+    server_ctx = TestServer.make_ssl_context(certfile, keyfile)
+    c_in, c_out, s_in, s_out = ssl.MemoryBIO(), ssl.MemoryBIO(), ssl.MemoryBIO(), ssl.MemoryBIO()
+    client = client_ctx.wrap_bio(c_in, c_out)
+    server = server_ctx.wrap_bio(s_in, s_out, server_side=True)
+    for _ in range(10):  # handshake by shuttling bytes between the BIOs
+        for obj in (client, server):
+            try:
+                obj.do_handshake()
+            except ssl.SSLWantReadError:
+                pass
+        s_in.write(c_out.read())
+        c_in.write(s_out.read())
+
+    for size in batch_sizes:
+        frame = b"".join(AgentMessageHelper.make_events_batch_frame(size, 1))
+
+        def encrypt():
+            client.write(frame)
+            c_out.read()
+
+        results[f"tls_write[b={size}]"] = bench(encrypt, seconds)
+    return results
+
+def bench_send(batch_sizes: list[int], seconds: float, port: int, use_tls: bool) -> dict:
+    # send_frame throughput on one connection; confirms are read and dropped by a side task
+    async def run(size: int) -> float:
+        config = AgentConfig('127.0.0.1', port, '', use_tls=use_tls)
+        reader, writer = await asyncio.open_connection(config.host, config.port, ssl=config.ssl_context)
+        await AgentMessageHelper.send_message(writer, AgentMessageHelper.make_id_msg("Bench", "Bench", ""))
+        await AgentMessageHelper.read_message(reader)
+
+        async def drop_confirms():
+            while True:
+                await AgentMessageHelper.read_message(reader)
+
+        drop_task = asyncio.create_task(drop_confirms())
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for _ in range(10):
+                count += 1
+                await AgentMessageHelper.send_frame(writer, AgentMessageHelper.make_events_batch_frame(size, count))
+        rate = count / (time.perf_counter() - start)
+        drop_task.cancel()
+        writer.close()
+        return rate
+
+    return {f"send_frame_eps[b={size}]": asyncio.run(run(size)) * size for size in batch_sizes}
+
+def bench_loop(batch_sizes: list[int], agent_counts: list[int], seconds: float, window: int,
+               port: int, use_tls: bool, transports: list[str]) -> dict:
+    # full AgentSocket loop, no rate limit: confirmed events/sec per (agents, batch) cell,
+    # and the generator's CPU time per confirmed batch
+    async def run(agents_count: int, size: int, transport: str) -> tuple[float, float]:
+        config = AgentConfig('127.0.0.1', port, '', size, window=window, use_tls=use_tls, transport=transport)
+        app_state = AppState(agents_count, size)
+        agents = [AgentSocket(config, app_state) for _ in range(agents_count)]
+        agent_tasks = [asyncio.create_task(agent.start()) for agent in agents]
+        await app_state.wait_ready()
+        await app_state.set_rate_limit_total(0, settle_sec=2.0)  # agents start sending within 1 sec
+        cpu_start = time.process_time()
+        await sleep_until(app_state.window_started + seconds)
+        elapsed = app_state.window_elapsed()
+        _, _, confirms, errors = app_state.snapshot_and_reset_window()
+        cpu = time.process_time() - cpu_start
+
+        app_state.signalToStop()
+        await asyncio.gather(*[agent.disconnect() for agent in agents])
+        await asyncio.gather(*agent_tasks, return_exceptions=True)
+        if errors:
+            logging.warning("Loop agents=%d batch=%d: %d errors", agents_count, size, errors)
+        return confirms * size / elapsed, cpu * 1_000_000 / max(1, confirms)
+
+    results = {}
+    for transport in transports:
+        suffix = "" if transport == "stream" else f",{transport}"
+        for agents_count in agent_counts:
+            for size in batch_sizes:
+                eps, cpu_us = asyncio.run(run(agents_count, size, transport))
+                results[f"agent_loop_eps[a={agents_count},b={size}{suffix}]"] = eps
+                results[f"agent_loop_cpu_us[a={agents_count},b={size}{suffix}]"] = cpu_us
+    return results
+
+def rss_bytes() -> int:
+    # current resident set size (Linux /proc)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def memory_cell(agents_count: int, port: int, use_tls: bool) -> float:
+    # an idle fleet: every agent connected and approved, traffic started at a rate that never sends;
+    # runs in a fresh process, so memory freed by the other benchmarks doesn't hide the agents' share
+    async def run() -> float:
+        config = AgentConfig('127.0.0.1', port, '', 1, open_loop=True, use_tls=use_tls, handshake_limit=200,
+                             tls_read_buffer=TLS_READ_BUFFER)
+        app_state = AppState(agents_count, 1)
+        await app_state.set_rate_limit_total(1e-9, reset_window=False)
+        agents = [AgentSocket(config, app_state) for _ in range(agents_count)]
+        gc.collect()
+        before = rss_bytes()
+        ramp = ConnectionRamp(config, app_state)
+        ramp.start(agents)
+        deadline = time.monotonic() + 120
+        while app_state.agents_approved < agents_count and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(1.5)  # agents past the start stagger, waiting for their first send
+        gc.collect()
+        used = rss_bytes() - before
+        connected = app_state.agents_active
+
+        app_state.signalToStop()
+        await asyncio.gather(*[agent.disconnect() for agent in agents])
+        await ramp.join()
+        if connected < agents_count:
+            logging.warning("Memory agents=%d: only %d connected", agents_count, connected)
+        return used / max(1, connected)
+
+    return asyncio.run(run())
+
+def bench_memory(agent_counts: list[int], port: int, use_tls: bool) -> dict:
+    # RSS per connected idle agent (bytes, lower is better): agent state, streams, tasks and TLS objects
+    if not os.path.exists('/proc/self/statm'):
+        logging.warning("Memory benchmark needs /proc (Linux), skipped")
+        return {}
+    results = {}
+    ctx = multiprocessing.get_context("spawn")
+    for agents_count in agent_counts:
+        with ctx.Pool(1) as pool:
+            results[f"agent_rss_bytes[a={agents_count}]"] = pool.apply(memory_cell, (agents_count, port, use_tls))
+    return results
+
+# -----------------------------
+# Baseline
+# -----------------------------
+def compare_baseline(results: dict, baseline_file: str, threshold: float) -> bool:
+    with open(baseline_file) as f:
+        baseline = json.load(f)["results"]
+    ok = True
+    print(f"\n{'Benchmark':<40} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name:<40} {'-':>12} {value:>12.0f}")
+            continue
+        change = value / base - 1.0
+        regressed = change > threshold if name.startswith(LOWER_IS_BETTER) else change < -threshold
+        ok = ok and not regressed
+        print(f"{name:<40} {base:>12.0f} {value:>12.0f} {change:>+7.1%}{'  REGRESSION' if regressed else ''}")
+    return ok
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    suite = set(args.suite.split(','))
+    batch_sizes = [int(x) for x in args.batch_sizes.split(',')]
+    agent_counts = [int(x) for x in args.agents.split(',')]
+    use_tls = not args.no_tls
+
+    results = {}
+    if 'batch' in suite:
+        results.update(bench_batch(batch_sizes, args.seconds))
+    if 'read' in suite:
+        results.update(bench_read(args.seconds))
+    if 'tls' in suite:
+        with tempfile.TemporaryDirectory() as cert_dir:
+            certfile, keyfile = TestServer.make_self_signed_cert(cert_dir)
+            results.update(bench_tls(batch_sizes, args.seconds, certfile, keyfile))
+    if 'memory' in suite:
+        try:
+            import resource  # a big idle fleet needs more descriptors; server and cells inherit the limit
+            _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ImportError, ValueError, OSError):
+            pass
+    if suite & {'send', 'loop', 'memory'}:
+        with LoopbackServer(use_tls) as server:
+            if 'send' in suite:
+                results.update(bench_send(batch_sizes, args.seconds, server.port, use_tls))
+            if 'loop' in suite:
+                results.update(bench_loop(batch_sizes, agent_counts, args.loop_seconds, args.window,
+                                          server.port, use_tls, args.transports.split(',')))
+            if 'memory' in suite:
+                results.update(bench_memory([int(x) for x in args.memory_agents.split(',')], server.port, use_tls))
+
+    print(f"{'Benchmark':<40} {'ops/sec|B':>12}")
+    for name, value in results.items():
+        print(f"{name:<40} {value:>12.0f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({"python": sys.version.split()[0], "tls": use_tls, "window": args.window,
+                       "results": results}, f, indent=2)
+    if args.baseline and not compare_baseline(results, args.baseline, args.threshold):
+        print(f"\nGenerator regressed by more than {args.threshold:.0%} against {args.baseline}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import random
+import socket
+from collections import deque
+from typing import Optional
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="TCP relay between the generator and the server with WAN-like impairments")
+    p.add_argument('--host', type=str, default='0.0.0.0')
+    p.add_argument('--port', type=int, default=9444) # point the generator here (--port 9444)
+    p.add_argument('--target-host', type=str, default='127.0.0.1') # the server
+    p.add_argument('--target-port', type=int, default=8444)
+    p.add_argument('--processes', type=int, default=1) # relay processes sharing the port (SO_REUSEPORT)
+    p.add_argument('--rtt-ms', type=float, default=0.0) # added round trip time, half of it each direction
+    p.add_argument('--jitter-ms', type=float, default=0.0) # extra random 0..N ms per chunk and direction (order is kept)
+    p.add_argument('--bandwidth-kbps', type=float, default=0.0) # per connection and direction, kbit/s (0 = no cap)
+    p.add_argument('--batch-ms', type=float, default=0.0) # hold data and release it on N ms ticks (0 = no batching)
+    p.add_argument('--queue-kb', type=int, default=1024) # held per direction before the sender is paused
+    p.add_argument('--stats-sec', type=float, default=5.0) # print stats every N sec
+    return p.parse_args(argv)
+
+# -----------------------------
+# Impairments
+# -----------------------------
+class Impairment:
+    # what the link does to every chunk of one direction of a connection
+    def __init__(self, rtt_ms: float = 0.0, jitter_ms: float = 0.0, bandwidth_kbps: float = 0.0,
+                 batch_ms: float = 0.0) -> None:
+        self.delay = rtt_ms / 2000
+        self.jitter = jitter_ms / 1000
+        self.bytes_per_sec = bandwidth_kbps * 1000 / 8
+        self.batch = batch_ms / 1000
+
+    @property
+    def none(self) -> bool:
+        return not (self.delay or self.jitter or self.bytes_per_sec or self.batch)
+
+    def __str__(self) -> str:
+        return "rtt=%.1fms, jitter=%.1fms, bandwidth=%s, batch=%.1fms" % (
+            self.delay * 2000, self.jitter * 1000,
+            "%.0fkbit/s" % (self.bytes_per_sec * 8 / 1000) if self.bytes_per_sec else "no cap", self.batch * 1000)
+
+class RelayStats:
+    def __init__(self) -> None:
+        self.connections = 0
+        self.bytes_up = 0  # generator -> server
+        self.bytes_down = 0
+        self.connect_errors = 0
+
+# -----------------------------
+# Relay
+# -----------------------------
+class Pipe:
+    # One direction of a relayed connection: the bytes objects read from one socket are written to the
+    # other as they are, never joined or sliced. Without impairments they go straight through; otherwise
+    # each waits in order for its release time, with one timer for the head of the queue.
+    __slots__ = ("_proxy", "_source", "_upstream", "_loop", "_queue", "_queued", "_timer",
+                 "_last_release", "_link_free", "_queue_full", "_sink_full", "_reading_paused", "_closing")
+
+    def __init__(self, proxy: "NetProxy", source: "RelaySide", upstream: bool) -> None:
+        self._proxy = proxy
+        self._source = source
+        self._upstream = upstream
+        self._loop = asyncio.get_running_loop()
+        self._queue: deque[tuple[float, bytes]] = deque()
+        self._queued = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._last_release = 0.0
+        self._link_free = 0.0  # bandwidth cap: the link is busy sending earlier chunks until then
+        self._queue_full = False
+        self._sink_full = False
+        self._reading_paused = False
+        self._closing = False
+
+    @property
+    def _sink(self) -> Optional[asyncio.Transport]:
+        peer = self._source.peer
+        return peer.transport if peer is not None else None
+
+    def push(self, data: bytes) -> None:
+        stats = self._proxy.stats
+        if self._upstream:
+            stats.bytes_up += len(data)
+        else:
+            stats.bytes_down += len(data)
+        impairment = self._proxy.impairment  # read per chunk, so it can be changed on live connections
+        sink = self._sink
+        if impairment.none and not self._queue and sink is not None:
+            sink.write(data)
+            return
+
+        now = self._loop.time()
+        release = now
+        if impairment.bytes_per_sec:
+            self._link_free = max(now, self._link_free) + len(data) / impairment.bytes_per_sec
+            release = self._link_free
+        release += impairment.delay
+        if impairment.jitter:
+            release += random.uniform(0, impairment.jitter)
+        if impairment.batch:
+            release = math.ceil(release / impairment.batch) * impairment.batch
+        release = max(release, self._last_release)  # a TCP stream is never reordered
+        self._last_release = release
+
+        self._queue.append((release, data))
+        self._queued += len(data)
+        if self._queued >= self._proxy.queue_limit and not self._queue_full:
+            self._queue_full = True
+            self._update_reading()
+        if self._timer is None:
+            self._timer = self._loop.call_at(self._queue[0][0], self.flush)
+
+    def flush(self) -> None:
+        self._timer = None
+        sink = self._sink
+        if sink is None:
+            return  # the server side is still connecting
+        queue = self._queue
+        if sink.is_closing():
+            queue.clear()
+            self._queued = 0
+        now = self._loop.time()
+        due = []
+        while queue and queue[0][0] <= now:
+            data = queue.popleft()[1]
+            self._queued -= len(data)
+            due.append(data)
+        if due:
+            sink.writelines(due)
+        if queue:
+            self._timer = self._loop.call_at(queue[0][0], self.flush)
+        elif self._closing:
+            sink.close()
+        if self._queue_full and self._queued < self._proxy.queue_limit // 2:
+            self._queue_full = False
+            self._update_reading()
+
+    def set_sink_full(self, full: bool) -> None:
+        # the other socket can't take more: stop reading this one until it can
+        self._sink_full = full
+        self._update_reading()
+
+    def close_when_drained(self) -> None:
+        self._closing = True
+        if self._timer is None:
+            self.flush()
+
+    def _update_reading(self) -> None:
+        paused = self._queue_full or self._sink_full
+        transport = self._source.transport
+        if paused == self._reading_paused or transport is None or transport.is_closing():
+            return
+        self._reading_paused = paused
+        if paused:
+            transport.pause_reading()
+        else:
+            transport.resume_reading()
+
+class RelaySide(asyncio.Protocol):
+    # One socket of a relayed connection. The generator side connects the server side when accepted;
+    # until it is connected the generator's bytes wait in the pipe.
+    def __init__(self, proxy: "NetProxy", peer: Optional["RelaySide"] = None) -> None:
+        self._proxy = proxy
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer = peer
+        self.pipe = Pipe(proxy, self, upstream=peer is None)  # what this side reads, on its way to the peer
+        self._connect_task: Optional[asyncio.Task] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        if self.peer is None:
+            self._proxy.stats.connections += 1
+            self._connect_task = asyncio.create_task(self._connect_server())
+        else:
+            self.peer.peer = self
+            self.peer.pipe.flush()  # what the generator sent while this side was connecting
+
+    async def _connect_server(self) -> None:
+        proxy = self._proxy
+        try:
+            await asyncio.get_running_loop().create_connection(
+                lambda: RelaySide(proxy, self), proxy.target_host, proxy.target_port)
+        except OSError as ex:
+            proxy.stats.connect_errors += 1
+            logging.warning("Can't connect to %s:%d: %s", proxy.target_host, proxy.target_port, ex)
+            self.transport.close()
+
+    def data_received(self, data: bytes) -> None:
+        self.pipe.push(data)
+
+    def eof_received(self) -> bool:
+        self.pipe.close_when_drained()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.pipe.close_when_drained()
+        if self._connect_task is not None:
+            self._proxy.stats.connections -= 1
+            self._connect_task.cancel()
+
+    def pause_writing(self) -> None:
+        if self.peer is not None:
+            self.peer.pipe.set_sink_full(True)
+
+    def resume_writing(self) -> None:
+        if self.peer is not None:
+            self.peer.pipe.set_sink_full(False)
+
+class NetProxy:
+    def __init__(self, args) -> None:
+        self._args = args
+        self.target_host = args.target_host
+        self.target_port = args.target_port
+        self.impairment = Impairment(args.rtt_ms, args.jitter_ms, args.bandwidth_kbps, args.batch_ms)
+        self.queue_limit = args.queue_kb * 1024
+        self.stats = RelayStats()
+
+    async def start(self) -> asyncio.AbstractServer:
+        # port 0 picks a free port, see server.sockets
+        return await asyncio.get_running_loop().create_server(
+            lambda: RelaySide(self), self._args.host, self._args.port,
+            reuse_port=self._args.processes > 1, backlog=4096)
+
+    async def serve(self) -> None:
+        server = await self.start()
+        stats_task = asyncio.create_task(self._print_stats())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            stats_task.cancel()
+
+    async def _print_stats(self) -> None:
+        if self._args.stats_sec <= 0:
+            return
+        stats = self.stats
+        last_up, last_down = 0, 0
+        while True:
+            await asyncio.sleep(self._args.stats_sec)
+            up, down = stats.bytes_up, stats.bytes_down
+            logging.info("Connections: %d, up MB/s: %.2f, down MB/s: %.2f, connect errors: %d",
+                         stats.connections, (up - last_up) / self._args.stats_sec / 1e6,
+                         (down - last_down) / self._args.stats_sec / 1e6, stats.connect_errors)
+            last_up, last_down = up, down
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+def run_proxy(args) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+    try:
+        asyncio.run(NetProxy(args).serve())
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+
+    if args.processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        logging.warning("SO_REUSEPORT is not supported on this OS, running a single process")
+        args.processes = 1
+
+    logging.info("Relaying %s:%d -> %s:%d, %s, %d process(es)", args.host, args.port, args.target_host,
+                 args.target_port, Impairment(args.rtt_ms, args.jitter_ms, args.bandwidth_kbps, args.batch_ms),
+                 args.processes)
+    if args.processes == 1:
+        run_proxy(args)
+        return
+
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=run_proxy, args=(args,), name=f"Proxy-{i}", daemon=True)
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+if __name__ == "__main__":
+    main()
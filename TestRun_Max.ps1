@@ -22,7 +22,7 @@ function Run_LoadTest {
     Write-Host "Run_LoadTest -Agents $Agents -EventBatch $EventBatch -Eps $Eps" -ForegroundColor Magenta
 
     python Agent_MaxLoad.py --agents $Agents --event-batch $EventBatch --target-eps $Eps `
-        --save-to results_maxBe_r.csv --warmup-min $WarmupMin --step-min 0.5 --step-inc 0.1 --slo-p95-sec 30.0 `
+        --save-to results_maxBe_r.csv --warmup-min $WarmupMin --step-min 0.5 --search step --step-inc 0.1 --slo-p95-sec 30.0 `
         --token MG2LIICYMYF4ANGRNUSQXWYAZTSK67DHSBFDRCZWEBQZEB6RUJKQ
     if ($LASTEXITCODE -ne 0) { Write-Host "Python script failed"; exit 1 }
 }
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import random
+import socket
+import ssl
+import subprocess
+import tempfile
+import time
+from typing import Callable, Optional
+
+# -----------------------------
+# Configuration and defaults
+# -----------------------------
+import argparse
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Python stand-in for BeServer: same length-prefixed agent protocol")
+    p.add_argument('--host', type=str, default='0.0.0.0')
+    p.add_argument('--port', type=int, default=8444)
+    p.add_argument('--processes', type=int, default=1) # server processes sharing the port (SO_REUSEPORT)
+    p.add_argument('--no-tls', action='store_true') # plaintext instead of TLS
+    p.add_argument('--certfile', type=str, default=None) # PEM cert; self-signed one is generated when not set
+    p.add_argument('--keyfile', type=str, default=None)
+    p.add_argument('--service', type=str, default='const:0') # time per batch, sec: const:S, uniform:A,B, exp:MEAN, lognorm:MEDIAN,SIGMA
+    p.add_argument('--per-event-us', type=float, default=0.0) # extra service time per event in batch, microseconds
+    p.add_argument('--policy', action='store_true') # send a policy message after auth, as the real server does
+    p.add_argument('--ping-sec', type=float, default=0.0) # send ping every N sec (0 = never)
+    p.add_argument('--drop-rate', type=float, default=0.0) # fraction of batches never confirmed
+    p.add_argument('--disconnect-rate', type=float, default=0.0) # fraction of batches that close the connection
+    p.add_argument('--auth-reject-rate', type=float, default=0.0) # fraction of agents not approved
+    p.add_argument('--stats-sec', type=float, default=5.0) # print stats every N sec
+    return p.parse_args(argv)
+
+# -----------------------------
+# Messages (see BeServer/MsgStorage.cs)
+# -----------------------------
+class MsgStorage:
+    AUTH_CONFIRM = b'{"m":"status","subsystem":"auth","error":0,"status":"approved","client_token":"ZEOKPFPFEVYSSBGRFFP5AS2QDV65J5KU73YGGNF2OV5REYDWSSDA"}'
+    AUTH_REJECT = b'{"m":"status","subsystem":"auth","error":1,"status":"rejected"}'
+    POLICY = b'{"m":"policy","id":0,"ts":%d,"folders":{"extra_folders":"remove_from_client","items":[],"preferences":{}},"scripts":{},"schedule":[],"licensed":true,"storages":[],"filePolicies":{},"tags":[{"name":"VIRTUAL","value":"true","modified":%d}]}'
+    CONFIRM = b'{"m":"confirm","id":"%b","data":{"priority":0}}'
+    PING = b'{"m":"ping","ts":%d}'
+
+    @staticmethod
+    def confirm(batch: bytes) -> bytes:
+        # echo the batch confirmId: ...,"confirmId":"123"}
+        pos = batch.rfind(b'"confirmId":"')
+        if pos < 0:
+            return MsgStorage.CONFIRM % b"0"
+        start = pos + 13
+        return MsgStorage.CONFIRM % batch[start:batch.index(b'"', start)]
+
+    @staticmethod
+    def policy() -> bytes:
+        ts = int(time.time())
+        return MsgStorage.POLICY % (ts, ts)
+
+    @staticmethod
+    def ping() -> bytes:
+        return MsgStorage.PING % int(time.time())
+
+def make_service_time(spec: str) -> Callable[[], float]:
+    kind, _, params = spec.partition(':')
+    values = [float(x) for x in params.split(',') if x]
+    if kind == 'const':
+        value = values[0] if values else 0.0
+        return lambda: value
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1.0 / values[0])
+    if kind == 'lognorm':
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Unknown service time distribution: {spec}")
+
+# -----------------------------
+# Server
+# -----------------------------
+class ServerStats:
+    def __init__(self) -> None:
+        self.connections = 0
+        self.batches = 0
+        self.events = 0
+        self.errors = 0
+
+class AgentServer:
+    def __init__(self, args, ssl_ctx: Optional[ssl.SSLContext]) -> None:
+        self._args = args
+        self._ssl_ctx = ssl_ctx
+        self._service_time = make_service_time(args.service)
+        self._stats = ServerStats()
+
+    @property
+    def stats(self) -> ServerStats:
+        return self._stats
+
+    async def start(self) -> asyncio.AbstractServer:
+        # port 0 picks a free port, see server.sockets
+        return await asyncio.start_server(
+            self._handle_client, self._args.host, self._args.port, ssl=self._ssl_ctx,
+            reuse_port=self._args.processes > 1, backlog=4096)
+
+    async def serve(self) -> None:
+        server = await self.start()
+        stats_task = asyncio.create_task(self._print_stats())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            stats_task.cancel()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        args = self._args
+        stats = self._stats
+        stats.connections += 1
+        ping_task = None
+        try:
+            # First message: id
+            await self._read_frame(reader)
+            if args.auth_reject_rate > 0 and random.random() < args.auth_reject_rate:
+                self._write_frame(writer, MsgStorage.AUTH_REJECT)
+                await writer.drain()
+                return
+            self._write_frame(writer, MsgStorage.AUTH_CONFIRM)
+            if args.policy:
+                self._write_frame(writer, MsgStorage.policy())
+            if args.ping_sec > 0:
+                ping_task = asyncio.create_task(self._ping(writer))
+
+            # Next: respond to each batch with confirm
+            while True:
+                batch = await self._read_frame(reader)
+                stats.batches += 1
+                events = batch.count(b'"eid":')
+                stats.events += events
+
+                delay = self._service_time() + events * args.per_event_us / 1_000_000
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if writer.is_closing():
+                    return  # agent is gone while the batch was in service
+                if args.disconnect_rate > 0 and random.random() < args.disconnect_rate:
+                    stats.errors += 1
+                    return
+                if args.drop_rate > 0 and random.random() < args.drop_rate:
+                    stats.errors += 1
+                    continue
+                self._write_frame(writer, MsgStorage.confirm(batch))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            if ping_task:
+                ping_task.cancel()
+            stats.connections -= 1
+            writer.close()
+
+    async def _ping(self, writer: asyncio.StreamWriter) -> None:
+        while not writer.is_closing():
+            await asyncio.sleep(self._args.ping_sec)
+            self._write_frame(writer, MsgStorage.ping())
+
+    @staticmethod
+    async def _read_frame(reader: asyncio.StreamReader) -> bytes:
+        size = int.from_bytes(await reader.readexactly(4), byteorder="big")
+        return await reader.readexactly(size)
+
+    @staticmethod
+    def _write_frame(writer: asyncio.StreamWriter, msg: bytes) -> None:
+        writer.writelines((len(msg).to_bytes(4, byteorder="big"), msg))
+
+    async def _print_stats(self) -> None:
+        if self._args.stats_sec <= 0:
+            return
+        stats = self._stats
+        last_batches, last_events = 0, 0
+        while True:
+            await asyncio.sleep(self._args.stats_sec)
+            batches, events = stats.batches, stats.events
+            logging.info("Connected: %d, batches/sec: %.0f, events/sec: %.0f, errors: %d",
+                         stats.connections, (batches - last_batches) / self._args.stats_sec,
+                         (events - last_events) / self._args.stats_sec, stats.errors)
+            last_batches, last_events = batches, events
+
+# -----------------------------
+# TLS
+# -----------------------------
+def make_self_signed_cert(directory: str) -> tuple[str, str]:
+    # same idea as BeServer/Certificate.cs, via the openssl command line
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "30",
+                    "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+def make_ssl_context(certfile: str, keyfile: str) -> ssl.SSLContext:
+    ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_ctx.load_cert_chain(certfile, keyfile)
+    return ssl_ctx
+
+# -----------------------------
+# Entrypoint
+# -----------------------------
+def run_server(args) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+    ssl_ctx = None if args.no_tls else make_ssl_context(args.certfile, args.keyfile)
+    try:
+        asyncio.run(AgentServer(args, ssl_ctx).serve())
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+
+    with tempfile.TemporaryDirectory() as cert_dir:
+        if not args.no_tls and not args.certfile:
+            args.certfile, args.keyfile = make_self_signed_cert(cert_dir)
+
+        if args.processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            logging.warning("SO_REUSEPORT is not supported on this OS, running a single process")
+            args.processes = 1
+
+        logging.info("Listening on %s:%d (%s), %d process(es), service=%s",
+                     args.host, args.port, "plain" if args.no_tls else "TLS", args.processes, args.service)
+        if args.processes == 1:
+            run_server(args)
+            return
+
+        ctx = multiprocessing.get_context("spawn")
+        processes = [ctx.Process(target=run_server, args=(args,), name=f"Server-{i}", daemon=True)
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+
+if __name__ == "__main__":
+    main()
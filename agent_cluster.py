@@ -0,0 +1,166 @@
+import asyncio
+import ipaddress
+import logging
+import multiprocessing
+import socket
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Optional
+from agent_common import AgentConfig
+from agent_trace import TraceRecorder
+from agent_workers import ShardedAppState, worker_main
+
+# -----------------------------
+# Generator cluster
+# -----------------------------
+# One scenario on several generator hosts: the coordinator (any scenario script with --nodes N) runs the
+# controller and waits for N node processes (Agent_Node.py) to connect over TCP. Each node is an agent worker
+# as in agent_workers.py, with a multiprocessing Connection over TCP instead of a pipe: the same messages,
+# authenticated with --cluster-key before anything is unpickled. The coordinator hands out agent shares by
+# node weight, splits every rate change by share and has it applied at one time on all nodes (their clock
+# offsets are measured at connect), and merges their latency histograms and counters into its step windows.
+# Coordinator -> node before the run: ("time",) -> ("time", node time.time()), then
+#   ("start", config, agents, share, push_interval, fleet, trace); the worker messages follow.
+# Node -> coordinator on connect: ("hello", name, weight)
+# Messages are pickles, so the key is all that stands between the network and code run on either side: the
+# coordinator listens on loopback by default, and the default key is refused on any other address.
+DEFAULT_CLUSTER_PORT = 7444
+DEFAULT_CLUSTER_KEY = 'loadtest'
+
+def cluster_key(key: str) -> bytes:
+    return key.encode()
+
+def is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback if host else False
+    except (OSError, ValueError):
+        return False
+
+def check_cluster_key(host: str, key: str) -> None:
+    # the default (public) key is only good for a coordinator and nodes on one host
+    if (not key or key == DEFAULT_CLUSTER_KEY) and not is_loopback(host):
+        raise ValueError(f"{host or '0.0.0.0'} is not a loopback address: set your own --cluster-key "
+                         f"on the coordinator and its nodes, the default one is public")
+
+class ClusterAppState(ShardedAppState):
+    START_LEAD = 0.25  # rate changes are sent this long before they apply, more than a one-way trip
+    CLOCK_PROBES = 8
+
+    def __init__(self, agents_count: int, batch_size: int, config: AgentConfig, nodes: int,
+                 address: tuple[str, int], key: str, ready_fraction: float = 1.0, push_interval: float = 0.5,
+                 fleet_spec: Optional[dict] = None, trace: Optional[TraceRecorder] = None) -> None:
+        check_cluster_key(address[0], key)
+        super().__init__(agents_count, batch_size, config, nodes, ready_fraction, push_interval, fleet_spec, trace)
+        self._nodes_count = nodes
+        self._address = address
+        self._key = cluster_key(key)
+        self._clock_offsets: list[float] = []  # node clock minus coordinator clock, sec
+
+    async def start_workers(self) -> None:
+        listener = Listener(self._address, authkey=self._key)
+        logging.info("Waiting for %d generator nodes on %s:%d", self._nodes_count, *self._address)
+        nodes = []
+        try:
+            while len(nodes) < self._nodes_count:
+                try:
+                    conn = await asyncio.to_thread(listener.accept)
+                    name, weight = await asyncio.to_thread(self._handshake, conn)
+                except (OSError, EOFError, multiprocessing.AuthenticationError) as ex:
+                    logging.warning("Node refused: %s", ex)
+                    continue
+                nodes.append((conn, name, weight))
+        finally:
+            listener.close()
+
+        # shares in proportion to node weights, by largest remainder
+        weights = [weight for _, _, weight in nodes]
+        exact = [self._agents_count * weight / sum(weights) for weight in weights]
+        self._shares = [int(share) for share in exact]
+        by_remainder = sorted(range(len(exact)), key=lambda i: self._shares[i] - exact[i])
+        for i in by_remainder[:self._agents_count - sum(self._shares)]:
+            self._shares[i] += 1
+
+        offset = 0
+        for i, (conn, name, _) in enumerate(nodes):
+            share = self._shares[i]
+            self._offsets.append(offset)
+            fleet = (self._fleet_spec, self._agents_count, offset) if self._fleet_spec else None
+            trace = (self.trace.started + self._clock_offsets[i], offset) if self.trace is not None else None
+            offset += share
+            conn.send(("start", self._config, share, share / self._agents_count, self._push_interval, fleet, trace))
+            self._conns.append(conn)
+            self._readers.append(asyncio.create_task(self._read_worker(i, conn)))
+        logging.info("Started %d generator nodes, agents per node: %s",
+                     len(nodes), ", ".join(f"{name}={share}" for (_, name, _), share in zip(nodes, self._shares)))
+
+    def _handshake(self, conn: Connection) -> tuple[str, float]:
+        # blocking, in a thread: hello, then the node's clock offset from the probe with the shortest round trip
+        msg = conn.recv()
+        if msg[0] != "hello":
+            raise OSError(f"Unexpected message from node: {msg[0]!r}")
+        _, name, weight = msg
+        best_rtt, offset = float('inf'), 0.0
+        for _ in range(self.CLOCK_PROBES):
+            sent = time.time()
+            conn.send(("time",))
+            node_time = conn.recv()[1]
+            received = time.time()
+            if received - sent < best_rtt:
+                best_rtt, offset = received - sent, node_time - (sent + received) / 2
+        self._clock_offsets.append(offset)
+        logging.info("Node %s connected (%d/%d), weight %g, clock offset %+.1f ms, rtt %.1f ms", name,
+                     len(self._clock_offsets), self._nodes_count, weight, offset * 1000, best_rtt * 1000)
+        return name, float(weight)
+
+    def _start_at(self) -> Optional[float]:
+        return time.time() + self.START_LEAD
+
+    def _worker_time(self, index: int, at: float) -> float:
+        return at + self._clock_offsets[index]
+
+    async def join_workers(self, timeout: float = 30.0) -> None:
+        await super().join_workers(timeout)
+        for conn in self._conns:
+            conn.close()
+
+# -----------------------------
+# Node
+# -----------------------------
+def run_node(address: tuple[str, int], key: str, weight: float = 1.0, name: Optional[str] = None,
+             once: bool = False, retry_sec: float = 1.0) -> None:
+    # connects to the coordinator (again and again until it is up) and runs its agents for one run;
+    # then waits for the next run, unless once
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+    try:
+        check_cluster_key(address[0], key)  # a rogue coordinator knowing the key could run code here
+    except ValueError as ex:
+        logging.error("%s", ex)
+        return
+    name = name or f"{socket.gethostname()}/{multiprocessing.current_process().name}"
+    while True:
+        try:
+            conn = Client(address, authkey=cluster_key(key))
+        except (OSError, EOFError):
+            time.sleep(retry_sec)
+            continue
+        except multiprocessing.AuthenticationError as ex:
+            logging.error("Coordinator %s:%d refused the key: %s", *address, ex)
+            return
+        logging.info("Connected to coordinator %s:%d", *address)
+        try:
+            conn.send(("hello", name, weight))
+            msg = conn.recv()
+            while msg[0] == "time":
+                conn.send(("time", time.time()))
+                msg = conn.recv()
+        except (OSError, EOFError) as ex:
+            logging.warning("Coordinator gone before the run started: %s", ex)
+            conn.close()
+            continue
+        # ("start", config, agents, share, push_interval, fleet, trace)
+        logging.info("Run: %d agents", msg[2])
+        worker_main(conn, *msg[1:])
+        logging.info("Run done")
+        if once:
+            return
+        time.sleep(retry_sec)  # the coordinator closes its listener before the next run opens one
@@ -1,36 +1,453 @@
 import asyncio
-import collections
+import asyncio.sslproto
+import array
 import ssl
 import socket
 import secrets
 import datetime
+import heapq
+import math
+import random
 import logging
 import os
 import csv
-from typing import Optional
+import re
+import struct
+import time
+from typing import Callable, Coroutine, Optional
+from agent_payloads import PayloadCorpus, make_corpus
 
 # -----------------------------
 # App state and stats
 # -----------------------------
+class LatencyHistogram:
+    # HDR-style histogram of latencies in microseconds: values below 2^SUB_BITS are counted exactly,
+    # above that every power of two is split into 2^(SUB_BITS-1) linear buckets (<0.8% error).
+    # Fixed memory (~30 KB), O(1) record, mergeable across agents, workers and windows.
+    SUB_BITS = 8
+    MAX_MAGNITUDE = 30  # values up to 2^(SUB_BITS+MAX_MAGNITUDE-1) us, ~9.5 days
+
+    _HALF = 1 << (SUB_BITS - 1)
+    _MAX_VALUE = (1 << (SUB_BITS + MAX_MAGNITUDE - 1)) - 1
+    _BUCKETS = (MAX_MAGNITUDE + 2) << (SUB_BITS - 1)
+
+    def __init__(self) -> None:
+        self._counts = array.array('Q', bytes(8 * self._BUCKETS))
+        self._count = 0
+        self._sum = 0.0
+        self._min = 0.0
+        self._max = 0.0
+
+    @classmethod
+    def _index(cls, value: int) -> int:
+        magnitude = value.bit_length() - cls.SUB_BITS
+        if magnitude <= 0:
+            return value
+        return (magnitude << (cls.SUB_BITS - 1)) + (value >> magnitude)
+
+    @classmethod
+    def _bucket_upper(cls, index: int) -> int:
+        # highest value (us) that falls into the bucket
+        magnitude = (index >> (cls.SUB_BITS - 1)) - 1
+        if magnitude <= 0:
+            return index
+        sub = index - (magnitude << (cls.SUB_BITS - 1))
+        return ((sub + 1) << magnitude) - 1
+
+    def record(self, seconds: float) -> None:
+        if seconds < 0.0:
+            seconds = 0.0
+        value = int(seconds * 1_000_000)
+        if value > self._MAX_VALUE:
+            value = self._MAX_VALUE
+        # inlined _index(), this runs once per confirm
+        magnitude = value.bit_length() - self.SUB_BITS
+        if magnitude > 0:
+            value = (magnitude << (self.SUB_BITS - 1)) + (value >> magnitude)
+        self._counts[value] += 1
+        if self._count == 0 or seconds < self._min:
+            self._min = seconds
+        if seconds > self._max:
+            self._max = seconds
+        self._count += 1
+        self._sum += seconds
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        if other._count == 0:
+            return
+        counts = self._counts
+        for i, c in enumerate(other._counts):
+            if c:
+                counts[i] += c
+        if self._count == 0 or other._min < self._min:
+            self._min = other._min
+        if other._max > self._max:
+            self._max = other._max
+        self._count += other._count
+        self._sum += other._sum
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def count(self) -> int: return self._count
+    @property
+    def min(self) -> float: return self._min
+    @property
+    def max(self) -> float: return self._max
+
+    @property
+    def sum(self) -> float: return self._sum
+
+    def mean(self) -> float:
+        return self._sum / self._count if self._count else 0.0
+
+    def cumulative_counts(self, edges: tuple[float, ...]) -> list[int]:
+        # counts of values <= each edge (seconds, ascending), one pass; edges resolve to bucket precision
+        limits = [self._index(min(int(edge * 1_000_000), self._MAX_VALUE)) for edge in edges]
+        result = []
+        seen = 0
+        start = 0
+        counts = self._counts
+        for limit in limits:
+            seen += sum(counts[start:limit + 1])
+            start = limit + 1
+            result.append(seen)
+        return result
+
+    def percentile(self, p: float) -> float:
+        # p in 0..100; returns the upper edge of the bucket holding the p-th value, capped by max
+        if self._count == 0:
+            return 0.0
+        rank = max(1, int(self._count * p / 100.0 + 0.999999))
+        seen = 0
+        for i, c in enumerate(self._counts):
+            if c:
+                seen += c
+                if seen >= rank:
+                    return min(self._bucket_upper(i) / 1_000_000, self._max)
+        return self._max
+
+    def percentiles(self, ps=(50, 90, 95, 99, 99.9)) -> dict:
+        return {p: self.percentile(p) for p in ps}
+
+async def sleep_until(when: float) -> None:
+    # when: time.monotonic() seconds; step and window boundaries are planned as timestamps, so
+    # the time spent by the controller itself does not add up over a run
+    await asyncio.sleep(max(0.0, when - time.monotonic()))
+
+class SendScheduler:
+    # One timer for all agents: a heap of (due time, seq, future) served by a
+    # single loop.call_later handle armed for the earliest entry, instead of a sleep per agent.
+    # Times are time.monotonic() seconds.
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, int, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_when = 0.0
+
+    def wait_until(self, when: float) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        if when <= time.monotonic():
+            fut.set_result(None)
+            return fut
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, fut))
+        if self._timer is None or when < self._timer_when:
+            self._arm(loop, when)
+        return fut
+
+    def _arm(self, loop: asyncio.AbstractEventLoop, when: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_when = when
+        self._timer = loop.call_later(max(0.0, when - time.monotonic()), self._fire)
+
+    def _fire(self) -> None:
+        self._timer = None
+        heap = self._heap
+        now = time.monotonic()
+        while heap and heap[0][0] <= now:
+            fut = heapq.heappop(heap)[2]
+            if not fut.done():
+                fut.set_result(None)
+        if heap:
+            self._arm(asyncio.get_running_loop(), heap[0][0])
+
+    def wake_all(self) -> None:
+        # the rate changed (or the run stops): every waiter re-plans its next send now
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        heap, self._heap = self._heap, []
+        for _, _, fut in heap:
+            if not fut.done():
+                fut.set_result(None)
+
+class LoopMonitor:
+    # Event loop saturation: a probe callback is scheduled every `interval` sec and the delay between
+    # its planned and actual run time goes to a histogram. Each probe also samples the loop's ready
+    # queue (callbacks waiting to run); the task count is taken about once a second.
+    # Windows of other loops (worker processes) are kept per loop: a window's lag is the busiest loop's.
+    def __init__(self, interval: float = 0.05) -> None:
+        self._interval = interval
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._planned = 0.0
+        self._probes = 0
+        self._lags = LatencyHistogram()
+        self._merged_lags: dict[int, LatencyHistogram] = {}  # by source, see merge_window
+        self._max = 0.0  # since take_max()
+        self._ready_max = 0
+        self._ready_sum = 0
+        self._tasks_max = 0
+
+    def start(self) -> None:
+        if self._handle is None:
+            self._schedule(asyncio.get_running_loop())
+
+    def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._planned = loop.time() + self._interval
+        self._handle = loop.call_at(self._planned, self._probe, loop)
+
+    def _probe(self, loop: asyncio.AbstractEventLoop) -> None:
+        lag = max(0.0, loop.time() - self._planned)
+        self._lags.record(lag)
+        if lag > self._max:
+            self._max = lag
+        ready = len(getattr(loop, '_ready', ()))  # CPython and uvloop-free loops only
+        self._ready_sum += ready
+        if ready > self._ready_max:
+            self._ready_max = ready
+        self._probes += 1
+        if self._probes % max(1, int(1.0 / self._interval)) == 0:
+            tasks = len(asyncio.all_tasks(loop))
+            if tasks > self._tasks_max:
+                self._tasks_max = tasks
+        self._schedule(loop)
+
+    def take_max(self) -> float:
+        value, self._max = self._max, 0.0
+        return value
+
+    def take_window(self) -> tuple[LatencyHistogram, int, float, int]:
+        # lag histogram of the busiest loop (highest p99: this one or a merged one), ready queue max
+        # and mean, task count max since the previous call
+        lags = self._lags
+        probes = lags.count
+        for merged in self._merged_lags.values():
+            probes += merged.count
+            if merged.percentile(99) > lags.percentile(99):
+                lags = merged
+        result = (lags, self._ready_max, self._ready_sum / probes if probes else 0.0, self._tasks_max)
+        self._lags = LatencyHistogram()
+        self._merged_lags = {}
+        self._ready_max = self._ready_sum = self._tasks_max = 0
+        return result
+
+    def merge_window(self, lags: LatencyHistogram, ready_max: int, ready_mean: float, tasks_max: int,
+                     source: int = 0) -> None:
+        # adds a window taken elsewhere (worker process `source`); its lags are not pooled with other
+        # loops', a busy loop among idle ones would not show in the pooled p99 - the worst loop decides
+        merged = self._merged_lags.get(source)
+        if merged is None:
+            merged = self._merged_lags[source] = LatencyHistogram()
+        merged.merge(lags)
+        self._ready_max = max(self._ready_max, ready_max)
+        self._ready_sum += ready_mean * lags.count
+        self._tasks_max = max(self._tasks_max, tasks_max)
+        if lags.max > self._max:
+            self._max = lags.max
+
+class AgentFairness:
+    # How evenly one window's traffic was served across the agents: Jain index of per-agent confirmed
+    # EPS over each agent's expected share (1 = all equal, 1/n = one agent got everything), the low end
+    # of the per-agent EPS, and the agents that got the least of their share. Agents that were due to
+    # send but could not (a window full of unconfirmed batches) count with 0 EPS; only those not
+    # connected or in the off period of a bursty agent are left out, as silent. Stalled: agents with
+    # batches waiting for a confirm and no confirm in the whole window.
+    SLOWEST = 5
+
+    def __init__(self, eps: list[float], shares: list[float], confirms: list[int], errors: list[int],
+                 lat_sum: list[float], lat_max: list[float], names: list[str], silent: int = 0,
+                 sent_eps: Optional[list[float]] = None, stalled: int = 0) -> None:
+        self.agents = len(eps)
+        self.silent = silent
+        self.stalled = stalled
+        self.shares = shares
+        self.sent_eps = sent_eps if sent_eps is not None else eps  # events sent per sec of every agent
+        served = [x / w if w > 0 else x for x, w in zip(eps, shares)]
+        total = sum(served)
+        squares = sum(x * x for x in served)
+        self.jain = total * total / (self.agents * squares) if squares > 0 else 1.0
+        ordered = sorted(eps)
+        self.eps_min = ordered[0] if ordered else 0.0
+        self.eps_p5 = ordered[int(len(ordered) * 0.05)] if ordered else 0.0
+        self.eps_median = ordered[len(ordered) // 2] if ordered else 0.0
+        # (name, confirmed EPS, mean latency, max latency, errors) of the least served agents
+        self.slowest = [(names[i], eps[i], lat_sum[i] / confirms[i] if confirms[i] else 0.0, lat_max[i], errors[i])
+                        for i in sorted(range(self.agents), key=served.__getitem__)[:self.SLOWEST]]
+
+    def share_below(self, planned_eps: float, ratio: float) -> float:
+        # part of the agents that sent less than ratio of their planned rate; planned_eps: the average
+        # per-agent rate, every agent is planned at its share of it
+        if not self.agents or planned_eps <= 0:
+            return 0.0
+        below = sum(1 for sent, share in zip(self.sent_eps, self.shares) if sent < ratio * planned_eps * share)
+        return below / self.agents
+
+    def describe(self) -> str:
+        return "jain=%.3f, agent eps min/p5/median=%.1f/%.1f/%.1f over %d agents (%d silent, %d stalled)" % (
+            self.jain, self.eps_min, self.eps_p5, self.eps_median, self.agents, self.silent, self.stalled)
+
+    def describe_slowest(self) -> str:
+        return ", ".join("%s eps=%.1f lat mean/max=%.3f/%.3fs errors=%d" % agent for agent in self.slowest)
+
+class AgentCounters:
+    # Per-agent traffic in flat arrays indexed by agent slot (an AgentSocket takes one when built):
+    # batches and events sent, confirms, errors, confirm latency sum and max. Updates on the send and
+    # confirm paths are array item stores, nothing is allocated per message; windows are differences
+    # of copies taken at their boundaries, and the latency max starts over with every window.
+    # inflight and due are sampled from the agents when a window is taken or pushed (AppState.sample_agents).
+    def __init__(self, size: int = 0) -> None:
+        self.batches = array.array('q', bytes(8 * size))
+        self.events = array.array('q', bytes(8 * size))
+        self.confirms = array.array('q', bytes(8 * size))
+        self.errors = array.array('q', bytes(8 * size))
+        self.lat_sum = array.array('d', bytes(8 * size))
+        self.lat_max = array.array('d', bytes(8 * size))
+        self.suffixes = array.array('Q', bytes(8 * size))  # agent names, see AgentSocket.name
+        self.active = bytearray(b"\x01" * size)  # 0: taken out of the run (AgentSocket.close)
+        self.inflight = array.array('q', bytes(8 * size))  # batches waiting for a confirm
+        self.due = bytearray(size)  # 1: connected and due to send (self paced, not in an off period)
+        self._base = self._copy()
+        self._window_started = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def add_agent(self, suffix: int) -> int:
+        for counts in (self.batches, self.events, self.confirms, self.errors):
+            counts.append(0)
+        self.lat_sum.append(0.0)
+        self.lat_max.append(0.0)
+        self.suffixes.append(suffix)
+        self.active.append(1)
+        self.inflight.append(0)
+        self.due.append(0)
+        for counts in self._base:
+            counts.append(0)
+        return len(self.batches) - 1
+
+    def _copy(self) -> tuple:
+        return (self.batches[:], self.events[:], self.confirms[:], self.errors[:], self.lat_sum[:])
+
+    def state(self) -> tuple:
+        # totals and the latency max of the window so far, as bytes (worker processes push them to the parent);
+        # the max starts over here, the parent keeps the window's max
+        state = (self.batches.tobytes(), self.events.tobytes(), self.confirms.tobytes(), self.errors.tobytes(),
+                 self.lat_sum.tobytes(), self.lat_max.tobytes(), self.suffixes.tobytes(), bytes(self.active),
+                 self.inflight.tobytes(), bytes(self.due))
+        self.lat_max = array.array('d', bytes(8 * len(self.lat_max)))
+        return state
+
+    def load(self, offset: int, state: tuple) -> None:
+        # state() of the agents [offset, offset + n) taken elsewhere
+        batches, events, confirms, errors, lat_sum, lat_max, suffixes, active, inflight, due = state
+        n = len(batches) // 8
+        end = offset + n
+        for counts, data in ((self.batches, batches), (self.events, events), (self.confirms, confirms),
+                             (self.errors, errors), (self.lat_sum, lat_sum), (self.suffixes, suffixes),
+                             (self.inflight, inflight)):
+            counts[offset:end] = array.array(counts.typecode, data)
+        self.lat_max[offset:end] = array.array('d', map(max, self.lat_max[offset:end], array.array('d', lat_max)))
+        self.active[offset:end] = active
+        self.due[offset:end] = due
+
+    def take_window(self, shares: Optional[list[float]] = None) -> Optional[AgentFairness]:
+        # fairness of the active agents since the previous call; shares: expected part of the
+        # average per-agent rate of every slot (fleet rate factors), equal when not set
+        now = time.monotonic()
+        seconds, self._window_started = now - self._window_started, now
+        base, current = self._base, self._copy()
+        self._base = current
+        lat_max, self.lat_max = self.lat_max, array.array('d', bytes(8 * len(self.lat_max)))
+        (batches, events, confirms, errors, lat_sum), (batches0, events0, confirms0, errors0, lat_sum0) = current, base
+        active = [i for i, flag in enumerate(self.active) if flag]
+        # an agent due to send that sent nothing is starved (its window full of unconfirmed batches): 0 EPS
+        slots = [i for i in active if batches[i] > batches0[i] or self.due[i]]
+        if not slots or seconds <= 0:
+            return None
+        eps, window_confirms = [], []
+        for i in slots:
+            confirmed = confirms[i] - confirms0[i]
+            # events per confirm: the agent's own batch sizes in the window, or in the run when it sent none
+            sent = batches[i] - batches0[i]
+            batch = (events[i] - events0[i]) / sent if sent else events[i] / batches[i] if batches[i] else 0.0
+            eps.append(confirmed * batch / seconds)
+            window_confirms.append(confirmed)
+        stalled = sum(1 for i in active if self.inflight[i] and confirms[i] == confirms0[i])
+        return AgentFairness(eps, [shares[i] for i in slots] if shares is not None else [1.0] * len(slots),
+                             window_confirms, [errors[i] - errors0[i] for i in slots],
+                             [lat_sum[i] - lat_sum0[i] for i in slots], [lat_max[i] for i in slots],
+                             [f"FakeAgent_{self.suffixes[i]:016X}" for i in slots], len(active) - len(slots),
+                             [(events[i] - events0[i]) / seconds for i in slots], stalled)
+
 class AppState:
-    def __init__(self, agents_count: int) -> None:
+    def __init__(self, agents_count: int, batch_size: int = 1, ready_fraction: float = 1.0) -> None:
         self._stop = False
         self._ready = False
         self._agents_approved = 0
 
         self._agents_count = agents_count
-        self._rate_limit_total_eps = 0.0  # total events/sec budget across all agents, live-updated
+        # traffic starts when this many agents are approved, stragglers join as they come
+        self._ready_count = max(1, math.ceil(agents_count * min(1.0, ready_fraction)))
+        self._batch_size = batch_size
+        # total events/sec budget across all agents, live-updated: a linear ramp from _rate_from
+        # to _rate_to between the monotonic times _ramp_start and _ramp_end (equal for a step change)
+        self._rate_from = 0.0
+        self._rate_to = 0.0
+        self._ramp_start = 0.0
+        self._ramp_end = 0.0
 
-        # Stats
+        # Stats: counters are totals for the run, windows are taken as differences
+        self._agents_active = 0
+        self._agents_dropped = 0  # connections cut by drop_agents
+        self._events_sent = 0
+        self._events_confirmed = 0  # at the batch size of the time (Agent_Sweep changes it), see events_confirmed
         self._batches_sent = 0
         self._confirms = 0
         self._errors = 0
-        # Keep moderate list size to bound memory; only p95 needs a few thousand
-        self._deque_max_len = 5000
-        self._confirm_latencies = collections.deque(maxlen=self._deque_max_len)
+        self._window_base = (0, 0, 0)
+        self._window_events_base = 0
+        self._window_started = time.monotonic()
+        # events per confirm of the last window taken (snapshot_and_reset_window), the batch size without a fleet
+        self.window_events_per_confirm = float(batch_size)
+        # Every confirm of the window is recorded, memory stays fixed
+        self._confirm_latencies = LatencyHistogram()
+        # Second histogram for per-interval consumers (MetricsRecorder), off unless requested
+        self._interval_latencies: Optional[LatencyHistogram] = None
+        # Connection phases, for the whole run
+        self._connect_tcp = LatencyHistogram()
+        self._connect_tls = LatencyHistogram()
+        self._connect_auth = LatencyHistogram()
+        self._tls_resumed = 0
+        # Loss (or drop) to approval of reconnecting agents; taken by the churn phase
+        self._reconnect_latencies = LatencyHistogram()
+        self._agents: list["AgentSocket"] = []  # attached by the runner, for drop_agents
+        self.fleet = None  # agent_fleet.Fleet: per-agent profiles and per-class stats, when the run has one
+        self.trace = None  # agent_trace.TraceRecorder: every batch sent is recorded, when the run has one
+        self.agent_counters = AgentCounters()  # per agent, by slot
 
-        # Protect against rare cross-task races; most ops are single-threaded in the event loop
-        self._change_rate_lock = asyncio.Lock()
+        self._ready_event = asyncio.Event()
+        self._ready_callbacks: list[Callable[[], None]] = []
+        self._send_scheduler = SendScheduler()
+        self._loop_monitor = LoopMonitor()
 
     @property
     def stopped(self) -> bool:
@@ -38,35 +455,166 @@ class AppState:
     
     def signalToStop(self) -> None:
         self._stop = True
+        self._ready_event.set()  # agents still waiting for the start exit
+        self._send_scheduler.wake_all()
    
     @property
     def ready(self) -> bool:
         return self._ready
 
+    async def wait_ready(self) -> None:
+        # returns when traffic starts (or the run is stopped before that)
+        await self._ready_event.wait()
+
+    def call_when_ready(self, callback: Callable[[], None]) -> None:
+        # runs callback when traffic starts, at once if it already has; no task per waiting agent
+        if self._ready:
+            callback()
+        else:
+            self._ready_callbacks.append(callback)
+
+    def _set_ready(self) -> None:
+        self._ready = True
+        self._ready_event.set()
+        callbacks, self._ready_callbacks = self._ready_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    @property
+    def send_scheduler(self) -> SendScheduler:
+        return self._send_scheduler
+
+    @property
+    def loop_monitor(self) -> LoopMonitor:
+        # not running until started by a consumer (CapacitySearch, MetricsEndpoint, agent workers)
+        return self._loop_monitor
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+    @batch_size.setter
+    def batch_size(self, value: int):
+        self._batch_size = value
+
+    @property
+    def agents_count(self) -> int:
+        return self._agents_count
+    @agents_count.setter
+    def agents_count(self, value: int):
+        # the pool was resized (Agent_Sweep): the per-agent share of the EPS budget follows
+        self._agents_count = value
+
+    @property
+    def agents_approved(self) -> int:
+        return self._agents_approved
+
+    @property
+    def agents_active(self) -> int:
+        # approved and still connected
+        return self._agents_active
+
+    @property
+    def rate_limit_total_eps(self) -> float:
+        # read on every send: during a ramp the budget follows the line, traffic never pauses
+        if self._ramp_end > self._ramp_start:
+            now = time.monotonic()
+            if now < self._ramp_end:
+                frac = (now - self._ramp_start) / (self._ramp_end - self._ramp_start)
+                return self._rate_from + (self._rate_to - self._rate_from) * frac
+        return self._rate_to
+
     @property
     def rate_limit_per_agent_eps(self) -> float:
         if self._agents_count == 0:
             return 0.0
-        return self._rate_limit_total_eps / self._agents_count
+        return self.rate_limit_total_eps / self._agents_count
 
     def is_changing_rate(self) -> bool:
-        return self._change_rate_lock.locked()
+        # a ramp is in progress
+        return time.monotonic() < self._ramp_end
 
-    async def set_rate_limit_total(self, eps: float, change_rate_delay: float = 5.0) -> None:
-        async with self._change_rate_lock:
-            self._rate_limit_total_eps = max(0.0, eps)
-            await asyncio.sleep(change_rate_delay)
+    async def set_rate_limit_total(self, eps: float, settle_sec: float = 5.0, reset_window: bool = True,
+                                   ramp_sec: float = 0.0) -> None:
+        # ramp_sec=0 changes the rate at once and wakes the agents to re-plan their next send;
+        # otherwise the rate moves linearly from the current one. Agents keep sending all the time.
+        # reset_window: the window is cut exactly settle_sec after the ramp ends, so the transition
+        # is not measured; without it the call returns right away.
+        now = time.monotonic()
+        self._rate_from = self.rate_limit_total_eps
+        self._rate_to = max(0.0, eps)
+        self._ramp_start = now
+        self._ramp_end = now + max(0.0, ramp_sec)
+        if ramp_sec <= 0:
+            self._send_scheduler.wake_all()
+        if reset_window:
+            await sleep_until(self._ramp_end + settle_sec)
             self.snapshot_and_reset_window()
 
     def on_agent_approved(self) -> None:
         self._agents_approved += 1
+        self._agents_active += 1
         #logging.info("Agents approved: %d/%d", self._agents_approved, self._agents_count)
-        if self._agents_approved == self._agents_count:
-            self._ready = True
-            logging.info("All agents approved, starting traffic...")
+        if not self._ready and self._agents_approved >= self._ready_count:
+            self._set_ready()
+            logging.info("%d/%d agents approved, starting traffic...", self._agents_approved, self._agents_count)
+
+    def on_agent_disconnected(self) -> None:
+        self._agents_active -= 1
+
+    def on_connect_phases(self, tcp: float, tls: float, auth: float, tls_resumed: bool) -> None:
+        self._connect_tcp.record(tcp)
+        self._connect_tls.record(tls)
+        self._connect_auth.record(auth)
+        if tls_resumed:
+            self._tls_resumed += 1
+
+    def connect_stats(self) -> tuple[LatencyHistogram, LatencyHistogram, LatencyHistogram, int]:
+        return self._connect_tcp, self._connect_tls, self._connect_auth, self._tls_resumed
+
+    def on_reconnected(self, seconds: float) -> None:
+        self._reconnect_latencies.record(seconds)
+
+    def sample_agents(self) -> None:
+        # connection and window state of this process's agents into agent_counters
+        now = time.monotonic()
+        for agent in self._agents:
+            agent.sample_counters(now)
+
+    def take_agent_fairness(self) -> Optional[AgentFairness]:
+        # per-agent fairness since the previous call; with a fleet every agent is judged by its own expected share
+        self.sample_agents()
+        return self.agent_counters.take_window(self.fleet.expected_share if self.fleet is not None else None)
+
+    def take_reconnect_latencies(self) -> LatencyHistogram:
+        lats, self._reconnect_latencies = self._reconnect_latencies, LatencyHistogram()
+        return lats
+
+    def attach_agents(self, agents: list["AgentSocket"]) -> None:
+        self._agents = agents
 
-    def on_batch_sent(self) -> None:
+    @property
+    def agents(self) -> list["AgentSocket"]:
+        # agents of this process, as attached
+        return self._agents
+
+    def drop_agents(self, count: int) -> int:
+        # cuts the connections of `count` random connected agents, as a network failure or a server
+        # restart would; agents with config.reconnect dial again. Returns the number dropped.
+        connected = [agent for agent in self._agents if agent.ready]
+        dropped = random.sample(connected, min(count, len(connected)))
+        for agent in dropped:
+            agent.drop()
+        self._agents_dropped += len(dropped)
+        return len(dropped)
+
+    @property
+    def agents_dropped(self) -> int:
+        # agents actually dropped so far (with worker processes: as they reported)
+        return self._agents_dropped
+
+    def on_batch_sent(self, events: int) -> None:
         self._batches_sent += 1
+        self._events_sent += events
 
     def on_error(self) -> None:
         self._errors += 1
@@ -75,27 +623,78 @@ class AppState:
         pass
 
     def on_confirm_latency(self, seconds: float) -> None:
-        self._confirm_latencies.append(seconds)
+        self._confirm_latencies.record(seconds)
+        if self._interval_latencies is not None:
+            self._interval_latencies.record(seconds)
 
     def on_confirm(self):
         self._confirms += 1
+        self._events_confirmed += self._batch_size
+
+    @property
+    def window_started(self) -> float:
+        # time.monotonic() of the last window cut
+        return self._window_started
+
+    def window_elapsed(self) -> float:
+        # exact length of the current window; read right before the snapshot to turn counts into rates
+        return time.monotonic() - self._window_started
 
-    def snapshot_and_reset_window(self) -> tuple[collections.deque, int, int, int, str]:
+    def snapshot_and_reset_window(self) -> tuple[LatencyHistogram, int, int, int]:
         # Called by scenario controller at step boundaries
         lats = self._confirm_latencies
-        batches_sent = self._batches_sent
-        confirms = self._confirms
-        errors = self._errors
-        self._confirm_latencies = collections.deque(maxlen=self._deque_max_len)
-        self._batches_sent = 0
-        self._confirms = 0
-        self._errors = 0
-        return lats, batches_sent, confirms, errors
+        base_sent, base_confirms, base_errors = self._window_base
+        self._window_base = (self._batches_sent, self._confirms, self._errors)
+        events = self.events_confirmed()
+        confirms = self._confirms - base_confirms
+        self.window_events_per_confirm = (events - self._window_events_base) / confirms if confirms else self._batch_size
+        self._window_events_base = events
+        self._window_started = time.monotonic()
+        self._confirm_latencies = LatencyHistogram()
+        return lats, self._batches_sent - base_sent, self._confirms - base_confirms, self._errors - base_errors
+
+    def merge_window(self, lats: LatencyHistogram, batches_sent: int, confirms: int, errors: int,
+                     events_sent: int) -> None:
+        # Adds a window snapshot taken elsewhere (e.g. in a worker process) to this window
+        self._confirm_latencies.merge(lats)
+        if self._interval_latencies is not None:
+            self._interval_latencies.merge(lats)
+        self._batches_sent += batches_sent
+        self._events_sent += events_sent
+        self._confirms += confirms
+        self._events_confirmed += confirms * self._batch_size
+        self._errors += errors
+
+    def events_confirmed(self) -> int:
+        # events of the confirmed batches since start. With a fleet they are counted per agent: agents of
+        # different batch sizes don't get confirms in proportion to their share (large batches held back
+        # by a full window), so confirms x the fleet's average batch would be off
+        if self.fleet is not None:
+            return self.fleet.events_confirmed
+        return self._events_confirmed
+
+    def confirm_marks(self) -> dict[int, tuple[float, int]]:
+        # per source of confirms: (its clock in sec, events confirmed so far); rates are differences
+        # of these (see agent_scenarios.ConfirmedRate). One source here, worker processes have their own
+        return {0: (time.monotonic(), self.events_confirmed())}
+
+    def window_latency_sum(self) -> tuple[int, float]:
+        # confirms and summed latency of the current window, cheap enough to poll every second
+        return self._confirm_latencies.count, self._confirm_latencies.sum
+
+    def totals(self) -> tuple[int, int, int, int]:
+        # batches sent, confirms, errors, events sent since start
+        return self._batches_sent, self._confirms, self._errors, self._events_sent
+
+    def take_interval_latencies(self) -> LatencyHistogram:
+        # latencies since the previous call; the first call turns interval recording on
+        lats = self._interval_latencies or LatencyHistogram()
+        self._interval_latencies = LatencyHistogram()
+        return lats
     
     async def start_stats(self) -> None:
         # Periodic overall stats
-        while not self._ready and not self._stop:
-            await asyncio.sleep(2)
+        await self.wait_ready()
 
         last_check = datetime.datetime.now()
         last_events_count = self._events_sent
@@ -122,6 +721,13 @@ class FileHelper:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         filename = os.path.join(script_dir, filename)
         file_exists = os.path.isfile(filename)
+        if file_exists and FileHelper._read_titles(filename) != list(titles):
+            # rows of another layout (an older version, another script): appending would put them under
+            # the wrong header, and readers go by column name - the old file is kept aside
+            rotated = FileHelper._free_name(filename)
+            os.replace(filename, rotated)
+            logging.warning("%s has other columns, moved to %s; starting a new file", filename, rotated)
+            file_exists = False
         with open(filename, 'a', newline='') as f:
             writer = csv.writer(f)
             if not file_exists:
@@ -129,19 +735,124 @@ class FileHelper:
 
             writer.writerow(data)
 
+    @staticmethod
+    def _read_titles(filename: str) -> list[str]:
+        with open(filename, newline='') as f:
+            return next(csv.reader(f), [])
+
+    @staticmethod
+    def _free_name(filename: str) -> str:
+        # results.csv -> results.1.csv, results.2.csv, ... whichever does not exist yet
+        stem, ext = os.path.splitext(filename)
+        n = 1
+        while os.path.exists(f"{stem}.{n}{ext}"):
+            n += 1
+        return f"{stem}.{n}{ext}"
+
+    @staticmethod
+    def load_results_csv(filename: str) -> list[dict]:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        filename = os.path.join(script_dir, filename)
+        if not os.path.isfile(filename):
+            return []
+        with open(filename, newline='') as f:
+            return list(csv.DictReader(f))
+
 # -----------------------------
 # Agent logic
 # -----------------------------
+# asyncio gives every TLS connection a 256 KB plaintext read buffer (SSLProtocol.max_size), most of an
+# idle agent's memory. 16 KB holds a full TLS record, and agents only read small confirms.
+TLS_READ_BUFFER = 16 * 1024
+
+def set_tls_read_buffer(size: int) -> None:
+    # SSLProtocol allocates the buffer in its constructor, before any hook sees the connection, so the size
+    # can only be set on the class and covers every TLS connection the process opens afterwards.
+    # Opt-in: AgentSocket calls it only for an AgentConfig with tls_read_buffer set
+    if size > 0 and getattr(asyncio.sslproto.SSLProtocol, "max_size", size) != size:
+        asyncio.sslproto.SSLProtocol.max_size = size
+
+class ResumableSSLContext(ssl.SSLContext):
+    # Client context that offers the last seen TLS session on every new connection, so a mass
+    # reconnect does abbreviated handshakes. asyncio has no session argument, but it creates
+    # every SSLObject through wrap_bio.
+    _session: Optional[ssl.SSLSession] = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self._session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def remember_session(self, ssl_object) -> None:
+        if ssl_object is not None and ssl_object.session is not None:
+            self._session = ssl_object.session
+
+TRANSPORTS = ("stream", "protocol")
+
 class AgentConfig:
-    def __init__(self, host, port, token, batch_size: int = 10) -> None:
+    def __init__(self, host, port, token, batch_size: int = 10,
+                 window: int = 1, confirm_timeout: float = 30.0, open_loop: bool = False,
+                 use_tls: bool = True, tls_resume: bool = True,
+                 spawn_rate: float = 0.0, handshake_limit: int = 0, transport: str = "stream",
+                 reconnect: bool = False, backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 payloads: Optional[dict] = None, self_paced: bool = True, tls_read_buffer: int = 0) -> None:
         self._host = host
         self._port = port
         self._token = token
         self._batch_size = batch_size
+        self._window = max(1, window)  # batches in flight per agent, waiting for confirm
+        self._confirm_timeout = confirm_timeout
+        # open loop: send times are planned from the target rate and latency counts from the
+        # planned time, so a slow server can't quietly lower the offered load (coordinated omission)
+        self._open_loop = open_loop
 
-        self._ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        self._ssl_ctx.check_hostname = False
-        self._ssl_ctx.verify_mode = ssl.VerifyMode.CERT_NONE
+        # connection ramp: new agents per sec (0 = all at once) and connects in progress at most (0 = no limit)
+        self._spawn_rate = spawn_rate
+        self._handshake_limit = handshake_limit
+
+        # stream: StreamReader/StreamWriter; protocol: AgentProtocol, frames parsed from bytes in place
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        self._transport = transport
+
+        # reconnect: a lost connection is dialed again after a backoff drawn from
+        # 0..min(backoff_max, backoff_base * 2^failed attempts) (exponential, full jitter)
+        self._reconnect = reconnect
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+
+        # payload corpus spec (see agent_payloads.py); None: every event is the constant "Startup" one
+        self._payload_spec = payloads
+        self._payloads = make_corpus(payloads)
+
+        # self paced: every agent sends at its share of the rate limit once traffic starts;
+        # otherwise agents only send when told to (AgentSocket.replay_send, see agent_trace.py)
+        self._self_paced = self_paced
+
+        self._use_tls = use_tls
+        self._tls_resume = tls_resume
+        # plaintext read buffer of TLS connections, 0 = asyncio default (see set_tls_read_buffer)
+        self._tls_read_buffer = tls_read_buffer
+        self._ssl_ctx = self._make_ssl_context() if use_tls else None
+
+    def _make_ssl_context(self) -> ssl.SSLContext:
+        ssl_ctx = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT) if self._tls_resume else ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_ctx.check_hostname = False
+        ssl_ctx.verify_mode = ssl.VerifyMode.CERT_NONE
+        return ssl_ctx
+
+    # SSLContext can't be pickled: worker processes get the settings and build their own context,
+    # and their own payload pool from the corpus spec
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_ssl_ctx']
+        del state['_payloads']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ssl_ctx = self._make_ssl_context() if self._use_tls else None
+        self._payloads = make_corpus(self._payload_spec)
 
     @property
     def host(self): return self._host
@@ -156,6 +867,30 @@ class AgentConfig:
     def batch_size(self, value: int):
         self._batch_size = value
     @property
+    def window(self): return self._window
+    @property
+    def confirm_timeout(self): return self._confirm_timeout
+    @property
+    def open_loop(self): return self._open_loop
+    @property
+    def spawn_rate(self): return self._spawn_rate
+    @property
+    def handshake_limit(self): return self._handshake_limit
+    @property
+    def tls_read_buffer(self): return self._tls_read_buffer
+    @property
+    def transport(self): return self._transport
+    @property
+    def reconnect(self): return self._reconnect
+    @property
+    def backoff_base(self): return self._backoff_base
+    @property
+    def backoff_max(self): return self._backoff_max
+    @property
+    def payloads(self): return self._payloads
+    @property
+    def self_paced(self): return self._self_paced
+    @property
     def ssl_context(self): return self._ssl_ctx
 
 class AgentMessageHelper:
@@ -169,6 +904,15 @@ class AgentMessageHelper:
         writer.write(msg_len + msg_bytes)
         await writer.drain()
 
+    @staticmethod
+    async def send_frame(writer: asyncio.StreamWriter, frame: tuple[bytes, ...]) -> None:
+        # frame is already length-prefixed (see make_events_batch_frame); writelines lets
+        # the TLS transport consume the cached batch body without joining it first
+        if writer is None:
+            return
+        writer.writelines(frame)
+        await writer.drain()
+
     @staticmethod
     async def read_message(reader: asyncio.StreamReader) -> str:
         if reader is None:
@@ -195,6 +939,33 @@ class AgentMessageHelper:
         echo_data = sock.recv(size)
         return echo_data.decode("utf-8")        
 
+    @staticmethod
+    def parse_confirm_id(msg: str) -> Optional[int]:
+        # '{"m":"confirm","id":"2",...}' -> 2; None when the confirm carries no usable id
+        pos = msg.find('"id":')
+        if pos < 0:
+            return None
+        pos += 5
+        if msg.startswith('"', pos):
+            pos += 1
+        end = pos
+        while end < len(msg) and msg[end].isdigit():
+            end += 1
+        return int(msg[pos:end]) if end > pos else None
+
+    _ID_DIGITS = re.compile(rb'"?(\d+)')
+
+    @staticmethod
+    def parse_confirm_id_bytes(buf, start: int = 0, end: Optional[int] = None) -> Optional[int]:
+        # parse_confirm_id on a bytes-like frame at buf[start:end], without decoding it
+        if end is None:
+            end = len(buf)
+        pos = buf.find(b'"id":', start, end)
+        if pos < 0:
+            return None
+        match = AgentMessageHelper._ID_DIGITS.match(buf, pos + 5, end)
+        return int(match.group(1)) if match else None
+
     @staticmethod
     def make_id_msg(name: str, peerid: str, token: str) -> str:
         return """{
@@ -245,77 +1016,384 @@ class AgentMessageHelper:
         events = ",".join(AgentMessageHelper.make_event(ts) for _ in range(events_count))
         return f'{{"m":"events","priority":0,"ts":{ts},"events":[{events}],"confirmId":"{confirmationId}"}}'
 
+    @staticmethod
+    def make_events_batch_frame(events_count: int, confirmationId: int,
+                                payloads: Optional[PayloadCorpus] = None) -> tuple[bytes, ...]:
+        # Same message as make_events_batch, but as ready-to-write bytes: (length prefix, cached body, confirmId tail);
+        # with a payload corpus the events are slices of its pre-encoded pool instead
+        if payloads is not None:
+            return payloads.make_events_batch_frame(events_count, confirmationId)
+        head = _batch_templates.get(events_count, int(time.time()))
+        tail = b'%d"}' % confirmationId
+        return (len(head) + len(tail)).to_bytes(4, byteorder="big"), head, tail
+
+class BatchTemplateCache:
+    # Encoded batch body up to the confirmId value, per batch size. All events of a batch share
+    # the batch "ts", so the cache is only valid for one second and is dropped when ts changes.
+    def __init__(self) -> None:
+        self._ts = -1
+        self._templates: dict[int, bytes] = {}
+
+    def get(self, events_count: int, ts: int) -> bytes:
+        if ts != self._ts:
+            self._ts = ts
+            self._templates.clear()
+        head = self._templates.get(events_count)
+        if head is None:
+            head = self._build(events_count, ts)
+            self._templates[events_count] = head
+        return head
+
+    @staticmethod
+    def _build(events_count: int, ts: int) -> bytes:
+        event = AgentMessageHelper.make_event(ts).encode()
+        events = (event + b",") * (events_count - 1) + event if events_count > 0 else b""
+        return b'{"m":"events","priority":0,"ts":%d,"events":[%b],"confirmId":"' % (ts, events)
+
+_batch_templates = BatchTemplateCache()
+
+class AgentProtocol(asyncio.BufferedProtocol):
+    # Low-level alternative to the StreamReader/StreamWriter pair (config.transport == "protocol").
+    # Frames are parsed straight out of one receive buffer that is reused (grown only for a bigger
+    # frame), classified from bytes and handed to the agent; nothing is decoded. Writes made in one
+    # loop iteration go to the transport in one writelines call, and senders wait only while the
+    # transport is over its high water mark.
+    __slots__ = ('_agent', '_transport', '_buffer', '_filled', '_pending', '_flushing', '_paused',
+                 '_drain_waiter', 'approved', 'closed')
+
+    BUFFER_SIZE = 2 * 1024  # confirms are ~60 bytes; policy frames grow the buffer once
+    HIGH_WATER = 64 * 1024
+    LOW_WATER = 16 * 1024
+    _CONFIRM_HEAD = b'{"m":"confirm","id":"'  # as the server writes it (MsgStorage.CONFIRM)
+    _frame_size = struct.Struct(">I").unpack_from
+
+    def __init__(self, agent: "AgentSocket") -> None:
+        loop = asyncio.get_running_loop()
+        self._agent = agent
+        self._transport: Optional[asyncio.Transport] = None
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._filled = 0
+        self._pending: list[bytes] = []
+        self._flushing = False
+        self._paused = False
+        self._drain_waiter: Optional[asyncio.Future] = None
+        self.approved = loop.create_future()  # auth answer: result on approve, exception on reject
+        self.closed = loop.create_future()    # connection end: result is the error, None when closed by us
+
+    @property
+    def transport(self) -> Optional[asyncio.Transport]:
+        return self._transport
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    # --- asyncio callbacks ---
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._transport = transport
+        transport.set_write_buffer_limits(self.HIGH_WATER, self.LOW_WATER)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._transport = None
+        if not self.approved.done():
+            self.approved.set_exception(exc or ConnectionError("Connection closed before auth"))
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        self.resume_writing()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._filled == len(self._buffer):
+            self._grow(2 * len(self._buffer))
+        return memoryview(self._buffer)[self._filled:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        filled = self._filled + nbytes
+        buf = self._buffer
+        pos = 0
+        while filled - pos >= 4:
+            end = pos + 4 + self._frame_size(buf, pos)[0]
+            if end > filled:
+                break
+            self._on_frame(buf, pos + 4, end)
+            pos = end
+        rest = filled - pos
+        if pos and rest:
+            # a partial frame moves to the start; usually the buffer held whole frames only
+            buf[:rest] = buf[pos:filled]
+        self._filled = rest
+        if rest >= 4:
+            size = 4 + self._frame_size(buf, 0)[0]
+            if size > len(buf):
+                self._grow(size)
+
+    def eof_received(self) -> bool:
+        return False  # close the transport, connection_lost follows
+
+    def pause_writing(self) -> None:
+        self._paused = True
+
+    def resume_writing(self) -> None:
+        self._paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+        self._drain_waiter = None
+
+    # --- used by AgentSocket ---
+    def write_frame(self, frame: tuple[bytes, ...]) -> None:
+        if self._transport is None or self._transport.is_closing():
+            raise ConnectionError("Connection lost")
+        self._pending.extend(frame)
+        if not self._flushing:
+            self._flushing = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def write_message(self, msg: str) -> None:
+        msg_bytes = msg.encode()
+        self.write_frame((len(msg_bytes).to_bytes(4, byteorder="big"), msg_bytes))
+
+    async def wait_writable(self) -> None:
+        if self._paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            await self._drain_waiter
+
+    def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+
+    def _flush(self) -> None:
+        self._flushing = False
+        pending, self._pending = self._pending, []
+        if self._transport is not None and not self._transport.is_closing():
+            self._transport.writelines(pending)
+
+    def _grow(self, size: int) -> None:
+        buf = bytearray(max(size, 2 * len(self._buffer)))
+        buf[:self._filled] = self._buffer[:self._filled]
+        self._buffer = buf
+
+    def _on_frame(self, buf: bytearray, start: int, end: int) -> None:
+        # confirms first: they are nearly all of the traffic; the server's own layout skips the search
+        if buf.startswith(self._CONFIRM_HEAD, start):
+            id_start = start + len(self._CONFIRM_HEAD)
+            id_end = buf.find(b'"', id_start, end)
+            digits = buf[id_start:id_end] if id_end > 0 else b""
+            self._agent._on_confirm(int(digits) if digits.isdigit() else None)
+        elif buf.find(b'"m":"confirm"', start, end) >= 0:
+            self._agent._on_confirm(AgentMessageHelper.parse_confirm_id_bytes(buf, start, end))
+        elif buf.find(b'"subsystem":"auth"', start, end) >= 0 and not self.approved.done():
+            if buf.find(b'"status":"approved"', start, end) >= 0:
+                self.approved.set_result(None)
+            elif buf.find(b'"error":1', start, end) >= 0:
+                self.approved.set_exception(Exception(f"Auth not approved: {bytes(buf[start:end]).decode(errors='replace')}"))
+        # policy, ping and the rest need no answer
+
 class AgentSocket:
-    def __init__(self, config: AgentConfig, app_state: AppState) -> None:
+    # Slots, not a dict: an idle fleet keeps 100k of these per process
+    __slots__ = ('_config', '_app_state', '_suffix', '_reader', '_writer', '_protocol', '_ready', '_closing',
+                 '_dropped', '_lost_at', '_sessions', '_confirmationId',
+                 '_inflight', '_window_waiter',
+                 '_spam_task', '_fleet_index', '_slot')
+
+    def __init__(self, config: AgentConfig, app_state: AppState, fleet_index: int = -1) -> None:
         self._config = config
         self._app_state = app_state
+        # profile of this agent in app_state.fleet (agent_fleet.py), -1: the run's batch size and an even EPS share
+        self._fleet_index = fleet_index
 
-        suffix = secrets.token_hex(8).upper()
-        self._name = f"FakeAgent_{suffix}"
-        self._peerid = f"EA2ULYEX7D6TG4MA{suffix}"
+        # name and peer id are derived from it when needed (auth message, logs)
+        self._suffix = secrets.randbits(64)
+        self._slot = app_state.agent_counters.add_agent(self._suffix)  # in app_state.agent_counters
 
         self._reader: Optional[asyncio.StreamReader] = None
         self._writer: Optional[asyncio.StreamWriter] = None
+        self._protocol: Optional[AgentProtocol] = None  # instead of reader/writer with config.transport "protocol"
 
         self._ready = False
+        self._closing = False  # closed on purpose, not a lost connection
+        self._dropped = False  # connection cut by drop(), not counted as an error
+        self._lost_at = 0.0  # time.monotonic() of the loss, until approved again
+        self._sessions = 0  # approved connections so far
         self._confirmationId = 1
-        self._confirmationFuture: Optional[asyncio.Future] = None
-        self._last_send_monotonic: float = 0.0
+
+        # Batches in flight: confirmId -> (time latency counts from, write time), in send order; at most
+        # config.window of them. Confirms are matched by id, so a late or lost one can't take the place of
+        # another batch. In open loop latency counts from the planned send time, but the confirm timeout
+        # always runs from the write: under backlog a batch written late is not timed out at once.
+        self._inflight: dict[int, tuple[float, float]] = {}
+        self._window_waiter: Optional[asyncio.Future] = None
+        self._spam_task: Optional[asyncio.Task] = None  # created when traffic starts
 
     @property
     def ready(self): return self._ready
 
+    @property
+    def name(self) -> str:
+        return f"FakeAgent_{self._suffix:016X}"
+
+    @property
+    def peerid(self) -> str:
+        return f"EA2ULYEX7D6TG4MA{self._suffix:016X}"
+
     def _log(self, msg):  # enable as needed
-        logging.info("[%s] %s", self._name, msg)
+        logging.info("[%s] %s", self.name, msg)
         return
 
     def _error(self, msg, exc: Optional[BaseException] = None):
         if exc:
-            logging.error("[%s] %s: %s", self._name, msg, exc)
+            logging.error("[%s] %s: %s", self.name, msg, exc)
         else:
-            logging.error("[%s] %s", self._name, msg)
+            logging.error("[%s] %s", self.name, msg)
 
-    async def connect(self):
+    async def connect(self, handshake_slots: Optional[asyncio.Semaphore] = None):
+        # handshake_slots bounds agents that are between TCP connect and auth approval (see ConnectionRamp)
+        slot_held = False
         try:
+            if handshake_slots is not None:
+                await handshake_slots.acquire()
+                slot_held = True
             #self._log("Connecting...")
-            self._reader, self._writer = await asyncio.open_connection(
-                self._config.host, self._config.port, ssl=self._config.ssl_context
-            )
-            
-            auth_msg = AgentMessageHelper.make_id_msg(self._name, self._peerid, self._config.token) 
-            await AgentMessageHelper.send_id_message(self._writer, auth_msg)
+            if self._sessions:
+                self._reset_inflight()  # batches of the lost connection won't be confirmed
+            started = time.monotonic()
+            tcp_time, tls_time = await self._open_connection()
+
+            # not kept in a local: this frame lives as long as the connection
+            if self._protocol is not None:
+                # frames are handled in AgentProtocol callbacks: this task only waits for approval and the end
+                protocol = self._protocol
+                protocol.write_message(AgentMessageHelper.make_id_msg(self.name, self.peerid, self._config.token))
+                await protocol.approved
+                if slot_held:
+                    handshake_slots.release()
+                    slot_held = False
+                self._on_approved(started, tcp_time, tls_time)
+                exc = await protocol.closed
+                if not self._closing and not self._app_state.stopped:
+                    raise exc or ConnectionError("Connection closed by server")
+                return
+
+            await AgentMessageHelper.send_message(
+                self._writer, AgentMessageHelper.make_id_msg(self.name, self.peerid, self._config.token))
 
             while not self._app_state.stopped:
                 msg = await AgentMessageHelper.read_message(self._reader)
 
                 if '"subsystem":"auth"' in msg and '"status":"approved"' in msg:
                     if not self._ready:
-                        self._ready = True
-                        self._app_state.on_agent_approved()
-                        asyncio.create_task(self._start_spam())
+                        if slot_held:
+                            handshake_slots.release()
+                            slot_held = False
+                        self._on_approved(started, tcp_time, tls_time)
+                elif '"subsystem":"auth"' in msg and '"error":1' in msg:
+                    raise Exception(f"Auth not approved: {msg}")
                 elif '"m":"confirm"' in msg:
-                    # record latency for the last batch
-                    if self._last_send_monotonic > 0.0:
-                        latency = datetime.datetime.now().timestamp() - self._last_send_monotonic
-                        self._app_state.on_confirm_latency(latency)
-                        self._app_state.on_confirm()
-                    # record confirmation for the last batch
-                    if self._confirmationFuture and not self._confirmationFuture.done():
-                        self._confirmationFuture.set_result(None)
+                    self._on_confirm(AgentMessageHelper.parse_confirm_id(msg))
 
         except Exception as ex:
-            if not self._app_state.stopped:
-                # Log the error, update stats, and return to stop the loop
-                self._app_state.on_error()
-                self._error("Lost connection", ex)
+            if not self._app_state.stopped and not self._closing:
+                # Log the error, update stats, and return to stop the loop. A drop is no error,
+                # and neither are failed reconnects: the loss was counted once already
+                if not self._dropped and not self._lost_at:
+                    self._on_error()
+                    self._error("Lost connection", ex)
+                self._dropped = False
+                if not self._lost_at:
+                    self._lost_at = time.monotonic()
                 await self.disconnect()
                 return
+        finally:
+            if slot_held:
+                handshake_slots.release()
+
+    async def _connect_reconnecting(self, handshake_slots: Optional[asyncio.Semaphore] = None):
+        # config.reconnect: connect again after every loss, with exponential backoff and full jitter;
+        # the backoff grows with attempts that fail before approval and starts over after one
+        failures = 0
+        while True:
+            sessions = self._sessions
+            await self.connect(handshake_slots)
+            if self._app_state.stopped or self._closing:
+                return
+            failures = 0 if self._sessions > sessions else failures + 1
+            if not self._lost_at:
+                self._lost_at = time.monotonic()  # refused before the connection was up
+            backoff = min(self._config.backoff_max, self._config.backoff_base * 2 ** min(failures, 30))
+            # on the shared scheduler, so stopping the run ends the wait
+            until = time.monotonic() + random.uniform(0, backoff)
+            while time.monotonic() < until:
+                if self._app_state.stopped or self._closing:
+                    return
+                await self._app_state.send_scheduler.wait_until(until)
+            if self._app_state.stopped or self._closing:
+                return
+
+    def drop(self) -> None:
+        # cut the connection without a goodbye, as a network failure would; the read side sees the
+        # loss and ends connect(), and a reconnecting agent dials again
+        transport = self._protocol.transport if self._protocol is not None else (
+            self._writer.transport if self._writer is not None else None)
+        if transport is None or not self._ready:
+            return
+        self._dropped = True
+        self._lost_at = time.monotonic()
+        transport.abort()
+
+    def _reset_inflight(self) -> None:
+        self._inflight.clear()
+
+    def _on_approved(self, started: float, tcp_time: float, tls_time: float) -> None:
+        transport = self._protocol.transport if self._protocol is not None else self._writer
+        ssl_object = transport.get_extra_info('ssl_object')
+        if isinstance(self._config.ssl_context, ResumableSSLContext):
+            self._config.ssl_context.remember_session(ssl_object)
+        self._app_state.on_connect_phases(
+            tcp_time, tls_time, time.monotonic() - started - tcp_time - tls_time,
+            ssl_object is not None and ssl_object.session_reused)
+
+        self._sessions += 1
+        if self._lost_at:
+            self._app_state.on_reconnected(time.monotonic() - self._lost_at)
+            self._lost_at = 0.0
+        self._ready = True
+        self._app_state.on_agent_approved()
+        self._app_state.call_when_ready(self._begin_spam)
+
+    async def _open_connection(self) -> tuple[float, float]:
+        # TCP connect and TLS handshake done separately to time each phase
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        family, type_, proto, _, address = (await loop.getaddrinfo(
+            self._config.host, self._config.port, type=socket.SOCK_STREAM))[0]
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        connected = time.monotonic()
+
+        ssl_ctx = self._config.ssl_context
+        server_hostname = self._config.host if ssl_ctx else None
+        if ssl_ctx:
+            set_tls_read_buffer(self._config.tls_read_buffer)
+        if self._config.transport == "protocol":
+            _, self._protocol = await loop.create_connection(
+                lambda: AgentProtocol(self), sock=sock, ssl=ssl_ctx, server_hostname=server_hostname)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(
+                sock=sock, ssl=ssl_ctx, server_hostname=server_hostname)
+        return connected - started, time.monotonic() - connected
 
     async def disconnect(self):
+        if self._ready:
+            self._app_state.on_agent_disconnected()
         self._ready = False
         try:
-            if self._confirmationFuture and not self._confirmationFuture.done():
-                self._confirmationFuture.set_result(None)
+            self._wake_sender()
+            if self._protocol:
+                self._protocol.close()
+                await self._protocol.closed
             if self._writer:
                 self._writer.close()
                 await self._writer.wait_closed()
@@ -324,63 +1402,315 @@ class AgentSocket:
                 self._error("Error closing writer", ex)
         self._writer = None
         self._reader = None
+        self._protocol = None
 
-    async def start(self) -> None:
-        await self.connect()
+    def start(self, handshake_slots: Optional[asyncio.Semaphore] = None) -> Coroutine:
+        # the connect coroutine itself, no wrapper frame kept per agent unless it reconnects
+        if self._config.reconnect:
+            return self._connect_reconnecting(handshake_slots)
+        return self.connect(handshake_slots)
 
-    async def _start_spam(self) -> None:
-        # wait until all agents approved
-        while not self._app_state.ready:
-            await asyncio.sleep(1)
+    async def close(self) -> None:
+        # take this agent out of a running test (pool shrinks), not counted as an error
+        self._closing = True
+        self._app_state.agent_counters.active[self._slot] = 0
+        await self.disconnect()
+
+    def _begin_spam(self) -> None:
+        # called once all agents are approved (AppState.call_when_ready): one send task per agent from here on
+        if not self._config.self_paced:
+            return
+        if self._ready and (self._spam_task is None or self._spam_task.done()):
+            self._spam_task = asyncio.create_task(
+                self._start_spam_open_loop() if self._config.open_loop else self._start_spam())
 
-        # small delay to stagger
-        await asyncio.sleep(1)
+    async def _start_spam(self) -> None:
+        # random delay to stagger, so agents don't start in lockstep
+        await asyncio.sleep(self._start_offset())
         #self._log(f"Start to send messages. EPS per agent={self._app_state.rate_limit_per_agent_eps}")
 
-        events_per_batch = self._config.batch_size
+        scheduler = self._app_state.send_scheduler
         while self._ready:
-            # honor "one in flight" rule
-            if self._confirmationFuture:
-                await self._confirmationFuture
+            # honor send window: no more than config.window batches in flight
+            await self._wait_send_window()
 
-            if self._app_state.stopped:
+            if self._app_state.stopped or not self._ready:
                 return
-            
-            # honor change rate
-            while self._app_state.is_changing_rate():
-                await asyncio.sleep(0.1)
 
-            start_send_time = datetime.datetime.now().timestamp()
+            # read every time: batch size may change between sweep cells
+            events_per_batch = self._events_per_batch()
+
+            start_send_time = time.monotonic()
             try:
                 await self._send_next_events_batch(events_per_batch)
             except Exception as ex:
                 if not self._app_state.stopped:
                     # Log the error, update stats, and return to stop the loop
-                    self._app_state.on_error()
+                    self._on_error()
                     self._error("Error on send events", ex)
                     return 0.0
-            end_send_time = datetime.datetime.now().timestamp()
-
-            # check if rate limit per agent is being honored
-            per_agent_eps = self._app_state.rate_limit_per_agent_eps
-            seconds_per_batch = (events_per_batch / per_agent_eps) if per_agent_eps > 0 else 0.0
-            if seconds_per_batch > 0:
-                #if passed_seconds > seconds_per_batch:
-                #    self._app_state.on_low_send_rate()
-                # Not an error!? - self._app_state.on_error()
-                sleep_time = max(0.0, seconds_per_batch - (end_send_time - start_send_time))
-                await asyncio.sleep(sleep_time)
-
-    async def _send_next_events_batch(self, events_per_batch: int) -> float:
+
+            # honor rate limit per agent: the next send is one batch interval after this one.
+            # A rate change wakes the agent early and the interval is taken again at the new rate.
+            while self._ready and not self._app_state.stopped:
+                per_agent_eps = self._per_agent_eps()
+                if per_agent_eps <= 0:
+                    break
+                next_send_time = start_send_time + events_per_batch / per_agent_eps
+                if self._fleet_index >= 0:
+                    next_send_time = self._app_state.fleet.next_on(self._fleet_index, next_send_time)
+                if next_send_time <= time.monotonic():
+                    break
+                await scheduler.wait_until(next_send_time)
+
+    async def _start_spam_open_loop(self) -> None:
+        await asyncio.sleep(self._start_offset())
+        scheduler = self._app_state.send_scheduler
+        previous = time.monotonic()
+        # random phase, so agents don't send in lockstep
+        per_agent_eps = self._per_agent_eps()
+        intended = previous
+        if per_agent_eps > 0:
+            intended += random.random() * self._events_per_batch() / per_agent_eps
+
+        while self._ready:
+            await scheduler.wait_until(intended)
+            if time.monotonic() < intended and not self._app_state.stopped:
+                # woken by a rate change: re-plan from the previous send at the new rate
+                intended = self._next_intended(previous, self._events_per_batch())
+                continue
+
+            # a late send (window full, slow server) keeps its planned time, and the
+            # following sends catch up; latency is measured from the planned time
+            await self._wait_send_window()
+            if self._app_state.stopped or not self._ready:
+                return
+
+            events_per_batch = self._events_per_batch()
+            try:
+                await self._send_next_events_batch(events_per_batch, intended)
+            except Exception as ex:
+                if not self._app_state.stopped:
+                    # Log the error, update stats, and return to stop the loop
+                    self._on_error()
+                    self._error("Error on send events", ex)
+                return
+
+            previous = intended
+            intended = self._next_intended(previous, events_per_batch)
+
+    def _next_intended(self, previous: float, events_per_batch: int) -> float:
+        per_agent_eps = self._per_agent_eps()
+        if per_agent_eps <= 0:
+            return time.monotonic()
+        intended = previous + events_per_batch / per_agent_eps
+        if self._fleet_index >= 0:
+            # an off period of a bursty agent is planned silence, not a late send
+            intended = self._app_state.fleet.next_on(self._fleet_index, intended)
+        return intended
+
+    def _events_per_batch(self) -> int:
+        if self._fleet_index >= 0:
+            return self._app_state.fleet.batch[self._fleet_index]
+        return self._config.batch_size
+
+    def _per_agent_eps(self) -> float:
+        if self._fleet_index >= 0:
+            return self._app_state.rate_limit_per_agent_eps * self._app_state.fleet.rate_factor[self._fleet_index]
+        return self._app_state.rate_limit_per_agent_eps
+
+    def _start_offset(self) -> float:
+        if self._fleet_index >= 0:
+            return self._app_state.fleet.start_offset[self._fleet_index]
+        return random.random()
+
+    def _on_error(self) -> None:
+        self._app_state.on_error()
+        self._app_state.agent_counters.errors[self._slot] += 1
+        if self._fleet_index >= 0:
+            self._app_state.fleet.on_error(self._fleet_index)
+
+    async def _send_next_events_batch(self, events_per_batch: int, intended: Optional[float] = None) -> float:
+        sent_at = self._write_events_batch(events_per_batch, intended)
+        protocol = self._protocol
+        if protocol is not None:
+            if protocol.paused:
+                await protocol.wait_writable()
+        elif self._writer is not None:
+            await self._writer.drain()
+        self._on_batch_sent(events_per_batch)
+        return sent_at
+
+    def replay_send(self, events_per_batch: int, intended: float) -> bool:
+        # one batch of a replayed trace (agent_trace.py), written without waiting: the trace sets the pace,
+        # so a slow socket doesn't hold the replay back. False when not sent: the agent is not connected,
+        # or its window is still full once timed-out batches are expired
+        if not self._ready or self._app_state.stopped:
+            return False
+        if len(self._inflight) >= self._config.window:
+            self._expire_inflight()
+            if len(self._inflight) >= self._config.window:
+                return False
+        try:
+            self._write_events_batch(events_per_batch, intended)
+        except Exception as ex:
+            self._on_error()
+            self._error("Error on send events", ex)
+            return False
+        self._on_batch_sent(events_per_batch)
+        return True
+
+    def _write_events_batch(self, events_per_batch: int, intended: Optional[float]) -> float:
+        # the batch goes into the transport buffer and its window slot; returns the time latency counts from
         self._confirmationId += 1
-        loop = asyncio.get_running_loop()
-        self._confirmationFuture = loop.create_future()
+        confirmation_id = self._confirmationId
 
-        batch_msg = AgentMessageHelper.make_events_batch(
-            events_per_batch, self._confirmationId
+        batch_frame = AgentMessageHelper.make_events_batch_frame(
+            events_per_batch, confirmation_id, self._config.payloads
         )
-        self._last_send_monotonic = datetime.datetime.now().timestamp()
-        await AgentMessageHelper.send_message(self._writer, batch_msg)
+        written_at = time.monotonic()
+        sent_at = written_at if intended is None else intended
+        self._inflight[confirmation_id] = (sent_at, written_at)
+        if self._protocol is not None:
+            self._protocol.write_frame(batch_frame)
+        elif self._writer is not None:
+            # writelines lets the TLS transport consume the cached batch body without joining it first
+            self._writer.writelines(batch_frame)
+        return sent_at
+
+    def _on_batch_sent(self, events_per_batch: int) -> None:
+        self._app_state.on_batch_sent(events_per_batch)
+        counters = self._app_state.agent_counters
+        counters.batches[self._slot] += 1
+        counters.events[self._slot] += events_per_batch
+        if self._fleet_index >= 0:
+            self._app_state.fleet.on_sent(self._fleet_index)
+        if self._app_state.trace is not None:
+            self._app_state.trace.record(self._suffix, events_per_batch)
+
+    def sample_counters(self, now: float) -> None:
+        # batches waiting for a confirm, and whether the agent is due to send: connected, self paced
+        # (a replayed agent sends only what the trace has), not in the off period of a bursty agent
+        counters = self._app_state.agent_counters
+        counters.inflight[self._slot] = len(self._inflight)
+        due = self._ready and self._config.self_paced
+        if due and self._fleet_index >= 0:
+            due = not self._app_state.fleet.is_off(self._fleet_index, now)
+        counters.due[self._slot] = due
+
+    def _oldest_inflight(self) -> Optional[int]:
+        # lowest confirmId still waiting for confirm
+        return next(iter(self._inflight), None)
+
+    def _on_confirm(self, confirmation_id: Optional[int]) -> None:
+        if confirmation_id is None:
+            # server did not echo our id: confirms come in order, take the oldest
+            confirmation_id = self._oldest_inflight()
+            if confirmation_id is None:
+                return
+        inflight = self._inflight.pop(confirmation_id, None)
+        if inflight is None:
+            return  # the batch already timed out (counted as an error then), or belongs to a lost connection
+
+        latency = time.monotonic() - inflight[0]
+        self._app_state.on_confirm_latency(latency)
+        self._app_state.on_confirm()
+        counters = self._app_state.agent_counters
+        counters.confirms[self._slot] += 1
+        counters.lat_sum[self._slot] += latency
+        if latency > counters.lat_max[self._slot]:
+            counters.lat_max[self._slot] = latency
+        if self._fleet_index >= 0:
+            self._app_state.fleet.on_confirm(self._fleet_index, latency)
+        self._wake_sender()
+
+    def _expire_inflight(self) -> None:
+        # confirms that never arrive free their window slot after config.confirm_timeout
+        deadline = time.monotonic() - self._config.confirm_timeout
+        inflight = self._inflight
+        while inflight:
+            confirmation_id = next(iter(inflight))
+            if inflight[confirmation_id][1] > deadline:
+                return
+            del inflight[confirmation_id]
+            self._on_error()
+            self._error(f"No confirm for batch {confirmation_id} in {self._config.confirm_timeout:g} sec")
+
+    async def _wait_send_window(self) -> None:
+        while self._ready and len(self._inflight) >= self._config.window:
+            self._expire_inflight()
+            confirmation_id = self._oldest_inflight()
+            if len(self._inflight) < self._config.window or confirmation_id is None:
+                return
+            timeout = self._inflight[confirmation_id][1] + self._config.confirm_timeout - time.monotonic()
+            # a plain timer instead of asyncio.wait_for, which costs a waiter, a timer and callbacks per batch
+            loop = asyncio.get_running_loop()
+            self._window_waiter = loop.create_future()
+            timer = loop.call_later(max(0.0, timeout), self._wake_sender)
+            try:
+                await self._window_waiter
+            finally:
+                timer.cancel()
+                self._window_waiter = None
+
+    def _wake_sender(self) -> None:
+        if self._window_waiter and not self._window_waiter.done():
+            self._window_waiter.set_result(None)
+
+class ConnectionRamp:
+    # Starts agents at config.spawn_rate per sec, with at most config.handshake_limit of them between
+    # TCP connect and auth approval, and reports how long each connection phase took.
+    def __init__(self, config: AgentConfig, app_state: AppState, share: float = 1.0) -> None:
+        # share: part of the run's agents started by this ramp (worker processes split the limits)
+        self._config = config
+        self._app_state = app_state
+        self._spawn_rate = config.spawn_rate * share
+        handshake_limit = max(1, round(config.handshake_limit * share)) if config.handshake_limit > 0 else 0
+        self._slots = asyncio.Semaphore(handshake_limit) if handshake_limit > 0 else None
+        self._tasks: list[asyncio.Task] = []
+        self._spawn_task: Optional[asyncio.Task] = None
+
+    @property
+    def tasks(self) -> list[asyncio.Task]:
+        return self._tasks
+
+    def start(self, agents: list[AgentSocket]) -> None:
+        self._spawn_task = asyncio.create_task(self._spawn(agents))
+
+    async def join(self) -> None:
+        if self._spawn_task and not self._spawn_task.done():
+            self._spawn_task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _spawn(self, agents: list[AgentSocket]) -> None:
+        started = time.monotonic()
+        approved_before = self._app_state.agents_approved  # ramp may add agents to a running pool
+        for i, agent in enumerate(agents):
+            if self._app_state.stopped:
+                return
+            if self._spawn_rate > 0:
+                delay = started + i / self._spawn_rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self._tasks.append(asyncio.create_task(agent.start(self._slots)))
+
+        # report once every agent is approved or gave up
+        last_log = time.monotonic()
+        while not self._app_state.stopped:
+            done = sum(1 for task in self._tasks if task.done())
+            approved = self._app_state.agents_approved - approved_before
+            if approved + done >= len(agents):
+                break
+            if time.monotonic() - last_log >= 5:
+                last_log = time.monotonic()
+                logging.info("Ramp: %d/%d agents approved, %d failed", approved, len(agents), done)
+            await asyncio.sleep(0.5)
 
-        self._app_state.on_batch_sent()
-        return self._last_send_monotonic
+        tcp, tls, auth, resumed = self._app_state.connect_stats()
+        logging.info(
+            "Ramp done in %.1f sec: %d/%d agents approved. p50/p95/p99 tcp=%.3f/%.3f/%.3fs, "
+            "tls=%.3f/%.3f/%.3fs (resumed %d), auth=%.3f/%.3f/%.3fs",
+            time.monotonic() - started, self._app_state.agents_approved - approved_before, len(agents),
+            tcp.percentile(50), tcp.percentile(95), tcp.percentile(99),
+            tls.percentile(50), tls.percentile(95), tls.percentile(99), resumed,
+            auth.percentile(50), auth.percentile(95), auth.percentile(99))
@@ -0,0 +1,234 @@
+import json
+import logging
+import math
+import random
+import time
+from typing import Optional
+from agent_common import FileHelper, LatencyHistogram
+from agent_payloads import make_distribution
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# -----------------------------
+# Heterogeneous agent fleet
+# -----------------------------
+# A fleet is a list of profile classes; every agent gets one class and its own parameters drawn from it:
+#   {"seed": 1, "classes": [
+#     {"name": "noisy",  "share": 0.02, "rate": "pareto:1.5", "batch": [1000]},
+#     {"name": "steady", "share": 0.78, "rate": "lognorm:1,0.3", "batch": {"10": 1, "100": 3}},
+#     {"name": "bursty", "share": 0.2,  "rate": "lognorm:1,1", "batch": [100], "on_sec": "exp:20", "off_sec": "exp:60"}]}
+# share: part of the agents; rate: distribution of the agent's relative rate (const:N, uniform:A,B, exp:MEAN,
+# lognorm:MEDIAN,SIGMA, pareto:ALPHA[,MIN]), scaled so that the whole fleet offers the scenario's total EPS;
+# batch: batch sizes, a list (equally likely) or {size: weight}; on_sec/off_sec: bursty agents send only
+# in on periods, period lengths drawn from these distributions.
+DEFAULT_FLEET = {
+    "classes": [
+        {"name": "noisy", "share": 0.02, "rate": "pareto:1.5", "batch": [1000]},
+        {"name": "steady", "share": 0.78, "rate": "lognorm:1,0.5", "batch": {"10": 1, "100": 3}},
+        {"name": "bursty", "share": 0.2, "rate": "lognorm:1,1", "batch": [100], "on_sec": "exp:20", "off_sec": "exp:60"},
+    ],
+}
+
+CLASS_TITLES = ('Phase', 'Class', 'Agents', 'Target Eps', 'Confirmed Eps', 'P50', 'P95', 'P99', 'Errors', 'Err Rate')
+
+def sample(spec: str, rng, count: int):
+    # count values of a distribution spec as a NumPy array
+    kind, _, params = spec.partition(':')
+    values = [float(x) for x in params.split(',') if x]
+    if kind == 'const':
+        return np.full(count, values[0] if values else 1.0)
+    if kind == 'uniform':
+        return rng.uniform(values[0], values[1], count)
+    if kind == 'exp':
+        return rng.exponential(values[0], count)
+    if kind == 'lognorm':
+        return rng.lognormal(math.log(values[0]), values[1], count)
+    if kind == 'pareto':
+        return (rng.pareto(values[0], count) + 1.0) * (values[1] if len(values) > 1 else 1.0)
+    raise ValueError(f"Unknown distribution: {spec}")
+
+class ClassWindow:
+    # traffic of one profile class since the last take_window()
+    def __init__(self) -> None:
+        self.lats = LatencyHistogram()
+        self.batches_sent = 0
+        self.confirms = 0
+        self.events_confirmed = 0
+        self.errors = 0
+
+    def merge(self, other: "ClassWindow") -> None:
+        self.lats.merge(other.lats)
+        self.batches_sent += other.batches_sent
+        self.confirms += other.confirms
+        self.events_confirmed += other.events_confirmed
+        self.errors += other.errors
+
+class Fleet:
+    # Per-agent profiles for the whole run, drawn at once as NumPy arrays from the seed, so every
+    # worker process builds the same fleet and keeps its own slice [offset, offset + count).
+    # Agents read them from plain lists: a list index is cheaper than a NumPy scalar on the send path.
+    def __init__(self, spec: dict, agents_count: int, offset: int = 0, count: Optional[int] = None) -> None:
+        if np is None:
+            raise Exception("NumPy is needed for fleet profiles: pip install numpy")
+        classes = spec["classes"]
+        if not classes:
+            raise ValueError("Fleet has no classes")
+        self.names = [c["name"] for c in classes]
+        rng = np.random.default_rng(spec.get("seed", 0))
+        n = agents_count
+
+        # class of every agent: shares rounded by largest remainder, then shuffled so that
+        # every worker slice gets its part of each class
+        shares = np.array([float(c.get("share", 1)) for c in classes])
+        shares = shares / shares.sum() * n
+        counts = np.floor(shares).astype(np.int64)
+        counts[np.argsort(counts - shares)[:n - counts.sum()]] += 1
+        cls = np.repeat(np.arange(len(classes)), counts)
+        rng.shuffle(cls)
+
+        weight = np.empty(n)
+        batch = np.empty(n, dtype=np.int64)
+        duty = np.ones(n)
+        self._on_len = []
+        self._off_len = []
+        for k, c in enumerate(classes):
+            idx = np.flatnonzero(cls == k)
+            weight[idx] = sample(c.get("rate", "const:1"), rng, len(idx))
+            sizes = c.get("batch", [100])
+            if isinstance(sizes, dict):
+                sizes, probs = [int(size) for size in sizes], np.array([float(w) for w in sizes.values()])
+            else:
+                sizes, probs = [int(size) for size in sizes], np.ones(len(sizes))
+            batch[idx] = rng.choice(sizes, size=len(idx), p=probs / probs.sum())
+            if "on_sec" in c:
+                on_mean = sample(c["on_sec"], rng, 10000).mean()
+                off_mean = sample(c.get("off_sec", c["on_sec"]), rng, 10000).mean()
+                duty[idx] = on_mean / (on_mean + off_mean)
+                self._on_len.append(make_distribution(c["on_sec"]))
+                self._off_len.append(make_distribution(c.get("off_sec", c["on_sec"])))
+            else:
+                self._on_len.append(None)
+                self._off_len.append(None)
+
+        # rate factor: the agent's EPS over the per-agent average; duty cycles are counted in,
+        # so the fleet as a whole offers the total budget
+        factor = weight * n / (weight * duty).sum()
+        # bursty agents start at a random point of their on/off cycle: on with the duty cycle probability,
+        # in a period drawn in proportion to its length (a random moment more likely falls in a long one)
+        bursty = duty < 1.0
+        on = rng.random(n) < duty
+        left = np.zeros(n)
+        for k, c in enumerate(classes):
+            if self._on_len[k] is not None:
+                idx = np.flatnonzero(cls == k)
+                on_len = self._length_biased(sample(c["on_sec"], rng, 10000), rng, len(idx))
+                off_len = self._length_biased(sample(c.get("off_sec", c["on_sec"]), rng, 10000), rng, len(idx))
+                left[idx] = np.where(on[idx], on_len, off_len) * rng.random(len(idx))
+        start = rng.random(n)  # first send offset in sec, so agents don't start in lockstep
+
+        # expected part of the total EPS and events per batch, per class and overall
+        offered = factor * duty
+        self.class_agents = np.bincount(cls, minlength=len(classes)).tolist()
+        self.class_share = (np.bincount(cls, weights=offered, minlength=len(classes)) / n).tolist()
+        self.events_per_batch = float(offered.sum() / (offered / batch).sum())
+
+        end = n if count is None else offset + count
+        now = time.monotonic()
+        self.cls = cls[offset:end].tolist()
+        self.rate_factor = factor[offset:end].tolist()
+        self.expected_share = offered[offset:end].tolist()  # part of the per-agent average EPS, duty cycle counted in
+        self.batch = batch[offset:end].tolist()
+        self.start_offset = start[offset:end].tolist()
+        self._bursty = bursty[offset:end].tolist()
+        self._on = on[offset:end].tolist()
+        self._period_end = (now + left[offset:end]).tolist()
+
+        self._windows = [ClassWindow() for _ in classes]
+        self._window_started = now
+        self.events_confirmed = 0  # all classes, for the run: the measured EPS (see AppState.events_confirmed)
+
+    @staticmethod
+    def _length_biased(lengths, rng, count: int):
+        return rng.choice(lengths, size=count, p=lengths / lengths.sum())
+
+    def describe(self) -> str:
+        return ", ".join("%s: %d agents, %.0f%% of EPS" % (name, agents, share * 100)
+                         for name, agents, share in zip(self.names, self.class_agents, self.class_share))
+
+    def next_on(self, i: int, t: float) -> float:
+        # earliest time from t on that agent i may send: t itself, unless a bursty agent is off then
+        if not self._bursty[i]:
+            return t
+        on, end = self._on[i], self._period_end[i]
+        if t >= end:
+            k = self.cls[i]
+            while t >= end:
+                on = not on
+                end += max(0.001, (self._on_len[k] if on else self._off_len[k])(random))
+            self._on[i], self._period_end[i] = on, end
+        return t if on else end
+
+    def is_off(self, i: int, t: float) -> bool:
+        # agent i is in an off period at t, as far as its current period tells (read only, unlike next_on:
+        # a period that ended is taken to have flipped once)
+        if not self._bursty[i]:
+            return False
+        return self._on[i] if t >= self._period_end[i] else not self._on[i]
+
+    # per-class stats, called by the agents
+    def on_sent(self, i: int) -> None:
+        self._windows[self.cls[i]].batches_sent += 1
+
+    def on_confirm(self, i: int, seconds: float) -> None:
+        window = self._windows[self.cls[i]]
+        window.lats.record(seconds)
+        window.confirms += 1
+        window.events_confirmed += self.batch[i]
+        self.events_confirmed += self.batch[i]
+
+    def on_error(self, i: int) -> None:
+        self._windows[self.cls[i]].errors += 1
+
+    def take_window(self) -> tuple[list[ClassWindow], float]:
+        # class windows and their length in sec; a new window starts
+        windows, self._windows = self._windows, [ClassWindow() for _ in self.names]
+        now = time.monotonic()
+        elapsed, self._window_started = now - self._window_started, now
+        return windows, elapsed
+
+    def merge_window(self, windows: list[ClassWindow]) -> None:
+        # adds class windows taken elsewhere (a worker process) to the current ones
+        for window, other in zip(self._windows, windows):
+            window.merge(other)
+            self.events_confirmed += other.events_confirmed
+
+    def report(self, phase: str, eps: float, save_to: Optional[str] = None) -> None:
+        # log line and results row per class for the window that ends now
+        windows, seconds = self.take_window()
+        for name, agents, share, window in zip(self.names, self.class_agents, self.class_share, windows):
+            confirmed_eps = window.events_confirmed / seconds if seconds > 0 else 0.0
+            err_rate = window.errors / max(1, window.confirms + window.errors)
+            lats = window.lats
+            logging.info("  class %s (%d agents): target=%.0f, confirmed_eps=%.0f, p50/p95/p99=%.3f/%.3f/%.3fs, "
+                         "errors=%d (err_rate=%.3f)", name, agents, eps * share, confirmed_eps,
+                         lats.percentile(50), lats.percentile(95), lats.percentile(99), window.errors, err_rate)
+            if save_to:
+                FileHelper.save_results_csv(save_to, CLASS_TITLES, [
+                    phase, name, agents, "%d" % (eps * share), "%d" % confirmed_eps, "%.3f" % lats.percentile(50),
+                    "%.3f" % lats.percentile(95), "%.3f" % lats.percentile(99), window.errors, "%.4f" % err_rate])
+
+def load_fleet(path: str) -> dict:
+    # "default": DEFAULT_FLEET; otherwise JSON, or YAML when PyYAML is installed
+    if path == "default":
+        return DEFAULT_FLEET
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("PyYAML is needed for YAML fleets: pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
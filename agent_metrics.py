@@ -0,0 +1,251 @@
+import array
+import asyncio
+import json
+import logging
+import struct
+import sys
+import time
+from typing import Callable, Optional
+from agent_common import AppState, LatencyHistogram
+
+# -----------------------------
+# Per-second metrics stream
+# -----------------------------
+METRICS_COLUMNS = (
+    "ts", "sent", "confirmed", "errors", "events_sent", "confirmed_eps",
+    "p50", "p90", "p95", "p99", "max", "active_agents", "target_eps",
+)
+
+class JsonlMetricsWriter:
+    # one JSON object per line, easy to grep and to load with pandas.read_json(lines=True)
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        with open(self._path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(dict(zip(METRICS_COLUMNS, row)), separators=(',', ':')))
+                f.write('\n')
+
+class ColumnarMetricsWriter:
+    # Binary file: MAGIC, header line with the column names (JSON), then blocks.
+    # Block: uint32 row count, then every column as row count float64 values (little endian).
+    MAGIC = b"LTMETRICS1\n"
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._header_written = False
+
+    def write_rows(self, rows: list[tuple]) -> None:
+        with open(self._path, 'ab') as f:
+            if not self._header_written:
+                if f.tell() == 0:
+                    f.write(self.MAGIC)
+                    f.write(json.dumps(METRICS_COLUMNS).encode() + b"\n")
+                self._header_written = True
+            f.write(struct.pack("<I", len(rows)))
+            for i in range(len(METRICS_COLUMNS)):
+                column = array.array('d', (float(row[i]) for row in rows))
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                f.write(column.tobytes())
+
+    @classmethod
+    def read(cls, path: str) -> dict[str, array.array]:
+        with open(path, 'rb') as f:
+            if f.readline() != cls.MAGIC:
+                raise ValueError(f"{path} is not a metrics file")
+            columns = json.loads(f.readline())
+            result = {name: array.array('d') for name in columns}
+            while True:
+                size = f.read(4)
+                if len(size) < 4:
+                    return result
+                rows = struct.unpack("<I", size)[0]
+                for name in columns:
+                    column = array.array('d')
+                    column.frombytes(f.read(8 * rows))
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    result[name].extend(column)
+
+def load_metrics(path: str) -> dict[str, list]:
+    # either format -> {column: values}
+    with open(path, 'rb') as f:
+        binary = f.read(len(ColumnarMetricsWriter.MAGIC)) == ColumnarMetricsWriter.MAGIC
+    if binary:
+        return {name: list(values) for name, values in ColumnarMetricsWriter.read(path).items()}
+    result = {name: [] for name in METRICS_COLUMNS}
+    with open(path) as f:
+        for line in f:
+            row = json.loads(line)
+            for name in METRICS_COLUMNS:
+                result[name].append(row.get(name))
+    return result
+
+class MetricsRecorder:
+    # Samples AppState once a second (on wall-clock second boundaries) and appends a row to
+    # the metrics file (path=None: no file, e.g. HTTP endpoint only). Rows are written in batches
+    # by a thread, never on the event loop. Listeners get (row, interval latencies) every second.
+    def __init__(self, app_state: AppState, path: Optional[str], fmt: str = "jsonl", flush_sec: float = 10.0) -> None:
+        self._app_state = app_state
+        self._writer = None
+        if path:
+            self._writer = ColumnarMetricsWriter(path) if fmt == "bin" else JsonlMetricsWriter(path)
+        self._flush_sec = flush_sec
+        self._rows: list[tuple] = []
+        self._listeners: list[Callable[[tuple, LatencyHistogram], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._pending_write: Optional[asyncio.Future] = None
+        self._endpoint: Optional["MetricsEndpoint"] = None
+        self.latest: Optional[tuple] = None  # last row, for live consumers
+
+    @property
+    def app_state(self) -> AppState:
+        return self._app_state
+
+    def add_listener(self, listener: Callable[[tuple, LatencyHistogram], None]) -> None:
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        self._app_state.take_interval_latencies()  # turn interval recording on
+        self._task = asyncio.create_task(self._run())
+
+    async def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        # OpenMetrics endpoint on this event loop, fed by this recorder
+        self._endpoint = MetricsEndpoint(self)
+        await self._endpoint.start(host, port)
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._endpoint:
+            await self._endpoint.stop()
+        await self._flush()
+        if self._pending_write:
+            await self._pending_write
+
+    async def _run(self) -> None:
+        last_totals = self._app_state.totals()
+        last_confirmed = self._app_state.events_confirmed()
+        last_time = time.time()
+        last_flush = last_time
+        while True:
+            await asyncio.sleep(1.0 - time.time() % 1.0)
+            now = time.time()
+            totals = self._app_state.totals()
+            confirmed_events = self._app_state.events_confirmed()
+            lats = self._app_state.take_interval_latencies()
+            self.latest = self._make_row(now, now - last_time, totals, last_totals, confirmed_events - last_confirmed,
+                                         lats)
+            if self._writer:
+                self._rows.append(self.latest)
+            for listener in self._listeners:
+                listener(self.latest, lats)
+            last_totals, last_confirmed, last_time = totals, confirmed_events, now
+            if now - last_flush >= self._flush_sec:
+                last_flush = now
+                await self._flush()
+
+    def _make_row(self, now: float, elapsed: float, totals: tuple, last_totals: tuple, confirmed_events: int,
+                  lats: LatencyHistogram) -> tuple:
+        # confirmed_events: of the confirmed batches, at their own sizes (AppState.events_confirmed)
+        app_state = self._app_state
+        sent, confirmed, errors, events = (t - l for t, l in zip(totals, last_totals))
+        confirmed_eps = confirmed_events / elapsed if elapsed > 0 else 0.0
+        return (round(now, 3), sent, confirmed, errors, events, round(confirmed_eps, 1),
+                lats.percentile(50), lats.percentile(90), lats.percentile(95), lats.percentile(99), lats.max,
+                app_state.agents_active, app_state.rate_limit_total_eps)
+
+    async def _flush(self) -> None:
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        if self._pending_write:
+            await self._pending_write  # keep rows in order
+        self._pending_write = asyncio.get_running_loop().run_in_executor(None, self._write, rows)
+
+    def _write(self, rows: list[tuple]) -> None:
+        try:
+            self._writer.write_rows(rows)
+        except OSError as ex:
+            logging.error("Can't write metrics: %s", ex)
+
+# -----------------------------
+# OpenMetrics endpoint
+# -----------------------------
+class MetricsEndpoint:
+    # GET /metrics in OpenMetrics text format. The page is rendered once a second when the recorder
+    # samples AppState; a scrape only writes the cached bytes, it never walks agents or histograms.
+    CONTENT_TYPE = b"application/openmetrics-text; version=1.0.0; charset=utf-8"
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, recorder: MetricsRecorder) -> None:
+        self._app_state = recorder.app_state
+        self._latencies = LatencyHistogram()  # whole run
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._page = b"# EOF\n"
+        recorder.add_listener(self._on_sample)
+
+    async def start(self, host: str, port: int) -> None:
+        self._app_state.loop_monitor.start()
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        logging.info("Metrics endpoint: http://%s:%d/metrics", host, port)
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def _on_sample(self, row: tuple, lats: LatencyHistogram) -> None:
+        self._latencies.merge(lats)
+        self._page = self._render(dict(zip(METRICS_COLUMNS, row))).encode()
+
+    def _render(self, row: dict) -> str:
+        app_state = self._app_state
+        batches_sent, confirms, errors, events_sent = app_state.totals()
+        lats = self._latencies
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]) -> None:
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help_text}")
+            for suffix, value in samples:
+                lines.append(f"{name}{suffix} {value}")
+
+        metric("ltgen_batches_sent", "counter", "Event batches sent.", [("_total", batches_sent)])
+        metric("ltgen_events_sent", "counter", "Events sent.", [("_total", events_sent)])
+        metric("ltgen_confirms", "counter", "Batches confirmed by the server.", [("_total", confirms)])
+        metric("ltgen_errors", "counter", "Batches without confirm in time.", [("_total", errors)])
+        buckets = [(f'_bucket{{le="{edge}"}}', count)
+                   for edge, count in zip(self.BUCKETS, lats.cumulative_counts(self.BUCKETS))]
+        buckets.append(('_bucket{le="+Inf"}', lats.count))
+        metric("ltgen_confirm_latency_seconds", "histogram", "Batch send to confirm latency.",
+               buckets + [("_count", lats.count), ("_sum", round(lats.sum, 6))])
+        metric("ltgen_agents_active", "gauge", "Approved and connected agents.", [("", app_state.agents_active)])
+        metric("ltgen_agents_approved", "counter", "Agents approved since start.", [("_total", app_state.agents_approved)])
+        metric("ltgen_target_eps", "gauge", "Target total events/sec.", [("", app_state.rate_limit_total_eps)])
+        metric("ltgen_confirmed_eps", "gauge", "Confirmed events/sec in the last second.", [("", row["confirmed_eps"])])
+        metric("ltgen_confirm_latency_p99_seconds", "gauge", "p99 confirm latency in the last second.", [("", row["p99"])])
+        metric("ltgen_loop_lag_seconds", "gauge", "Max event loop lag in the last second.",
+               [("", round(app_state.loop_monitor.take_max(), 6))])
+        lines.append("# EOF\n")
+        return "\n".join(lines)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, content_type, body = b"200 OK", self.CONTENT_TYPE, self._page
+            else:
+                status, content_type, body = b"404 Not Found", b"text/plain", b"Not found\n"
+            writer.write(b"HTTP/1.1 %b\r\nContent-Type: %b\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                         % (status, content_type, len(body)))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,226 @@
+import json
+import logging
+import math
+import random
+import string
+import time
+from itertools import accumulate
+from typing import Callable, Optional
+
+# -----------------------------
+# Event payload corpus
+# -----------------------------
+# A corpus is a weighted list of event types, each with the attributes of its "data" object:
+#   {"pool_size": 4096, "seed": 1, "events": [
+#     {"e": "FileChanged", "src": "Sync", "t": 1, "eid": 10, "weight": 60, "data": {
+#       "path":   {"text": "lognorm:60,0.5", "cardinality": 100000, "skew": 1.1},
+#       "size":   {"int": [0, 10000000]},
+#       "folder": {"enum": ["Documents", "Projects", "Shared"]}}}]}
+# text: value length distribution (the service time syntax of TestServer.py: const:N, uniform:A,B,
+# exp:MEAN, lognorm:MEDIAN,SIGMA, pareto:ALPHA[,MIN]), cardinality: distinct values (0 = every value new),
+# skew: Zipf exponent over the distinct values (0 = uniform, ~1 = a few hot keys).
+DEFAULT_CORPUS = {
+    "pool_size": 4096,
+    "events": [
+        {"e": "FileChanged", "src": "Sync", "t": 1, "eid": 10, "weight": 55, "data": {
+            "folder": {"text": "uniform:8,24", "cardinality": 200, "skew": 1.0},
+            "path": {"text": "lognorm:60,0.5", "cardinality": 50000, "skew": 0.8},
+            "size": {"int": [0, 50000000]},
+            "action": {"enum": ["added", "modified", "deleted", "renamed"]}}},
+        {"e": "TransferComplete", "src": "Transfer", "t": 2, "eid": 20, "weight": 20, "data": {
+            "job": {"text": "const:32", "cardinality": 500},
+            "peer": {"text": "const:40", "cardinality": 2000, "skew": 1.1},
+            "bytes": {"int": [1000, 500000000]},
+            "duration_ms": {"int": [1, 600000]}}},
+        {"e": "PeerConnected", "src": "Net", "t": 2, "eid": 30, "weight": 10, "data": {
+            "peer": {"text": "const:40", "cardinality": 2000, "skew": 1.1},
+            "address": {"text": "uniform:9,15", "cardinality": 5000},
+            "transport": {"enum": ["tcp", "utp3", "proxy"]}}},
+        {"e": "Error", "src": "App", "t": 4, "eid": 40, "weight": 8, "data": {
+            "code": {"int": [1, 300]},
+            "message": {"text": "lognorm:120,0.8", "cardinality": 300, "skew": 1.2},
+            "path": {"text": "lognorm:60,0.5", "cardinality": 0}}},
+        {"e": "ResourceUsage", "src": "App", "t": 3, "eid": 50, "weight": 6, "data": {
+            "cpu": {"int": [0, 100]},
+            "memory_mb": {"int": [50, 4000]},
+            "disk_free_gb": {"int": [1, 2000]}}},
+        {"e": "Startup", "src": "App", "t": 3, "eid": 1, "weight": 1, "data": {
+            "time": {"int": [0, 0]}}},
+    ],
+}
+
+def make_distribution(spec: str) -> Callable[[random.Random], float]:
+    kind, _, params = spec.partition(':')
+    values = [float(x) for x in params.split(',') if x]
+    if kind == 'const':
+        value = values[0] if values else 0.0
+        return lambda rng: value
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda rng: rng.expovariate(1.0 / values[0])
+    if kind == 'lognorm':
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == 'pareto':
+        alpha, scale = values[0], values[1] if len(values) > 1 else 1.0
+        return lambda rng: rng.paretovariate(alpha) * scale
+    raise ValueError(f"Unknown size distribution: {spec}")
+
+class Attribute:
+    # one key of an event's "data" object, drawn from its spec
+    ALPHABET = string.ascii_lowercase + string.digits
+
+    def __init__(self, name: str, spec: dict) -> None:
+        self.name = name
+        if "int" in spec:
+            self._kind = "int"
+            self._low, self._high = spec["int"]
+        elif "enum" in spec:
+            self._kind = "enum"
+            self._values = list(spec["enum"])
+        elif "text" in spec:
+            self._kind = "text"
+            self._length = make_distribution(spec["text"])
+            self._cardinality = int(spec.get("cardinality", 0))
+            self._texts: dict[int, str] = {}
+            skew = float(spec.get("skew", 0.0))
+            # cumulative Zipf weights over the distinct values, for random.choices
+            self._cum_weights = list(accumulate((k + 1) ** -skew for k in range(self._cardinality))) \
+                if skew > 0 and self._cardinality > 0 else None
+        else:
+            raise ValueError(f"Attribute {name!r} needs one of int, enum, text")
+
+    def value(self, rng: random.Random):
+        if self._kind == "int":
+            return rng.randint(self._low, self._high)
+        if self._kind == "enum":
+            return rng.choice(self._values)
+        if self._cardinality <= 0:
+            return self._make_text(rng)
+        if self._cum_weights is not None:
+            key = rng.choices(range(self._cardinality), cum_weights=self._cum_weights)[0]
+        else:
+            key = rng.randrange(self._cardinality)
+        text = self._texts.get(key)
+        if text is None:
+            # a distinct value keeps its length and content wherever it is drawn
+            text = self._texts[key] = self._make_text(random.Random(f"{self.name}/{key}"))
+        return text
+
+    def _make_text(self, rng: random.Random) -> str:
+        return "".join(rng.choices(self.ALPHABET, k=max(1, round(self._length(rng)))))
+
+class PayloadCorpus:
+    # pool_size events are drawn from the corpus and encoded once. A batch is a run of consecutive pool
+    # events from a random start: one slice of a buffer holding the pool twice, so any run up to the
+    # pool size is contiguous. All events of a batch carry the batch "ts", so the buffer is joined
+    # again when ts changes (once a second, as BatchTemplateCache does), in one bytes.join call.
+    _TS_LEN = len(b'{"ts":1700000000')  # the part of an encoded event joined in per second
+
+    def __init__(self, spec: dict, pool_size: Optional[int] = None, seed: Optional[int] = None) -> None:
+        pool_size = int(pool_size or spec.get("pool_size", 4096))
+        seed = seed if seed is not None else spec.get("seed")
+        rng = random.Random(seed)
+        types = spec["events"]
+        if not types:
+            raise ValueError("Payload corpus has no events")
+        attributes = [[Attribute(name, attr) for name, attr in event.get("data", {}).items()] for event in types]
+        weights = [float(event.get("weight", 1)) for event in types]
+
+        # encoded events without the opening '{"ts":<ts>', which is prepended when the buffer is joined
+        self._events: list[bytes] = []
+        self._counts = [0] * len(types)
+        for i in rng.choices(range(len(types)), weights=weights, k=pool_size):
+            event = types[i]
+            data = {attr.name: attr.value(rng) for attr in attributes[i]}
+            encoded = json.dumps({"id": 0, "eid": event.get("eid", 1), "tick": 0, "t": event.get("t", 3),
+                                  "e": event["e"], "src": event.get("src", "App"), "data": data},
+                                 separators=(',', ':'))
+            self._events.append(b"," + encoded[1:].encode())
+            self._counts[i] += 1
+        self._names = [event["e"] for event in types]
+
+        self._ts = -1
+        self._head = b""
+        self._buffer = memoryview(b"")
+        self._offsets: list[int] = []  # start of every event in the buffer, and the buffer end
+        self._prefix_len = -1
+
+    @property
+    def pool_size(self) -> int:
+        return len(self._events)
+
+    @property
+    def mean_event_bytes(self) -> float:
+        return sum(len(event) for event in self._events) / len(self._events) + self._TS_LEN
+
+    def describe(self) -> str:
+        sizes = sorted(len(event) + self._TS_LEN for event in self._events)
+        mix = ", ".join(f"{name} {count / len(self._events):.0%}" for name, count in zip(self._names, self._counts))
+        return "%d pre-encoded events, bytes/event mean %.0f p50 %d p95 %d max %d; %s" % (
+            len(sizes), self.mean_event_bytes, sizes[len(sizes) // 2], sizes[int(len(sizes) * 0.95)], sizes[-1], mix)
+
+    def events(self, count: int, ts: int) -> list:
+        # the batch's "events" array content as buffer slices (memoryviews, nothing copied)
+        if ts != self._ts:
+            self._join(ts)
+        size = len(self._events)
+        offsets = self._offsets
+        buffer = self._buffer
+        start = int(random.random() * size)
+        pieces = []
+        while count > 0:
+            n = min(count, size)
+            if pieces:
+                pieces.append(b",")
+            pieces.append(buffer[offsets[start]:offsets[start + n] - 1])  # without the comma after the run
+            count -= n
+        return pieces
+
+    def make_events_batch_frame(self, events_count: int, confirmationId: int) -> tuple:
+        # the frame of AgentMessageHelper.make_events_batch_frame, with corpus events
+        ts = int(time.time())
+        if ts != self._ts:
+            self._join(ts)
+        tail = b'],"confirmId":"%d"}' % confirmationId
+        size = len(self._events)
+        if 0 < events_count <= size:
+            # one run of the pool: the common case, kept to a single slice
+            start = int(random.random() * size)
+            body = self._buffer[self._offsets[start]:self._offsets[start + events_count] - 1]
+            return ((len(self._head) + len(body) + len(tail)).to_bytes(4, byteorder="big"), self._head, body, tail)
+        pieces = self.events(events_count, ts) if events_count > 0 else []
+        length = len(self._head) + len(tail) + sum(len(piece) for piece in pieces)
+        return (length.to_bytes(4, byteorder="big"), self._head, *pieces, tail)
+
+    def _join(self, ts: int) -> None:
+        self._ts = ts
+        self._head = b'{"m":"events","priority":0,"ts":%d,"events":[' % ts
+        prefix = b'{"ts":%d' % ts
+        events = self._events * 2
+        # the comma after every event is part of its slot; the last one is never sliced
+        self._buffer = memoryview(prefix + (b"," + prefix).join(events) + b",")
+        if len(prefix) != self._prefix_len:
+            self._prefix_len = len(prefix)
+            self._offsets = [0] + list(accumulate(len(prefix) + len(event) + 1 for event in events))
+
+def load_corpus(path: str) -> dict:
+    # "default": DEFAULT_CORPUS; otherwise JSON, or YAML when PyYAML is installed
+    if path == "default":
+        return DEFAULT_CORPUS
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("PyYAML is needed for YAML corpora: pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def make_corpus(spec: Optional[dict]) -> Optional[PayloadCorpus]:
+    if not spec:
+        return None
+    corpus = PayloadCorpus(spec)
+    logging.info("Payloads: %s", corpus.describe())
+    return corpus
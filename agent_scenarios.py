@@ -0,0 +1,818 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from typing import Awaitable, Callable, Optional
+from agent_cluster import DEFAULT_CLUSTER_KEY, DEFAULT_CLUSTER_PORT, ClusterAppState
+from agent_common import (TLS_READ_BUFFER, TRANSPORTS, AgentConfig, AgentFairness, AgentSocket, AppState, ConnectionRamp,
+                          FileHelper, LatencyHistogram, sleep_until)
+from agent_fleet import Fleet, load_fleet
+from agent_metrics import MetricsRecorder
+from agent_payloads import load_corpus
+from agent_trace import TraceRecorder, replay_trace
+from agent_workers import ShardedAppState
+
+# -----------------------------
+# Capacity search
+# -----------------------------
+CAPACITY_TITLES = ('Agents Count', 'Batch Size', 'Sent', 'Confirmed', 'P95', 'Best Eps', 'Best Confirmed', 'Best Eps CI95',
+                   'Generator Bound')
+
+FAIRNESS_WARN_JAIN = 0.9  # a step or phase with a lower Jain index of per-agent EPS is logged as a warning
+
+# two-sided 95% Student t by degrees of freedom, 2.0 past the table
+_T95 = (0.0, 12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13)
+
+def mean_ci(values: list[float], batch: int = 5) -> tuple[float, float]:
+    # mean and 95% CI half-width; per-second samples are autocorrelated, so the spread is taken
+    # from means of `batch`-second blocks rather than from single samples
+    n = len(values)
+    mean = sum(values) / n if n else 0.0
+    blocks = [sum(values[i:i + batch]) / batch for i in range(n % batch, n, batch)]
+    k = len(blocks)
+    if k < 2:
+        return mean, math.inf
+    block_mean = sum(blocks) / k
+    var = sum((b - block_mean) ** 2 for b in blocks) / (k - 1)
+    t = _T95[k - 1] if k - 1 < len(_T95) else 2.0
+    return mean, t * math.sqrt(var / k)
+
+def linear_slope(values: list[float]) -> float:
+    # least squares slope per sample
+    n = len(values)
+    if n < 2:
+        return 0.0
+    x_mean = (n - 1) / 2
+    y_mean = sum(values) / n
+    sxy = sum((i - x_mean) * (y - y_mean) for i, y in enumerate(values))
+    sxx = n * (n * n - 1) / 12
+    return sxy / sxx
+
+def log_fairness(what: str, fairness: Optional[AgentFairness]) -> None:
+    # per-agent spread of a step or phase, and its least served agents
+    if fairness is None:
+        return
+    uneven = fairness.jain < FAIRNESS_WARN_JAIN
+    logging.log(logging.WARNING if uneven or fairness.stalled else logging.INFO,
+                "%s fairness: %s%s%s", what, fairness.describe(),
+                " - UNEVEN, some agents are starved" if uneven else "",
+                " - STALLED agents: batches sent, no confirm in the whole window" if fairness.stalled else "")
+    logging.info("%s slowest agents: %s", what, fairness.describe_slowest())
+
+class StepResult:
+    # one rate step: what was offered, what came back, and whether it met the SLOs
+    def __init__(self, eps: float, seconds: float, lats: LatencyHistogram,
+                 batches_sent: int, confirms: int, errors: int, events_per_confirm: float) -> None:
+        self.eps = eps
+        self.seconds = seconds
+        self.lats = lats
+        self.batches_sent = batches_sent
+        self.confirms = confirms
+        self.errors = errors
+        self.p95 = lats.percentile(95)
+        self.confirmed_eps = confirms * events_per_confirm / seconds if seconds > 0 else 0.0
+        self.err_rate = errors / max(1, (confirms + errors))
+        self.passed = False
+        # per-second samples of the steady part of the step (see SteadyState)
+        self.steady = False
+        self.steady_eps = self.confirmed_eps
+        self.steady_eps_ci = math.inf
+        # generator side of the step (see CapacitySearch._check_generator)
+        self.loop_lag_p99 = 0.0
+        self.ready_max = 0
+        self.send_ratio = 1.0  # batches sent / batches the target rate asked for
+        self.agents_behind = 0.0  # part of the agents that sent below min_send_ratio of their own planned rate
+        self.generator_bound = False
+        self.fairness: Optional[AgentFairness] = None  # per-agent spread of the step
+
+class CapacityResult:
+    def __init__(self) -> None:
+        self.best_sustainable = 0.0  # (steady) confirmed EPS of the best step that met the SLOs
+        self.best_sustainable_ci = math.inf  # 95% CI half-width of the steady confirmed EPS of that step
+        self.best_confirmed = 0.0    # highest confirmed EPS of any step
+        self.generator_bound = False # the search hit a limit of the generator, not of the server
+        self.last: Optional[StepResult] = None
+        self.steps: list[StepResult] = []
+
+    def add(self, step: StepResult) -> None:
+        self.steps.append(step)
+        self.last = step
+        if step.generator_bound:
+            self.generator_bound = True
+        if self.best_confirmed < step.confirmed_eps:
+            self.best_confirmed = step.confirmed_eps
+        if step.passed and step.steady_eps > self.best_sustainable:
+            self.best_sustainable = step.steady_eps
+            self.best_sustainable_ci = step.steady_eps_ci
+
+class ConfirmedRate:
+    # Confirmed EPS sampled about once a second. Every source of AppState.confirm_marks() is rated over
+    # the span between its own reports: with worker processes counts move only on their pushes, and a
+    # fixed 1 sec sample would hold one push in one second and three in the next. A source that did
+    # not report since the last sample keeps its previous rate.
+    def __init__(self, app_state: AppState) -> None:
+        self._app_state = app_state
+        self._marks = app_state.confirm_marks()
+        self._rates: dict[int, float] = {}
+
+    def sample(self) -> float:
+        for source, (seconds, events) in self._app_state.confirm_marks().items():
+            last = self._marks.get(source)
+            if last is None:
+                self._marks[source] = (seconds, events)  # first report: the span starts here
+            elif seconds > last[0]:
+                self._rates[source] = (events - last[1]) / (seconds - last[0])
+                self._marks[source] = (seconds, events)
+        return sum(self._rates.values())
+
+class SteadyState:
+    # Per-second confirmed EPS and mean latency of a step. The trailing half of the step (at least
+    # min_sec) is steady when neither drifts by more than tol over it and the EPS CI is within tol.
+    def __init__(self, tol: float, min_sec: float) -> None:
+        self._tol = tol
+        self._min_sec = min_sec
+        self.eps: list[float] = []
+        self.latency: list[float] = []
+
+    def add(self, eps: float, latency: float) -> None:
+        self.eps.append(eps)
+        self.latency.append(latency)
+
+    def _tail(self, values: list[float]) -> list[float]:
+        n = max(int(self._min_sec), len(values) // 2)
+        return values[-n:]
+
+    def eps_ci(self) -> tuple[float, float]:
+        return mean_ci(self._tail(self.eps))
+
+    def is_steady(self) -> bool:
+        if len(self.eps) < self._min_sec:
+            return False
+        eps = self._tail(self.eps)
+        mean, ci = mean_ci(eps)
+        if mean <= 0 or ci > mean * self._tol:
+            return False
+        if abs(linear_slope(eps)) * len(eps) > mean * self._tol:
+            return False
+        latency = [x for x in self._tail(self.latency) if x > 0]
+        if len(latency) >= 2:
+            lat_mean = sum(latency) / len(latency)
+            # a queue building up shows as latency growing through the window
+            if linear_slope(latency) * len(latency) > lat_mean * self._tol:
+                return False
+        return True
+
+    def is_clear(self, threshold: float) -> bool:
+        # the EPS CI is on one side of the pass threshold
+        mean, ci = self.eps_ci()
+        return mean - ci >= threshold or mean + ci < threshold
+
+class CapacitySearch:
+    # Runs rate steps against AppState and judges them by the SLOs:
+    # confirmed EPS >= min_confirmed_frac of the target, p95 confirm latency, error rate.
+    # steady_tol: a step ends early once it is steady and its verdict is clear, or runs on up to
+    # step_max_min while it is not steady; steady_tol=0 runs every step for exactly step_min.
+    # A step is generator-bound when our own event loop (the busiest one, with worker processes) was late
+    # by more than gen_lag_p99_sec (p99), or sends fell below min_send_ratio of the plan while the loop was
+    # at least a quarter that late: in total, or for more than 1 - min_send_ratio of the agents - a few
+    # stalled agents don't move the total.
+    def __init__(self, app_state: AppState, step_min: float, slo_p95_sec: float, slo_err_rate: float,
+                 min_confirmed_frac: float = 0.85, steady_tol: float = 0.0, step_max_min: float = 0.0,
+                 gen_lag_p99_sec: float = 0.05, min_send_ratio: float = 0.9) -> None:
+        self._app_state = app_state
+        self._gen_lag_p99_sec = gen_lag_p99_sec
+        self._min_send_ratio = min_send_ratio
+        app_state.loop_monitor.start()
+        self._step_min = step_min
+        self._slo_p95_sec = slo_p95_sec
+        self._slo_err_rate = slo_err_rate
+        self._min_confirmed_frac = min_confirmed_frac
+        self._steady_tol = steady_tol
+        self._step_max_min = max(step_min, step_max_min)
+
+    async def run_step(self, eps: float) -> StepResult:
+        app_state = self._app_state
+        await app_state.set_rate_limit_total(eps)
+        app_state.loop_monitor.take_window()  # step window starts now, as the stats window does
+        app_state.take_agent_fairness()
+        if self._steady_tol > 0:
+            logging.info("Step: total EPS set to %.0f, running until steady, %.1f-%.1f min",
+                         eps, self._step_min, self._step_max_min)
+            steady = await self._run_until_steady(eps)
+        else:
+            logging.info("Step: total EPS set to %.0f, running for %.1f min", eps, self._step_min)
+            # run this step window
+            await sleep_until(app_state.window_started + self._step_min * 60)
+            steady = None
+
+        # evaluate window SLOs; rates come from the exact window length
+        step_time = app_state.window_elapsed()
+        lats, batches_sent, confirms, errors = app_state.snapshot_and_reset_window()
+        step = StepResult(eps, step_time, lats, batches_sent, confirms, errors, app_state.window_events_per_confirm)
+        step.fairness = app_state.take_agent_fairness()
+        if steady is not None:
+            step.steady = steady.is_steady()
+            step.steady_eps, step.steady_eps_ci = steady.eps_ci()
+        self._check_generator(step)
+        step.passed = self._meets_slo(step) and not step.generator_bound
+        logging.info(
+            "Step result: p95=%.3fs, mean_lat=%.1fs sent=%d, confirms=%d, confirmed_eps=%d, errors=%d (err_rate=%.3f)",
+            step.p95, lats.mean(), batches_sent, confirms, step.confirmed_eps, errors, step.err_rate
+        )
+        if steady is not None:
+            logging.info("Step steady state: %s after %.0f sec, confirmed_eps=%.0f ±%.0f (95%% CI)",
+                         "reached" if step.steady else "NOT reached", step_time, step.steady_eps, step.steady_eps_ci)
+        logging.log(logging.WARNING if step.generator_bound else logging.INFO,
+                    "Step generator: loop_lag_p99=%.3fs, ready_max=%d, send_ratio=%.2f, agents below plan=%.0f%%%s",
+                    step.loop_lag_p99, step.ready_max, step.send_ratio, step.agents_behind * 100,
+                    " - GENERATOR-BOUND, the limit is this client" if step.generator_bound else "")
+        logging.info(
+            "Step latency: p50=%.3fs, p90=%.3fs, p99=%.3fs, p99.9=%.3fs, max=%.3fs",
+            lats.percentile(50), lats.percentile(90), lats.percentile(99), lats.percentile(99.9), lats.max
+        )
+        log_fairness("Step", step.fairness)
+        return step
+
+    async def _run_until_steady(self, eps: float) -> SteadyState:
+        # sample every second; end when steady and clear (after min_sec), steady (after step_min)
+        # or at step_max_min regardless
+        app_state = self._app_state
+        min_sec = max(10.0, self._step_min * 60 / 4)
+        steady = SteadyState(self._steady_tol, min_sec)
+        threshold = eps * self._min_confirmed_frac
+        started = app_state.window_started
+        rate = ConfirmedRate(app_state)
+        last_count, last_sum = app_state.window_latency_sum()
+        tick = 0
+        while not app_state.stopped:
+            # samples on whole seconds of the window, a slow tick doesn't shift the next ones
+            tick += 1
+            await sleep_until(started + tick)
+            now = time.monotonic()
+            count, lat_sum = app_state.window_latency_sum()
+            steady.add(rate.sample(), (lat_sum - last_sum) / (count - last_count) if count > last_count else 0.0)
+            last_count, last_sum = count, lat_sum
+
+            elapsed = now - started
+            if elapsed >= self._step_max_min * 60:
+                break
+            if elapsed >= min_sec and steady.is_steady():
+                if elapsed >= self._step_min * 60 or steady.is_clear(threshold):
+                    break
+        return steady
+
+    def _check_generator(self, step: StepResult) -> None:
+        lags, ready_max, _, _ = self._app_state.loop_monitor.take_window()
+        step.loop_lag_p99 = lags.percentile(99)
+        step.ready_max = ready_max
+        batch_size = self._app_state.batch_size
+        if step.eps > 0 and batch_size > 0:
+            step.send_ratio = step.batches_sent / (step.eps * step.seconds / batch_size)
+        agents_count = self._app_state.agents_count
+        if step.fairness is not None and agents_count > 0:
+            step.agents_behind = step.fairness.share_below(step.eps / agents_count, self._min_send_ratio)
+        sending_short = (step.send_ratio < self._min_send_ratio
+                         or step.agents_behind > 1.0 - self._min_send_ratio)
+        step.generator_bound = (step.loop_lag_p99 > self._gen_lag_p99_sec or (
+            sending_short and step.loop_lag_p99 > self._gen_lag_p99_sec / 4))
+
+    def _meets_slo(self, step: StepResult) -> bool:
+        confirmed_eps = step.steady_eps if step.steady else step.confirmed_eps
+        if confirmed_eps < step.eps * self._min_confirmed_frac:
+            return False
+        if step.p95 and step.p95 > self._slo_p95_sec:
+            return False
+        return step.err_rate <= self._slo_err_rate
+
+    async def step_up(self, start_eps: float, step_inc: float, max_steps: int = 1000) -> CapacityResult:
+        # +step_inc per step from start_eps until the first step that breaches the SLOs
+        result = CapacityResult()
+        step_eps = start_eps
+        for _ in range(max_steps):
+            if self._app_state.stopped:
+                break
+            step_eps = step_eps * (1.0 + step_inc)
+            step = await self.run_step(step_eps)
+            result.add(step)
+            if step.generator_bound:
+                logging.warning("Generator-bound at EPS=%.0f: stopping, capacity is at least %.0f EPS",
+                                step.eps, result.best_sustainable)
+                break
+            if not step.passed:
+                logging.warning(
+                    "SLO breached at EPS=%.0f (eps=%.1f%% of target, p95=%.3fs, err_rate=%.3f). Using previous step as capacity.",
+                    step.confirmed_eps, 100 * step.confirmed_eps / step.eps, step.p95, step.err_rate)
+                break
+        else:
+            logging.info("Reached maximum steps (%d).", max_steps)
+        return result
+
+    async def bracket_bisect(self, start_eps: float, resolution: float = 0.02, growth: float = 2.0,
+                             max_steps: int = 50, min_eps: float = 0.0) -> CapacityResult:
+        # x growth per probe until the SLOs break (or / growth until they hold), then bisect between
+        # the last passing and the first failing rate until they are within resolution of each other.
+        # Bracketing down gives up below min_eps; by default 10 divisions below start_eps (1/1024 with x2):
+        # a target that far off is a wrong --target-eps or a broken server, not a capacity to search for
+        min_eps = min_eps or start_eps / growth ** 10
+        result = CapacityResult()
+        passing, failing = 0.0, 0.0
+        eps = start_eps
+        for n in range(1, max_steps + 1):
+            if self._app_state.stopped:
+                break
+            step = await self.run_step(eps)
+            result.add(step)
+            if step.generator_bound:
+                logging.warning("Generator-bound at EPS=%.0f: stopping, capacity is at least %.0f EPS",
+                                eps, result.best_sustainable)
+                break
+            if step.passed:
+                passing = eps
+            else:
+                failing = eps
+            logging.info("Probe %d: %.0f EPS %s, capacity in [%.0f, %s]", n, eps, "passed" if step.passed else "failed",
+                         passing, "%.0f" % failing if failing else "?")
+
+            if not failing:
+                eps = eps * growth  # bracketing up
+            elif not passing:
+                eps = eps / growth  # bracketing down
+                if eps < min_eps:
+                    logging.warning("SLOs are not met even at %.0f EPS", failing)
+                    break
+            elif failing - passing <= passing * resolution:
+                break
+            else:
+                eps = (passing + failing) / 2
+        else:
+            logging.info("Reached maximum probes (%d).", max_steps)
+        logging.info("Capacity: %.0f EPS target passed, %.0f confirmed (resolution %.0f%%, %d probes)",
+                     passing, result.best_sustainable, resolution * 100, len(result.steps))
+        return result
+
+    async def find(self, strategy: str, start_eps: float, step_inc: float = 0.10,
+                   resolution: float = 0.02, min_eps: float = 0.0) -> CapacityResult:
+        if strategy == 'bisect':
+            return await self.bracket_bisect(start_eps, resolution, min_eps=min_eps)
+        if strategy == 'step':
+            return await self.step_up(start_eps, step_inc)
+        raise ValueError(f"Unknown search strategy: {strategy}")
+
+SEARCH_STRATEGIES = ('bisect', 'step')
+
+def save_capacity_csv(filename: str, agents_count: int, batch_size: int, result: CapacityResult) -> None:
+    last = result.last
+    FileHelper.save_results_csv(filename, CAPACITY_TITLES, [
+        agents_count, batch_size,
+        last.batches_sent if last else 0, last.confirms if last else 0, "%.2f" % (last.p95 if last else 0.0),
+        "%d" % result.best_sustainable, "%d" % result.best_confirmed,
+        "%d" % result.best_sustainable_ci if math.isfinite(result.best_sustainable_ci) else "",
+        1 if result.generator_bound else 0
+    ])
+
+# -----------------------------
+# Scenario engine
+# -----------------------------
+# A scenario is a list of phases run one after another on the same connected agents:
+#   {"type": "constant", "x": 0.5, "min": 5}                 warm-up, plateau
+#   {"type": "ramp", "from_x": 0.5, "to_x": 1.5, "min": 10}  linear change of the rate
+#   {"type": "search", "strategy": "bisect", "step_min": 1}  capacity search, sets the capacity
+#   {"type": "spike", "x": 2.0, "min": 2, "count": 2}        spikes, each followed by a settle at settle_x
+#   {"type": "soak", "x": 0.75, "min": 60}                   long run, stats logged every log_sec
+#   {"type": "churn", "x": 0.5, "min": 3, "rate": 20}        agents dropped at rate/sec for churn_sec after pre_sec,
+#   {"type": "churn", "x": 0.5, "min": 3, "storm": true}     or a fraction of them at once; needs --reconnect
+#   {"type": "replay", "trace": "run.trace", "speed": 2}     batches of a recorded trace at their times (from_sec, to_sec);
+#                                                            agents must not be self paced (Agent_Replay.py)
+# Rates are "eps" (absolute) or "x" (times the capacity: --target-eps until a search phase found one).
+# "slo" of a phase overrides the scenario SLO ({"p95_sec", "err_rate", "min_confirmed_frac"}), false turns it off.
+PHASE_TYPES = ('constant', 'ramp', 'search', 'spike', 'soak', 'churn', 'replay')
+PHASE_TITLES = ('Phase', 'Type', 'Target Eps', 'Seconds', 'Sent', 'Confirmed', 'Confirmed Eps',
+                'P50', 'P95', 'P99', 'Errors', 'Err Rate', 'SLO', 'Generator Bound', 'Capacity',
+                'Dropped', 'Reconnect P95', 'Handshakes Peak', 'Dip', 'Recovery Sec',
+                'Jain', 'Agent Eps Min', 'Agent Eps P5', 'Agent Eps P50')
+
+def load_scenario(path: str) -> dict:
+    # JSON, or YAML when PyYAML is installed; a bare list is a list of phases
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("PyYAML is needed for YAML scenarios: pip install pyyaml")
+            scenario = yaml.safe_load(f)
+        else:
+            scenario = json.load(f)
+    if isinstance(scenario, list):
+        scenario = {"phases": scenario}
+    for phase in scenario.get("phases", []):
+        if phase.get("type") not in PHASE_TYPES:
+            raise ValueError(f"Unknown phase type {phase.get('type')!r}, expected one of {PHASE_TYPES}")
+    return scenario
+
+class ChurnStats:
+    # what a churn phase did to the rest of the traffic, from per-second samples of the phase
+    def __init__(self, dropped: int, reconnect: LatencyHistogram, eps: list[float], approvals: list[int],
+                 pre_sec: int, end_sec: int, tol: float = 0.05, hold_sec: int = 3) -> None:
+        self.dropped = dropped
+        self.reconnect = reconnect  # loss to approval of the dropped agents
+        # baseline: EPS before the first drop; dip: the worst second after it, as a part of the baseline
+        self.baseline_eps = sum(eps[:pre_sec]) / pre_sec if pre_sec > 0 else 0.0
+        after = eps[pre_sec:]
+        self.dip = 1.0 - min(after) / self.baseline_eps if after and self.baseline_eps > 0 else 0.0
+        # recovery: from the last drop until EPS holds within tol of the baseline for hold_sec
+        self.recovery_sec: Optional[float] = None
+        floor = self.baseline_eps * (1.0 - tol)
+        for i in range(end_sec, len(eps) - hold_sec + 1):
+            if all(value >= floor for value in eps[i:i + hold_sec]):
+                self.recovery_sec = float(i - end_sec)
+                break
+        # auth throughput: approvals per second once the drops started
+        churn = approvals[pre_sec:]
+        self.handshakes_peak = max(churn) if churn else 0
+        self.handshakes_mean = sum(churn) / len(churn) if churn else 0.0
+
+class PhaseResult:
+    def __init__(self, name: str, kind: str, eps: float, seconds: float, lats: LatencyHistogram,
+                 batches_sent: int, confirms: int, errors: int, events_per_confirm: float) -> None:
+        self.name = name
+        self.kind = kind
+        self.eps = eps
+        self.seconds = seconds
+        self.lats = lats
+        self.batches_sent = batches_sent
+        self.confirms = confirms
+        self.errors = errors
+        self.confirmed_eps = confirms * events_per_confirm / seconds if seconds > 0 else 0.0
+        self.err_rate = errors / max(1, (confirms + errors))
+        self.slo_passed: Optional[bool] = None  # None: no SLO for this phase
+        self.generator_bound = False
+        self.capacity = 0.0
+        self.churn: Optional[ChurnStats] = None  # churn phases only
+        self.fairness: Optional[AgentFairness] = None
+
+    def row(self) -> list:
+        slo = "" if self.slo_passed is None else ("pass" if self.slo_passed else "FAIL")
+        churn = ["", "", "", "", ""]
+        if self.churn is not None:
+            recovery = self.churn.recovery_sec
+            churn = [self.churn.dropped, "%.3f" % self.churn.reconnect.percentile(95), self.churn.handshakes_peak,
+                     "%.3f" % self.churn.dip, "%.0f" % recovery if recovery is not None else "never"]
+        fairness = ["", "", "", ""]
+        if self.fairness is not None:
+            fairness = ["%.3f" % self.fairness.jain, "%.1f" % self.fairness.eps_min, "%.1f" % self.fairness.eps_p5,
+                        "%.1f" % self.fairness.eps_median]
+        return [self.name, self.kind, "%d" % self.eps, "%.0f" % self.seconds, self.batches_sent, self.confirms,
+                "%d" % self.confirmed_eps, "%.3f" % self.lats.percentile(50), "%.3f" % self.lats.percentile(95),
+                "%.3f" % self.lats.percentile(99), self.errors, "%.4f" % self.err_rate, slo,
+                1 if self.generator_bound else 0, "%d" % self.capacity] + churn + fairness
+
+class ScenarioRunner:
+    def __init__(self, app_state: AppState, target_eps: float, slo: Optional[dict] = None,
+                 search_defaults: Optional[dict] = None, save_to: Optional[str] = None) -> None:
+        self._app_state = app_state
+        self._capacity = target_eps
+        self._slo = {"p95_sec": 0.5, "err_rate": 0.01, "min_confirmed_frac": 0.0}
+        self._slo.update(slo or {})
+        self._search_defaults = search_defaults or {}
+        self._save_to = save_to
+        self.results: list[PhaseResult] = []
+        self.last_search: Optional[CapacityResult] = None
+        app_state.loop_monitor.start()
+
+    @property
+    def capacity(self) -> float:
+        return self._capacity
+
+    async def run(self, phases: list[dict]) -> list[PhaseResult]:
+        for n, phase in enumerate(phases, 1):
+            if self._app_state.stopped:
+                break
+            name = phase.get("name", f"{n}-{phase['type']}")
+            logging.info("Phase %s", name)
+            self._start_window()
+            await getattr(self, "_" + phase["type"])(name, phase)
+        return self.results
+
+    def _eps(self, phase: dict, key: str = "", default_x: float = 1.0) -> float:
+        eps = phase.get(key + "eps")
+        if eps is not None:
+            return float(eps)
+        return self._capacity * float(phase.get(key + "x", default_x))
+
+    def _phase_slo(self, phase: dict) -> Optional[dict]:
+        slo = phase.get("slo", {})
+        if slo is False:
+            return None
+        return {**self._slo, **slo}
+
+    def _start_window(self) -> None:
+        # the phase is measured from here on: loop lag, per-class and per-agent stats start over
+        self._app_state.loop_monitor.take_window()
+        self._app_state.take_agent_fairness()
+        if self._app_state.fleet is not None:
+            self._app_state.fleet.take_window()
+
+    def _report(self, name: str, kind: str, eps: float, seconds: float, phase: dict,
+                window: Optional[tuple] = None, verdict: Optional[tuple[bool, bool]] = None,
+                churn: Optional[ChurnStats] = None) -> PhaseResult:
+        # one reporting path for every phase: SLO verdict, log line, results row;
+        # window and verdict (slo passed, generator-bound) come from the caller when it judged the phase itself
+        if window is None:
+            seconds = self._app_state.window_elapsed()  # exact window length, not the planned one
+            window = self._app_state.snapshot_and_reset_window()
+        lats, batches_sent, confirms, errors = window
+        result = PhaseResult(name, kind, eps, seconds, lats, batches_sent, confirms, errors,
+                             self._app_state.window_events_per_confirm)
+        lag_p99 = self._app_state.loop_monitor.take_window()[0].percentile(99)
+        slo = self._phase_slo(phase)
+        if verdict is not None:
+            result.slo_passed, result.generator_bound = verdict
+        else:
+            if slo is not None:
+                p95 = lats.percentile(95)
+                result.slo_passed = (not (p95 and p95 > slo["p95_sec"]) and result.err_rate <= slo["err_rate"]
+                                     and result.confirmed_eps >= eps * slo["min_confirmed_frac"])
+            result.generator_bound = lag_p99 > float(self._search_defaults.get("gen_lag_p99_sec", 0.05))
+        result.capacity = self._capacity
+        result.churn = churn
+        result.fairness = self._app_state.take_agent_fairness()
+        self.results.append(result)
+        logging.log(logging.INFO if result.slo_passed is not False else logging.WARNING,
+                    "Phase %s result: target=%.0f, confirmed_eps=%.0f, p50/p95/p99=%.3f/%.3f/%.3fs, errors=%d "
+                    "(err_rate=%.3f), loop_lag_p99=%.3fs%s",
+                    name, eps, result.confirmed_eps, lats.percentile(50), lats.percentile(95), lats.percentile(99),
+                    errors, result.err_rate, lag_p99,
+                    "" if result.slo_passed is None else (", SLO passed" if result.slo_passed else ", SLO BREACHED"))
+        log_fairness("Phase " + name, result.fairness)
+        if self._save_to:
+            FileHelper.save_results_csv(self._save_to, PHASE_TITLES, result.row())
+        if self._app_state.fleet is not None:
+            # per profile class, for the whole phase; rows go next to the phase rows
+            root, ext = os.path.splitext(self._save_to) if self._save_to else ("", "")
+            self._app_state.fleet.report(name, eps, root + "_classes" + ext if self._save_to else None)
+        return result
+
+    async def _hold(self, eps: float, seconds: float) -> None:
+        await self._app_state.set_rate_limit_total(eps)
+        self._start_window()
+        await sleep_until(self._app_state.window_started + seconds)
+
+    async def _constant(self, name: str, phase: dict) -> None:
+        eps = self._eps(phase)
+        seconds = float(phase.get("min", 1)) * 60
+        logging.info("Constant: total EPS %.0f for %.1f min", eps, seconds / 60)
+        await self._hold(eps, seconds)
+        self._report(name, "constant", eps, seconds, phase)
+
+    async def _ramp(self, name: str, phase: dict) -> None:
+        start_eps = self._eps(phase, "from_", 0.0)
+        end_eps = self._eps(phase, "to_")
+        seconds = float(phase.get("min", 1)) * 60
+        logging.info("Ramp: total EPS %.0f -> %.0f over %.1f min", start_eps, end_eps, seconds / 60)
+        await self._app_state.set_rate_limit_total(start_eps)
+        self._start_window()
+        # a linear ramp read by the agents on every send, traffic keeps flowing
+        await self._app_state.set_rate_limit_total(end_eps, reset_window=False, ramp_sec=seconds)
+        await sleep_until(self._app_state.window_started + seconds)
+        self._report(name, "ramp", end_eps, seconds, phase)
+
+    async def _search(self, name: str, phase: dict) -> None:
+        options = {**self._search_defaults, **phase}
+        slo = self._phase_slo(phase) or self._slo
+        search = CapacitySearch(self._app_state, float(options.get("step_min", 3)), slo["p95_sec"], slo["err_rate"],
+                                float(slo.get("min_confirmed_frac") or 0.85),
+                                steady_tol=float(options.get("steady_tol", 0.05)),
+                                step_max_min=float(options.get("step_max_min", 0)) or float(options.get("step_min", 3)) * 2,
+                                gen_lag_p99_sec=float(options.get("gen_lag_p99_sec", 0.05)),
+                                min_send_ratio=float(options.get("gen_send_ratio", 0.9)))
+        result = await search.find(options.get("strategy", "bisect"), self._eps(phase),
+                                   float(options.get("step_inc", 0.10)), float(options.get("resolution", 0.02)),
+                                   float(options.get("min_eps", 0)))
+        self.last_search = result
+        if result.best_sustainable > 0:
+            self._capacity = result.best_sustainable
+        logging.info("Capacity: %.0f EPS%s", self._capacity, " (generator-bound)" if result.generator_bound else "")
+        last = result.last
+        if last is not None:
+            # the row is the last probe, capacity is the best passing one
+            self._report(name, "search", last.eps, last.seconds, phase,
+                         (last.lats, last.batches_sent, last.confirms, last.errors),
+                         (last.passed, result.generator_bound))
+
+    async def _spike(self, name: str, phase: dict) -> None:
+        eps = self._eps(phase, default_x=2.0)
+        seconds = float(phase.get("min", 2)) * 60
+        settle_eps = self._eps(phase, "settle_", 0.7)
+        settle_seconds = float(phase.get("settle_sec", 30))
+        for n in range(1, int(phase.get("count", 1)) + 1):
+            if self._app_state.stopped:
+                return
+            logging.info("Spike #%d: total EPS %.0f for %.1f min", n, eps, seconds / 60)
+            await self._hold(eps, seconds)
+            self._report(f"{name}#{n}", "spike", eps, seconds, phase)
+            if settle_seconds > 0:
+                logging.info("Spike #%d: settle at %.0f EPS for %.0f sec", n, settle_eps, settle_seconds)
+                await self._hold(settle_eps, settle_seconds)
+                self._report(f"{name}#{n}-settle", "settle", settle_eps, settle_seconds, phase)
+
+    async def _soak(self, name: str, phase: dict) -> None:
+        eps = self._eps(phase, default_x=0.75)
+        seconds = float(phase.get("min", 60)) * 60
+        log_sec = float(phase.get("log_sec", 30))
+        logging.info("Soak: total EPS %.0f for %.1f min", eps, seconds / 60)
+        await self._app_state.set_rate_limit_total(eps)
+        self._start_window()
+        lats = LatencyHistogram()
+        batches_sent = confirms = errors = 0
+        started = self._app_state.window_started
+        left = seconds
+        while left > 0 and not self._app_state.stopped:
+            await sleep_until(started + min(seconds, seconds - left + log_sec))
+            left = max(0.0, seconds - (time.monotonic() - started))
+            window = self._app_state.snapshot_and_reset_window()
+            lats.merge(window[0])
+            batches_sent, confirms, errors = batches_sent + window[1], confirms + window[2], errors + window[3]
+            hours, remainder = divmod(int(left), 3600)
+            logging.info("Soak: confirms=%d, errors=%d (err_rate=%.3f), p95=%.3fs, %02d:%02d:%02d left",
+                         window[2], window[3], window[3] / max(1, window[2] + window[3]), window[0].percentile(95),
+                         hours, remainder // 60, remainder % 60)
+        self._report(name, "soak", eps, seconds - left, phase, (lats, batches_sent, confirms, errors))
+
+    async def _churn(self, name: str, phase: dict) -> None:
+        app_state = self._app_state
+        eps = self._eps(phase, default_x=0.5)
+        seconds = int(float(phase.get("min", 3)) * 60)
+        pre_sec = int(phase.get("pre_sec", 20))  # steady traffic before the first drop: the baseline
+        storm = bool(phase.get("storm", False))
+        rate = float(phase.get("rate", 10))  # agents dropped per second
+        churn_sec = 0 if storm else int(phase.get("churn_sec", 30))
+        fraction = float(phase.get("fraction", 1.0))  # storm: part of the agents dropped at once
+        if storm:
+            logging.info("Churn: total EPS %.0f for %.1f min, %.0f%% of agents dropped at once after %d sec",
+                         eps, seconds / 60, fraction * 100, pre_sec)
+        else:
+            logging.info("Churn: total EPS %.0f for %.1f min, %.1f agents/sec dropped for %d sec after %d sec",
+                         eps, seconds / 60, rate, churn_sec, pre_sec)
+        await app_state.set_rate_limit_total(eps)
+        self._start_window()
+        app_state.take_reconnect_latencies()
+
+        # per-second samples on whole seconds of the window; drops happen right after a sample
+        started = app_state.window_started
+        eps_samples: list[float] = []
+        approvals: list[int] = []
+        confirmed_rate = ConfirmedRate(app_state)
+        last_approved = app_state.agents_approved
+        dropped_before = app_state.agents_dropped
+        requested = 0  # drops asked for (worker processes report what they did drop later)
+        tick = 0
+        while tick < seconds and not app_state.stopped:
+            tick += 1
+            await sleep_until(started + tick)
+            approved = app_state.agents_approved
+            eps_samples.append(confirmed_rate.sample())
+            approvals.append(approved - last_approved)
+            last_approved = approved
+            if storm and tick == pre_sec:
+                requested += app_state.drop_agents(round(app_state.agents_count * fraction))
+                logging.info("Churn: %d agents to drop", requested)
+            elif not storm and pre_sec <= tick < pre_sec + churn_sec:
+                requested += app_state.drop_agents(round(rate * (tick - pre_sec + 1)) - requested)
+
+        dropped = app_state.agents_dropped - dropped_before
+        stats = ChurnStats(dropped, app_state.take_reconnect_latencies(), eps_samples, approvals,
+                           pre_sec, pre_sec + churn_sec)
+        logging.info("Churn: dropped=%d, reconnect p50/p95/p99=%.3f/%.3f/%.3fs, handshakes/sec mean=%.1f peak=%d, "
+                     "EPS dip=%.0f%% of %.0f, recovered %s",
+                     dropped, stats.reconnect.percentile(50), stats.reconnect.percentile(95),
+                     stats.reconnect.percentile(99), stats.handshakes_mean, stats.handshakes_peak,
+                     stats.dip * 100, stats.baseline_eps,
+                     "in %.0f sec" % stats.recovery_sec if stats.recovery_sec is not None else "NEVER in the phase")
+        self._report(name, "churn", eps, seconds, phase, churn=stats)
+
+    async def _replay(self, name: str, phase: dict) -> None:
+        app_state = self._app_state
+        path = phase["trace"]
+        speed = float(phase.get("speed", 1.0))
+        from_sec, to_sec = float(phase.get("from_sec", 0)), float(phase.get("to_sec", 0))
+        logging.info("Replay: %s at %gx speed", path, speed)
+        await app_state.wait_ready()
+        self._start_window()
+        app_state.snapshot_and_reset_window()
+        if isinstance(app_state, ShardedAppState):
+            stats = await app_state.replay_trace(path, speed, from_sec, to_sec)
+        else:
+            stats = await replay_trace(app_state, app_state.agents, path, speed, from_sec, to_sec)
+        # confirms of the last batches belong to the phase
+        await sleep_until(time.monotonic() + float(phase.get("drain_sec", 2)))
+        seconds = app_state.window_elapsed()
+        logging.info("Replay: %d/%d batches sent (%d events), %d skipped (agent not connected or window full), "
+                     "latest send %.3fs after its time", stats.sent, stats.records, stats.events, stats.skipped,
+                     stats.max_late)
+        # the target of the row is what the trace offered, as replayed
+        self._report(name, "replay", stats.events / seconds if seconds > 0 else 0.0, seconds, phase)
+
+# -----------------------------
+# Agents for a scenario
+# -----------------------------
+def add_agent_args(p) -> None:
+    # connection and agent pool options shared by the scenario scripts
+    p.add_argument('--window', type=int, default=1) # batches in flight per agent (1 = wait confirm before next send)
+    p.add_argument('--open-loop', action='store_true') # plan sends from target rate; latency from planned send time
+    p.add_argument('--spawn-rate', type=float, default=0) # new connections per sec (0 = all at once)
+    p.add_argument('--handshake-limit', type=int, default=0) # connects in progress at most (0 = no limit)
+    p.add_argument('--ready-frac', type=float, default=1.0) # start traffic when this part of agents is approved
+    p.add_argument('--metrics-to', type=str, default=None) # per-second metrics stream file
+    p.add_argument('--metrics-format', type=str, default='jsonl', choices=['jsonl', 'bin']) # bin: columnar float64 blocks
+    p.add_argument('--metrics-port', type=int, default=0) # serve OpenMetrics on http://127.0.0.1:PORT/metrics (0 = off)
+    p.add_argument('--workers', type=int, default=1) # agent processes; >1 shards agents across cores
+    p.add_argument('--no-tls', action='store_true') # plaintext connection (e.g. TestServer.py --no-tls)
+    p.add_argument('--tls-read-buffer', type=int, default=TLS_READ_BUFFER) # plaintext read buffer of every TLS connection in the process (0 = asyncio's 256 KB)
+    p.add_argument('--transport', type=str, default='stream', choices=TRANSPORTS) # protocol: frames parsed in place, coalesced writes
+    p.add_argument('--reconnect', action='store_true') # lost agents connect again (churn phases need it)
+    p.add_argument('--backoff-base', type=float, default=0.5) # reconnect backoff: random 0..min(max, base * 2^failures) sec
+    p.add_argument('--backoff-max', type=float, default=30.0)
+    p.add_argument('--payloads', type=str, default=None) # event corpus file, or "default" (see agent_payloads.py); constant events when not set
+    p.add_argument('--fleet', type=str, default=None) # agent profile classes file, or "default" (see agent_fleet.py, needs numpy); overrides --event-batch
+    p.add_argument('--record-trace', type=str, default=None) # write every batch sent to a trace file for Agent_Replay.py (see agent_trace.py)
+    p.add_argument('--nodes', type=int, default=0) # coordinate N generator nodes (Agent_Node.py) instead of local agents (see agent_cluster.py)
+    p.add_argument('--cluster-listen', type=str, default=f'127.0.0.1:{DEFAULT_CLUSTER_PORT}') # --nodes: address the nodes connect to (0.0.0.0: all interfaces)
+    p.add_argument('--cluster-key', type=str, default=DEFAULT_CLUSTER_KEY) # --nodes: shared secret of the coordinator and its nodes; the default only on loopback
+
+async def start_metrics(args, app_state: AppState) -> Optional[MetricsRecorder]:
+    if not args.metrics_to and not args.metrics_port:
+        return None
+    recorder = MetricsRecorder(app_state, args.metrics_to, args.metrics_format)
+    recorder.start()
+    if args.metrics_port:
+        await recorder.serve(args.metrics_port)
+    return recorder
+
+async def run_with_agents(args, controller: Callable[[AppState], Awaitable[None]], self_paced: bool = True) -> None:
+    # connects args.agents agents (in this process or in worker processes), runs the controller
+    # on them and disconnects; the pool stays connected for all phases of the controller.
+    # Not self paced: agents send only what the controller tells them to (trace replay)
+    config = AgentConfig(args.host, args.port, args.token, args.event_batch, window=args.window, open_loop=args.open_loop,
+                         use_tls=not args.no_tls, spawn_rate=args.spawn_rate, handshake_limit=args.handshake_limit,
+                         tls_read_buffer=args.tls_read_buffer, transport=args.transport, reconnect=args.reconnect,
+                         backoff_base=args.backoff_base, backoff_max=args.backoff_max,
+                         payloads=load_corpus(args.payloads) if args.payloads else None, self_paced=self_paced)
+    fleet_spec = load_fleet(args.fleet) if args.fleet else None
+    fleet = Fleet(fleet_spec, args.agents) if fleet_spec else None
+    # with a fleet, sent events are counted at the fleet's average batch; confirmed EPS is measured per agent
+    batch_size = fleet.events_per_batch if fleet else args.event_batch
+    if fleet:
+        logging.info("Fleet: %s; %.1f events per batch on average", fleet.describe(), batch_size)
+    trace = TraceRecorder(args.record_trace, args.agents) if args.record_trace else None
+
+    if args.nodes > 0 or args.workers > 1:
+        if args.nodes > 0:
+            host, _, port = args.cluster_listen.rpartition(':')
+            app_state = ClusterAppState(args.agents, batch_size, config, args.nodes, (host or '0.0.0.0', int(port)),
+                                        args.cluster_key, args.ready_frac, fleet_spec=fleet_spec, trace=trace)
+        else:
+            app_state = ShardedAppState(args.agents, batch_size, config, args.workers, args.ready_frac,
+                                        fleet_spec=fleet_spec, trace=trace)
+        app_state.fleet = fleet  # per-class stats of the workers are merged here
+        await app_state.start_workers()
+        recorder = await start_metrics(args, app_state)
+
+        # Run scenario controller, agents run in worker processes or on the nodes
+        await controller(app_state)
+
+        # Signal to stop and wait for the final stats of the workers
+        app_state.signalToStop()
+        await app_state.join_workers()
+        if recorder:
+            await recorder.stop()
+        if trace:
+            await trace.close()
+        return
+
+    app_state = AppState(args.agents, batch_size, args.ready_frac)
+    app_state.fleet = fleet
+    app_state.trace = trace
+    agents = [AgentSocket(config, app_state, i if fleet else -1) for i in range(args.agents)]
+    app_state.attach_agents(agents)
+
+    # Start agent tasks
+    ramp = ConnectionRamp(config, app_state)
+    ramp.start(agents)
+    recorder = await start_metrics(args, app_state)
+
+    # Run scenario controller
+    await controller(app_state)
+
+    # Signal to stop and disconnect agents
+    app_state.signalToStop()
+    await asyncio.sleep(3) # Allow some time for agents to finish
+    await asyncio.gather(*[agent.disconnect() for agent in agents])
+
+    # Wait for all agents to finish
+    await ramp.join()
+    if recorder:
+        await recorder.stop()
+    if trace:
+        await trace.close()
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import mmap
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+from agent_common import AgentSocket, AppState
+
+# -----------------------------
+# Trace file
+# -----------------------------
+# 32-byte header, then 16-byte records, little endian:
+#   header: b"LTTRACE1", float64 wall-clock start (time.time()), uint32 agents, 12 zero bytes
+#   record: float64 sec since start, uint32 agent id (0..agents-1), uint32 batch size (events)
+# Records are in time order; with worker processes they are sorted per written block, and may be out of order
+# by up to a stats push interval where two blocks meet.
+TRACE_MAGIC = b"LTTRACE1"
+TRACE_HEADER = struct.Struct("<8sdI12x")
+TRACE_RECORD = struct.Struct("<dII")
+
+class TraceReader:
+    # The file is memory-mapped and read in blocks of records, so a multi-GB trace streams through
+    # the page cache instead of being loaded
+    BLOCK_RECORDS = 65536
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path} is empty, not a trace file")
+        if len(self._mmap) < TRACE_HEADER.size:
+            self.close()
+            raise ValueError(f"{path} is not a trace file")
+        magic, self.started, self.agents = TRACE_HEADER.unpack_from(self._mmap, 0)
+        if magic != TRACE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a trace file")
+        self.records = (len(self._mmap) - TRACE_HEADER.size) // TRACE_RECORD.size
+
+    def __enter__(self) -> "TraceReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+    def record(self, index: int) -> tuple[float, int, int]:
+        return TRACE_RECORD.unpack_from(self._mmap, TRACE_HEADER.size + index * TRACE_RECORD.size)
+
+    @property
+    def duration(self) -> float:
+        return self.record(self.records - 1)[0] if self.records else 0.0
+
+    def mean_batch(self, sample: int = 100000) -> float:
+        # events per batch over the first records, a sample is enough for rates from confirm counts
+        count = total = 0
+        for _, _, events in self.read():
+            count += 1
+            total += events
+            if count >= sample:
+                break
+        return total / count if count else 0.0
+
+    def find(self, sec: float) -> int:
+        # index of the first record at or after sec (bisection over the mapped file)
+        low, high = 0, self.records
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < sec:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def read(self, first: int = 0) -> Iterator[tuple[float, int, int]]:
+        # (sec, agent id, batch size) from record `first` on
+        for start in range(first, self.records, self.BLOCK_RECORDS):
+            end = min(self.records, start + self.BLOCK_RECORDS)
+            yield from TRACE_RECORD.iter_unpack(
+                self._mmap[TRACE_HEADER.size + start * TRACE_RECORD.size:TRACE_HEADER.size + end * TRACE_RECORD.size])
+
+class TraceRecorder:
+    # Records every batch sent as (sec since start, agent id, batch size). Agents get ids in the order of
+    # their first batch, from id_base (worker processes take their part of the run's ids). Records are
+    # packed on the event loop; with a path they are written in blocks by one writer thread, never on the
+    # loop (one thread: blocks reach the file in order), without one they are taken by take() (worker
+    # processes send them to the parent).
+    def __init__(self, path: Optional[str], agents: int, started: Optional[float] = None, id_base: int = 0,
+                 flush_bytes: int = 1 << 20) -> None:
+        self._path = path
+        self._agents = agents
+        self.started = time.time() if started is None else started
+        # monotonic clock from here on: a wall clock step can't reorder the records
+        self._mono_start = time.monotonic() - (time.time() - self.started)
+        self._ids: dict[int, int] = {}
+        self._id_base = id_base
+        self._buffer = bytearray()
+        self._flush_bytes = flush_bytes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="TraceWriter") if path else None
+        self._pending_write: Optional[asyncio.Future] = None
+        self._merged = False  # records of worker processes interleave: blocks are sorted before they are written
+        self.count = 0
+        if path:
+            with open(path, 'wb') as f:
+                f.write(TRACE_HEADER.pack(TRACE_MAGIC, self.started, agents))
+
+    def record(self, agent_key: int, events: int) -> None:
+        agent_id = self._ids.get(agent_key)
+        if agent_id is None:
+            agent_id = self._ids[agent_key] = self._id_base + len(self._ids)
+        self._buffer += TRACE_RECORD.pack(time.monotonic() - self._mono_start, agent_id, events)
+        self.count += 1
+        if self._path and len(self._buffer) >= self._flush_bytes:
+            self._flush()
+
+    def merge(self, records: bytes) -> None:
+        # packed records from a worker process, same start and clock
+        self._merged = True
+        self._buffer += records
+        self.count += len(records) // TRACE_RECORD.size
+        if self._path and len(self._buffer) >= self._flush_bytes:
+            self._flush()
+
+    def take(self) -> bytes:
+        records, self._buffer = bytes(self._buffer), bytearray()
+        return records
+
+    async def close(self) -> None:
+        self._flush()
+        if self._pending_write:
+            await self._pending_write
+        if self._executor is not None:
+            self._executor.shutdown()
+        logging.info("Trace: %d batches of %d agents recorded to %s", self.count, self._agents, self._path)
+
+    def _flush(self) -> None:
+        if not self._buffer or not self._path:
+            return
+        records = self.take()
+        self._pending_write = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._write, records, self._merged)
+
+    def _write(self, records: bytes, sort: bool) -> None:
+        if sort:
+            records = b"".join(TRACE_RECORD.pack(*record) for record in sorted(TRACE_RECORD.iter_unpack(records)))
+        try:
+            with open(self._path, 'ab') as f:
+                f.write(records)
+        except OSError as ex:
+            logging.error("Can't write trace: %s", ex)
+
+# -----------------------------
+# Replay
+# -----------------------------
+class ReplayStats:
+    def __init__(self) -> None:
+        self.records = 0  # trace records for these agents
+        self.sent = 0
+        self.events = 0  # in the batches sent
+        self.skipped = 0  # agent not connected, or its window still full of unconfirmed batches
+        self.max_late = 0.0  # worst delay of a send after its due time, sec
+
+    def merge(self, other: "ReplayStats") -> None:
+        self.records += other.records
+        self.sent += other.sent
+        self.events += other.events
+        self.skipped += other.skipped
+        self.max_late = max(self.max_late, other.max_late)
+
+class TraceReplayer:
+    # Sends the batches of a trace at their (time-scaled) times, open loop: latency counts from the due time.
+    # Trace agents map to `total` replay agents: several trace agents share one connection when there are
+    # fewer replay agents, and a trace agent's batches go round robin over its copies when there are more.
+    # This process drives agents[i] as replay agent offset + i; the others belong to other worker processes.
+    SEND_AHEAD = 0.001  # records due within this are sent together, without a sleep
+    YIELD_EVERY = 256  # records handled without a sleep before the loop gets a turn (replay behind its trace)
+
+    def __init__(self, app_state: AppState, reader: TraceReader, agents: list[AgentSocket], total: int,
+                 offset: int = 0, speed: float = 1.0, from_sec: float = 0.0, to_sec: float = 0.0) -> None:
+        self._app_state = app_state
+        self._reader = reader
+        self._agents = agents
+        self._total = total
+        self._offset = offset
+        self._speed = speed
+        self._from_sec = from_sec
+        self._to_sec = to_sec or float('inf')
+        self.stats = ReplayStats()
+
+    async def run(self, start: Optional[float] = None) -> ReplayStats:
+        # start: time.monotonic() of the first replayed record (now when not set)
+        app_state, reader, stats = self._app_state, self._reader, self.stats
+        scheduler = app_state.send_scheduler
+        trace_agents = max(1, reader.agents)
+        total, offset, local = self._total, self._offset, len(self._agents)
+        copies_of = [total // trace_agents + (1 if a < total % trace_agents else 0) for a in range(trace_agents)] \
+            if total > trace_agents else None
+        sent_by = [0] * trace_agents  # batches of each trace agent so far, for the round robin over copies
+        agents = self._agents
+        start = time.monotonic() if start is None else start
+        # the first record replayed is due at start: the idle time before it (connects) is skipped
+        first = reader.find(self._from_sec)
+        origin = reader.record(first)[0] if first < reader.records else self._from_sec
+        scale = 1.0 / self._speed
+        to_sec = self._to_sec
+        unyielded = 0
+
+        for sec, trace_agent, events in reader.read(first):
+            if sec >= to_sec:
+                break
+            trace_agent %= trace_agents
+            if copies_of is None:
+                replay_agent = trace_agent % total
+            else:
+                replay_agent = trace_agent + trace_agents * (sent_by[trace_agent] % copies_of[trace_agent])
+                sent_by[trace_agent] += 1
+            index = replay_agent - offset
+            if index < 0 or index >= local:
+                continue
+            stats.records += 1
+            due = start + (sec - origin) * scale
+            now = time.monotonic()
+            if due > now + self.SEND_AHEAD:
+                unyielded = 0
+                while due > now + self.SEND_AHEAD and not app_state.stopped:
+                    # on the shared scheduler, so stopping the run ends the wait
+                    await scheduler.wait_until(due)
+                    now = time.monotonic()
+            else:
+                unyielded += 1
+                if unyielded >= self.YIELD_EVERY:
+                    # late replay never sleeps: confirms must still be read (or every window stays full),
+                    # stats and metrics tasks run
+                    unyielded = 0
+                    await asyncio.sleep(0)
+                    now = time.monotonic()
+            if app_state.stopped:
+                break
+            if agents[index].replay_send(events, min(due, now)):
+                stats.sent += 1
+                stats.events += events
+                if now - due > stats.max_late:
+                    stats.max_late = now - due
+            else:
+                stats.skipped += 1
+        return stats
+
+async def replay_trace(app_state: AppState, agents: list[AgentSocket], path: str, speed: float = 1.0,
+                       from_sec: float = 0.0, to_sec: float = 0.0, total: Optional[int] = None, offset: int = 0,
+                       start: Optional[float] = None) -> ReplayStats:
+    # replays a trace file on connected agents, once traffic may start
+    await app_state.wait_ready()
+    with TraceReader(path) as reader:
+        replayer = TraceReplayer(app_state, reader, agents, total or len(agents), offset, speed, from_sec, to_sec)
+        return await replayer.run(start)
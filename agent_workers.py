@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from multiprocessing.connection import Connection
+from typing import Optional
+from agent_common import AgentConfig, AgentCounters, AgentSocket, AppState, ConnectionRamp, sleep_until
+from agent_fleet import Fleet
+from agent_trace import ReplayStats, TraceRecorder, replay_trace
+
+# -----------------------------
+# Multi-process agent sharding
+# -----------------------------
+# The parent process keeps the scenario controller and a ShardedAppState: it owns the total
+# EPS budget and the step windows. Agents live in worker processes, each with its own event loop.
+# Parent -> worker: ("rate", eps, ramp_sec, at), ("ready",), ("drop", count),
+#                   ("replay", path, speed, from_sec, to_sec, total, offset, start_wall), ("stop",)
+# Worker -> parent: ("stats", approved, active, lats, batches_sent, confirms, errors, loop_window, reconnect_lats,
+#                    class_windows, trace_records, agent_counters, window_sec, events_sent),
+#                   ("dropped", count), ("replayed", replay_stats), ("done",)
+
+COUNTERS_EVERY = 4  # per-agent counters go with every 4th stats push
+
+class ShardedAppState(AppState):
+    def __init__(self, agents_count: int, batch_size: int, config: AgentConfig,
+                 workers: int, ready_fraction: float = 1.0, push_interval: float = 0.5,
+                 fleet_spec: Optional[dict] = None, trace: Optional[TraceRecorder] = None) -> None:
+        super().__init__(agents_count, batch_size, ready_fraction)
+        self._config = config
+        self._push_interval = push_interval
+        self._fleet_spec = fleet_spec  # every worker builds the whole fleet from it and takes its own slice
+        # workers record their batches with the same start and their own agent ids, the parent writes them
+        self.trace = trace
+
+        workers = max(1, min(workers, agents_count))
+        base, extra = divmod(agents_count, workers)
+        self._shares = [base + (1 if i < extra else 0) for i in range(workers)]
+        self._offsets: list[int] = []  # first agent of every worker
+        self.agent_counters = AgentCounters(agents_count)  # the workers' counters land in their slices
+        # per worker: (sec of its pushed windows, events confirmed in them), see confirm_marks
+        self._worker_marks: dict[int, tuple[float, int]] = {}
+
+        self._conns: list[Connection] = []
+        self._processes: list[multiprocessing.Process] = []
+        self._readers: list[asyncio.Task] = []
+        self._replays: list[asyncio.Future] = []
+
+    @property
+    def workers_count(self) -> int:
+        return len(self._shares)
+
+    async def start_workers(self) -> None:
+        # spawn: fork is unsafe with a running event loop, and is the only option on Windows anyway
+        ctx = multiprocessing.get_context("spawn")
+        offset = 0
+        for i, share in enumerate(self._shares):
+            self._offsets.append(offset)
+            parent_conn, child_conn = ctx.Pipe()
+            fleet = (self._fleet_spec, self._agents_count, offset) if self._fleet_spec else None
+            trace = (self.trace.started, offset) if self.trace is not None else None
+            offset += share
+            process = ctx.Process(
+                target=worker_main, name=f"AgentWorker-{i}", daemon=True,
+                args=(child_conn, self._config, share, share / self._agents_count, self._push_interval, fleet, trace))
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+            self._readers.append(asyncio.create_task(self._read_worker(i, parent_conn)))
+        logging.info("Started %d agent workers, agents per worker: %s", len(self._shares), self._shares)
+
+    async def join_workers(self, timeout: float = 30.0) -> None:
+        # expects signalToStop() to be called already; waits for the final stats of every worker
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._readers, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Agent workers did not stop in %.0f sec, terminating", timeout)
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+            await asyncio.to_thread(process.join)
+
+    def signalToStop(self) -> None:
+        super().signalToStop()
+        self._broadcast(lambda i: ("stop",))
+
+    async def set_rate_limit_total(self, eps: float, settle_sec: float = 5.0, reset_window: bool = True,
+                                   ramp_sec: float = 0.0) -> None:
+        # every worker gets the part of the budget that matches its part of the agents and runs the
+        # same ramp; the parent alone waits for the settle time and cuts the step window
+        total = max(0.0, eps)
+        at = self._start_at()
+        self._broadcast(lambda i: ("rate", total * self._shares[i] / self._agents_count, ramp_sec,
+                                   self._worker_time(i, at) if at is not None else None))
+        if at is not None:
+            await sleep_until(time.monotonic() + at - time.time())  # the step starts here when it does on the workers
+        await super().set_rate_limit_total(eps, settle_sec, reset_window, ramp_sec)
+
+    def _start_at(self) -> Optional[float]:
+        # time.time() at which the workers apply a rate change; None: as soon as they get it (same host, a pipe away)
+        return None
+
+    def _worker_time(self, index: int, at: float) -> float:
+        # `at` on the clock of a worker
+        return at
+
+    def drop_agents(self, count: int) -> int:
+        # split as the agents are; each worker drops random agents of its own. Returns the number requested:
+        # a worker with fewer connected agents drops fewer, the real count is agents_dropped once they reply
+        base, extra = divmod(count, len(self._shares))
+        parts = [min(share, base + (1 if i < extra else 0)) for i, share in enumerate(self._shares)]
+        self._broadcast(lambda i: ("drop", parts[i]))
+        return sum(parts)
+
+    async def replay_trace(self, path: str, speed: float = 1.0, from_sec: float = 0.0, to_sec: float = 0.0,
+                           start_delay: float = 0.5) -> ReplayStats:
+        # every worker replays the records of its own agents, from one start time
+        await self.wait_ready()
+        loop = asyncio.get_running_loop()
+        self._replays = [loop.create_future() for _ in self._conns]
+        start_wall = time.time() + start_delay
+        self._broadcast(lambda i: ("replay", path, speed, from_sec, to_sec, self._agents_count, self._offsets[i],
+                                   self._worker_time(i, start_wall)))
+        stats = ReplayStats()
+        for worker_stats in await asyncio.gather(*self._replays):
+            stats.merge(worker_stats)
+        return stats
+
+    def confirm_marks(self) -> dict[int, tuple[float, int]]:
+        # the workers' own window times: counts move only when a worker pushes, a rate over the
+        # parent's clock would alias with the pushes
+        return dict(self._worker_marks)
+
+    def on_agent_approved(self) -> None:
+        was_ready = self._ready
+        super().on_agent_approved()
+        if self._ready and not was_ready:
+            # start traffic in all workers at once, as in the single-process mode
+            self._broadcast(lambda i: ("ready",))
+
+    def _broadcast(self, make_msg) -> None:
+        for i, conn in enumerate(self._conns):
+            try:
+                conn.send(make_msg(i))
+            except (OSError, EOFError):
+                pass  # worker already gone
+
+    async def _read_worker(self, index: int, conn: Connection) -> None:
+        approved, active = 0, 0
+        while True:
+            try:
+                msg = await asyncio.to_thread(conn.recv)
+            except (OSError, EOFError):
+                if self._replays and not self._replays[index].done():
+                    self._replays[index].set_result(ReplayStats())  # the worker is gone, so is its replay
+                return
+            if msg[0] == "stats":
+                (_, worker_approved, worker_active, lats, batches_sent, confirms, errors, loop_window, reconnect_lats,
+                 class_windows, trace_records, agent_counters, window_sec, events_sent) = msg
+                new_approvals = worker_approved - approved
+                for _ in range(new_approvals):
+                    self.on_agent_approved()  # counts the agent as active too
+                self._agents_active += worker_active - active - new_approvals
+                approved, active = worker_approved, worker_active
+                self.merge_window(lats, batches_sent, confirms, errors, events_sent)
+                self._loop_monitor.merge_window(*loop_window, index)
+                self._reconnect_latencies.merge(reconnect_lats)
+                if class_windows is not None and self.fleet is not None:
+                    self.fleet.merge_window(class_windows)
+                if trace_records and self.trace is not None:
+                    self.trace.merge(trace_records)
+                if agent_counters is not None:
+                    self.agent_counters.load(self._offsets[index], agent_counters)
+                events = (sum(window.events_confirmed for window in class_windows) if class_windows is not None
+                          else confirms * self._batch_size)
+                seconds, total = self._worker_marks.get(index, (0.0, 0))
+                self._worker_marks[index] = (seconds + window_sec, total + events)
+            elif msg[0] == "dropped":
+                self._agents_dropped += msg[1]
+            elif msg[0] == "replayed":
+                if self._replays and not self._replays[index].done():
+                    self._replays[index].set_result(msg[1])
+            elif msg[0] == "done":
+                return
+
+# -----------------------------
+# Worker process
+# -----------------------------
+class WorkerAppState(AppState):
+    # Traffic starts when the parent says all agents of all workers are approved
+    def on_agent_approved(self) -> None:
+        self._agents_approved += 1
+        self._agents_active += 1
+
+    def mark_ready(self) -> None:
+        self._set_ready()
+
+def worker_main(conn: Connection, config: AgentConfig, agents_count: int, share: float, push_interval: float,
+                fleet: Optional[tuple] = None, trace: Optional[tuple] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(processName)s %(message)s")
+    try:
+        asyncio.run(_worker_loop(conn, config, agents_count, share, push_interval, fleet, trace))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+async def _worker_loop(conn: Connection, config: AgentConfig, agents_count: int, share: float, push_interval: float,
+                       fleet: Optional[tuple], trace: Optional[tuple]) -> None:
+    app_state = WorkerAppState(agents_count, config.batch_size)
+    if fleet is not None:
+        # (spec, agents of the run, first agent of this worker)
+        fleet_spec, total, offset = fleet
+        app_state.fleet = Fleet(fleet_spec, total, offset, agents_count)
+    if trace is not None:
+        # (start of the run's trace, first agent id of this worker); records go to the parent with the stats
+        started, id_base = trace
+        app_state.trace = TraceRecorder(None, agents_count, started, id_base)
+    agents = [AgentSocket(config, app_state, i if fleet is not None else -1) for i in range(agents_count)]
+    app_state.attach_agents(agents)
+    # spawn rate and handshake limit are for the whole run, this worker takes its share of both
+    ramp = ConnectionRamp(config, app_state, share)
+    ramp.start(agents)
+    app_state.loop_monitor.start()  # the parent judges steps by the busiest worker loop
+
+    pushes = 0
+    events_pushed = 0
+
+    def push_stats(final: bool = False) -> None:
+        nonlocal pushes, events_pushed
+        pushes += 1
+        send_counters = final or pushes % COUNTERS_EVERY == 0
+        if send_counters:
+            app_state.sample_agents()
+        window_sec = app_state.window_elapsed()
+        lats, batches_sent, confirms, errors = app_state.snapshot_and_reset_window()
+        events_sent = app_state.totals()[3]
+        events_pushed, events_sent = events_sent, events_sent - events_pushed
+        conn.send(("stats", app_state.agents_approved, app_state.agents_active, lats, batches_sent, confirms, errors,
+                   app_state.loop_monitor.take_window(), app_state.take_reconnect_latencies(),
+                   app_state.fleet.take_window()[0] if app_state.fleet is not None else None,
+                   app_state.trace.take() if app_state.trace is not None else None,
+                   # 64 bytes per agent: every few pushes is enough for step-long windows
+                   app_state.agent_counters.state() if send_counters else None, window_sec, events_sent))
+
+    async def push_loop() -> None:
+        while not app_state.stopped:
+            await asyncio.sleep(push_interval)
+            push_stats()
+
+    async def replay(path: str, speed: float, from_sec: float, to_sec: float, total: int, offset: int,
+                     start_wall: float) -> None:
+        start = time.monotonic() + (start_wall - time.time())
+        try:
+            stats = await replay_trace(app_state, agents, path, speed, from_sec, to_sec, total, offset, start)
+        except Exception as ex:
+            logging.error("Replay failed: %s", ex)
+            stats = ReplayStats()
+        conn.send(("replayed", stats))
+
+    push_task = asyncio.create_task(push_loop())
+    replay_task: Optional[asyncio.Task] = None
+    while not app_state.stopped:
+        try:
+            msg = await asyncio.to_thread(conn.recv)
+        except (OSError, EOFError):
+            break  # parent is gone
+        if msg[0] == "rate":
+            if msg[3] is not None:
+                await asyncio.sleep(max(0.0, msg[3] - time.time()))
+            # the parent resets the step windows; here the window is only a push buffer
+            await app_state.set_rate_limit_total(msg[1], reset_window=False, ramp_sec=msg[2])
+        elif msg[0] == "ready":
+            app_state.mark_ready()
+        elif msg[0] == "drop":
+            conn.send(("dropped", app_state.drop_agents(msg[1])))
+        elif msg[0] == "replay":
+            replay_task = asyncio.create_task(replay(*msg[1:]))
+        elif msg[0] == "stop":
+            app_state.signalToStop()
+
+    app_state.signalToStop()
+    push_task.cancel()
+    if replay_task is not None:
+        await replay_task
+    await asyncio.sleep(3)  # Allow some time for agents to finish
+    await asyncio.gather(*[agent.disconnect() for agent in agents])
+    await ramp.join()
+    try:
+        push_stats(final=True)
+        conn.send(("done",))
+    except (OSError, EOFError):
+        pass
@@ -0,0 +1,34 @@
+import asyncio
+from agent_trace import TRACE_RECORD, TraceReader, TraceRecorder
+
+def test_recorder_writes_every_flushed_block(tmp_path):
+    path = str(tmp_path / "run.trace")
+
+    async def record() -> None:
+        # 100 records per flush: 5 blocks go through the writer thread
+        recorder = TraceRecorder(path, agents=4, flush_bytes=100 * TRACE_RECORD.size)
+        for i in range(500):
+            recorder.record(i % 4, 10 + i)
+        await recorder.close()
+
+    asyncio.run(record())
+    with TraceReader(path) as reader:
+        assert reader.agents == 4
+        assert reader.records == 500
+        records = list(reader.read())
+    assert [events for _, _, events in records] == [10 + i for i in range(500)]
+    assert all(a[0] <= b[0] for a, b in zip(records, records[1:]))
+
+def test_recorder_sorts_merged_blocks(tmp_path):
+    path = str(tmp_path / "merged.trace")
+
+    async def record() -> None:
+        recorder = TraceRecorder(path, agents=2, flush_bytes=4 * TRACE_RECORD.size)
+        # two worker processes' records, interleaved out of order within each block
+        recorder.merge(b"".join(TRACE_RECORD.pack(sec, 0, 1) for sec in (0.3, 0.1, 0.4, 0.2)))
+        recorder.merge(b"".join(TRACE_RECORD.pack(sec, 1, 1) for sec in (0.8, 0.5, 0.7, 0.6)))
+        await recorder.close()
+
+    asyncio.run(record())
+    with TraceReader(path) as reader:
+        assert [sec for sec, _, _ in reader.read()] == [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]